@@ -0,0 +1,311 @@
+"""
+Benchmarks for deck loading, card picking and the main window.
+
+Generates synthetic deck directories, times them and writes the results as JSON:
+
+    python benchmarks/bench.py --scenario small medium --output results.json
+    python benchmarks/bench.py --compare results.json
+
+Everything runs against a temporary config directory and Qt's offscreen platform,
+the real PyJi config and decks are never touched.
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# (files, cards per file)
+SCENARIOS = {
+    'tiny': (1, 100),
+    'small': (10, 1000),
+    'medium': (100, 1000),
+    'large': (1000, 1000),
+    'huge': (1000, 3000),
+}
+DEFAULT_SCENARIOS = ['small', 'medium']
+
+KANJI = [chr(code) for code in range(0x4E00, 0x4E00 + 2000)]
+KANA = [chr(code) for code in range(0x3041, 0x3097)]
+WORDS = ['water', 'fire', 'tree', 'mountain', 'river', 'person', 'sun', 'moon', 'eye', 'mouth', 'to eat', 'to go']
+
+
+def random_text(rng, alphabet, low, high):
+    return ''.join(rng.choice(alphabet) for _ in range(rng.randint(low, high)))
+
+
+def random_card(rng):
+    question = random_text(rng, KANJI, 1, 3)
+    answer = f"{random_text(rng, KANA, 2, 6)} / {rng.choice(WORDS)}"
+    comment = f"{random_text(rng, KANJI, 2, 4)}{random_text(rng, KANA, 3, 10)}"
+    return question, answer, comment
+
+
+def write_deck_file(file_path, deck_name, cards, rng):
+    lines = ['decks:', f"  - name: '{deck_name}'", '    cards:']
+    for _ in range(cards):
+        question, answer, comment = random_card(rng)
+        lines.append(f"      - ['{question}', '{answer}', '{comment}']")
+    with open(file_path, 'w', encoding='utf-8') as file:
+        file.write('\n'.join(lines) + '\n')
+
+
+def write_tsv_file(file_path, deck_name, cards, rng):
+    lines = [f"#deck:{deck_name}"]
+    lines.extend('\t'.join(random_card(rng)) for _ in range(cards))
+    with open(file_path, 'w', encoding='utf-8') as file:
+        file.write('\n'.join(lines) + '\n')
+
+
+# Format -> (file extension, writer)
+FORMATS = {
+    'yaml': ('.yaml', write_deck_file),
+    'tsv': ('.tsv', write_tsv_file),
+}
+
+
+def generate_decks(directory, files, cards, seed=0, deck_format='yaml'):
+    """
+    Fill `directory` with `files` deck files of `cards` CJK-heavy cards each.
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    extension, write = FORMATS[deck_format]
+    for index in range(files):
+        write(os.path.join(directory, f"synthetic-{index:04d}{extension}"), f"Synthetic {index:04d}", cards, rng)
+
+
+def reset_dir(path):
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def max_rss_mb():
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 1024
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_load(decks_dir, cache_dir, store_kind):
+    import cardstore
+    import deck
+
+    def load():
+        return deck.Collection(decks_dir, cache_dir, store=cardstore.open_store(store_kind, cache_dir))
+
+    results = {}
+    reset_dir(cache_dir)
+    collection, results['load_cold_s'] = timed(load)
+    collection.close()
+    collection, results['load_warm_s'] = timed(load)
+    results['cards'] = sum(collection.count(name) for name in collection.get_decks())
+    collection.close()
+
+    # Traced separately, tracemalloc slows the load down
+    gc.collect()
+    tracemalloc.start()
+    collection = load()
+    results['load_heap_current_mb'], results['load_heap_peak_mb'] = (
+        size / 2 ** 20 for size in tracemalloc.get_traced_memory()
+    )
+    tracemalloc.stop()
+    return collection, results
+
+
+def bench_picking(collection, iterations):
+    import deck
+
+    results = {}
+    deck_names = collection.get_decks()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        collection.get_random_card(random.choice(deck_names))
+    results['get_random_card_per_s'] = iterations / (time.perf_counter() - start)
+
+    sampler = deck.WeightedSampler(collection, 'card', deck_names)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        sampler.sample()
+    results['sampler_sample_per_s'] = iterations / (time.perf_counter() - start)
+    sampler.close()
+    return results
+
+
+def bench_deck_dialog(collection, config, repeat):
+    import ui
+
+    dialog = ui.DeckSelectionDialog(collection, config)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        dialog.populate_table()
+    elapsed = (time.perf_counter() - start) / repeat
+    dialog.done(0)
+    dialog.deleteLater()
+    return {'populate_table_s': elapsed}
+
+
+def bench_main_window(app, config, ticks, resizes):
+    import ui
+
+    results = {}
+    window, results['window_create_s'] = timed(ui.MainWindow, config)
+    window.show()
+    start = time.perf_counter()
+    while window.current_card is None or window.loader is not None or not window.painted:
+        app.processEvents()
+        if time.perf_counter() - start > 600:
+            raise RuntimeError("Decks took too long to load")
+        time.sleep(0.001)
+    results['window_load_s'] = time.perf_counter() - start
+
+    window.timer.stop()
+    start = time.perf_counter()
+    for _ in range(ticks):
+        window.update_text()
+        app.processEvents()
+    results['tick_ms'] = (time.perf_counter() - start) / ticks * 1000
+
+    start = time.perf_counter()
+    for index in range(resizes):
+        window.resize(200 + index % 300, 200 + index % 200)
+        # What the resize timer ends up calling
+        window.fit_content()
+        app.processEvents()
+    results['resize_ms'] = (time.perf_counter() - start) / resizes * 1000
+
+    window.close()
+    window.collection.close()
+    window.deleteLater()
+    app.processEvents()
+    return results
+
+
+def run(args):
+    home = tempfile.mkdtemp(prefix='pyji-bench-')
+    # Must happen before config resolves its directory
+    os.environ['HOME'] = home
+    os.environ['APPDATA'] = home
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+    import config as conf
+    import metrics
+
+    if args.metrics:
+        # Before deck and ui are imported, so their hooks are in place
+        metrics.enable()
+    config_dir = conf.get_config_path(config=False)
+    decks_dir = os.path.join(config_dir, 'decks')
+    cache_dir = conf.get_cache_path()
+    config = conf.init()
+    config.set('Collection', 'card_store', args.store)
+
+    app = None
+    if not args.no_ui:
+        import ui
+        app = ui.QApplication.instance() or ui.QApplication([])
+
+    results = []
+    try:
+        for name in args.scenario:
+            files, cards = SCENARIOS[name]
+            print(f"{name}: {files} files x {cards} cards", flush=True)
+            metrics.reset()
+            reset_dir(decks_dir)
+            _, generate_s = timed(generate_decks, decks_dir, files, cards, deck_format=args.format)
+
+            result = {'scenario': name, 'files': files, 'cards_per_file': cards, 'store': args.store,
+                      'format': args.format, 'generate_s': generate_s}
+            collection, load_results = bench_load(decks_dir, cache_dir, args.store)
+            result.update(load_results)
+            result.update(bench_picking(collection, args.iterations))
+            if app is not None:
+                result.update(bench_deck_dialog(collection, config, args.repeat))
+            collection.close()
+            if app is not None:
+                result.update(bench_main_window(app, config, args.ticks, args.resizes))
+            result['max_rss_mb'] = max_rss_mb()
+            if metrics.enabled:
+                result['metrics'] = metrics.snapshot()
+            results.append(result)
+            for key, value in result.items():
+                if key == 'metrics':
+                    continue
+                print(f"  {key:<24} {value:.4g}" if isinstance(value, float) else f"  {key:<24} {value}")
+    finally:
+        config.close()
+        shutil.rmtree(home, ignore_errors=True)
+
+    return {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+
+def compare(old, new):
+    """
+    Print the change of every number between two result files, per scenario.
+    """
+    old_results = {result['scenario']: result for result in old['results']}
+    for result in new['results']:
+        previous = old_results.get(result['scenario'])
+        if previous is None:
+            continue
+        print(f"{result['scenario']} (old -> new):")
+        for key, value in result.items():
+            old_value = previous.get(key)
+            if isinstance(value, float) and isinstance(old_value, (int, float)) and old_value:
+                print(f"  {key:<24} {old_value:10.4g} -> {value:10.4g}  {(value / old_value - 1) * 100:+6.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PyJi benchmarks")
+    parser.add_argument('--scenario', nargs='+', choices=sorted(SCENARIOS), default=DEFAULT_SCENARIOS)
+    parser.add_argument('--store', choices=['memory', 'mmap', 'sqlite'], default='memory')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='yaml', help="format of the generated deck files")
+    parser.add_argument('--iterations', type=int, default=100000, help="cards picked per throughput test")
+    parser.add_argument('--repeat', type=int, default=5, help="populate_table runs")
+    parser.add_argument('--ticks', type=int, default=200, help="MainWindow.update_text calls")
+    parser.add_argument('--resizes', type=int, default=200, help="MainWindow resizes")
+    parser.add_argument('--no-ui', action='store_true', help="skip the Qt benchmarks")
+    parser.add_argument('--metrics', action='store_true', help="add the built-in timings and counters to the results")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="JSON file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            compare(json.load(file), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+
+# Bump when the layout or meaning of cached entries changes so old entries are ignored
+CACHE_VERSION = 2
+CACHE_SUFFIX = '.deck'
+
+
+def cache_file_path(cache_dir, source_path):
+    """
+    Get the cache entry path for a source file. Entries are keyed by the absolute source path.
+    """
+    key = hashlib.sha1(os.path.abspath(source_path).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key + CACHE_SUFFIX)
+
+
+def file_digest(file_path):
+    """
+    Compute the SHA-256 digest of a file's content.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _header(source_path, digest, stat):
+    return {
+        'version': CACHE_VERSION,
+        'path': os.path.abspath(source_path),
+        'mtime': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha256': digest,
+    }
+
+
+def _write_entry(entry_path, header, body):
+    # `body` is a file holding the pickled chunks and trailer, copied after the header
+    tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(header, file, protocol=pickle.HIGHEST_PROTOCOL)
+            body.seek(0)
+            shutil.copyfileobj(body, file, 1 << 20)
+        os.replace(tmp_path, entry_path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _header_matches(header, source_path, stat):
+    # Everything but the mtime, which is checked separately
+    return (
+        isinstance(header, dict)
+        and header.get('version') == CACHE_VERSION
+        and header.get('path') == os.path.abspath(source_path)
+        and header.get('size') == stat.st_size
+    )
+
+
+def _read_body(file):
+    """
+    Yield the chunks of decks of an entry after its header, then its trailer dict.
+    """
+    while True:
+        item = pickle.load(file)
+        yield item
+        if isinstance(item, dict):
+            return
+
+
+def _update_mtime(entry_path, file, header, stat):
+    # Rewrite the entry of a touched but unchanged file with its new mtime, `file` being the open entry
+    header['mtime'] = stat.st_mtime_ns
+    try:
+        file.seek(0)
+        pickle.load(file)
+        with tempfile.TemporaryFile() as body:
+            shutil.copyfileobj(file, body, 1 << 20)
+            _write_entry(entry_path, header, body)
+    except OSError:
+        pass
+
+
+def is_fresh(cache_dir, source_path):
+    """
+    Check whether a source file has an up to date cache entry without loading it. A file whose
+    mtime changed but content didn't is fresh, and its entry gets the new mtime.
+    """
+    entry_path = cache_file_path(cache_dir, source_path)
+    try:
+        stat = os.stat(source_path)
+        with open(entry_path, 'rb') as file:
+            header = pickle.load(file)
+            if not _header_matches(header, source_path, stat):
+                return False
+            if header.get('mtime') == stat.st_mtime_ns:
+                return True
+            if header.get('sha256') != file_digest(source_path):
+                return False
+            _update_mtime(entry_path, file, header, stat)
+        return True
+    except Exception:
+        return False
+
+
+def _drop(entry_path):
+    # Corrupt or unreadable entry, drop it so it gets rebuilt
+    try:
+        os.remove(entry_path)
+    except OSError:
+        pass
+
+
+def iter_chunks(cache_dir, source_path, skipped=None):
+    """
+    Yield the lists of decks of a source file from its cache entry one chunk at a time, like
+    deckstream.ChunkedParser does, and add the descriptions of its skipped cards to `skipped`.
+    The entry must be fresh, see is_fresh. Raises ValueError if it can't be read.
+    """
+    entry_path = cache_file_path(cache_dir, source_path)
+    try:
+        with open(entry_path, 'rb') as file:
+            pickle.load(file)
+            for item in _read_body(file):
+                if isinstance(item, dict):
+                    if skipped is not None:
+                        skipped.extend(item.get('skipped', []))
+                else:
+                    yield item
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError) as e:
+        _drop(entry_path)
+        raise ValueError(f"Deck cache entry is broken: {e}")
+
+
+def load(cache_dir, source_path):
+    """
+    Load cached deck data for a source file, {'decks': [...], 'skipped': [...]} with the chunks
+    of each deck merged. Returns None if there is no entry or the entry is stale or corrupt.
+    """
+    entry_path = cache_file_path(cache_dir, source_path)
+    try:
+        stat = os.stat(source_path)
+        with open(entry_path, 'rb') as file:
+            header = pickle.load(file)
+            if not _header_matches(header, source_path, stat):
+                return None
+            # A touched file is still fresh if the content didn't change
+            touched = header.get('mtime') != stat.st_mtime_ns
+            if touched and header.get('sha256') != file_digest(source_path):
+                return None
+            decks = {}
+            skipped = []
+            for item in _read_body(file):
+                if isinstance(item, dict):
+                    skipped = item.get('skipped', [])
+                    continue
+                for deck in item:
+                    if deck['name'] in decks:
+                        decks[deck['name']]['cards'].extend(deck['cards'])
+                    else:
+                        decks[deck['name']] = {'name': deck['name'], 'cards': list(deck['cards'])}
+            if touched:
+                _update_mtime(entry_path, file, header, stat)
+        return {'decks': list(decks.values()), 'skipped': skipped}
+    except FileNotFoundError:
+        return None
+    except Exception:
+        _drop(entry_path)
+        return None
+
+
+class EntryWriter:
+    """
+    Writes the cache entry of a source file while it is parsed, one chunk of decks at a time.
+    The chunks wait in a temporary file until the header, which needs the digest of the whole
+    source, can be written in front of them. Write errors are printed and the entry is given up.
+    """
+
+    def __init__(self, cache_dir, source_path):
+        self.cache_dir = cache_dir
+        self.source_path = source_path
+        self.body = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.body = tempfile.TemporaryFile(dir=cache_dir)
+        except OSError as e:
+            self.fail(e)
+
+    def fail(self, error):
+        print(f"Failed to write deck cache for {self.source_path}: {error}")
+        self.close()
+
+    def add(self, decks):
+        if self.body is None:
+            return
+        try:
+            pickle.dump(decks, self.body, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError as e:
+            self.fail(e)
+
+    def finish(self, skipped, digest, stat):
+        """
+        Write the entry, `digest` and `stat` must describe the source content the chunks were parsed from.
+        """
+        if self.body is None:
+            return
+        try:
+            pickle.dump({'skipped': skipped}, self.body, protocol=pickle.HIGHEST_PROTOCOL)
+            _write_entry(cache_file_path(self.cache_dir, self.source_path), _header(self.source_path, digest, stat),
+                         self.body)
+        except OSError as e:
+            self.fail(e)
+        self.close()
+
+    def close(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+
+def store(cache_dir, source_path, data, digest, stat):
+    """
+    Store parsed deck data for a source file.
+    `digest` and `stat` must describe the source content the data was parsed from.
+    """
+    writer = EntryWriter(cache_dir, source_path)
+    writer.add(data['decks'])
+    writer.finish(data.get('skipped', []), digest, stat)
@@ -0,0 +1,907 @@
+import array
+import hashlib
+import itertools
+import mmap
+import os
+import sqlite3
+import struct
+import tempfile
+
+# Fields of a card are joined with the ASCII unit separator for its id, same as Anki does
+FIELD_SEPARATOR = '\x1f'
+# Fields starting with this refer to an image file, relative to the decks directory
+IMAGE_PREFIX = 'img:'
+OFFSET = struct.Struct('<Q')
+# Byte lengths of the question and answer heading an MmapCardStore record, the comment takes the rest
+FIELD_LENGTHS = struct.Struct('<II')
+# (key, value) slot of a HashIndex
+SLOT = struct.Struct('<QQ')
+KEY_MASK = (1 << 64) - 1
+
+
+class Card:
+    """
+    A single card. Only the question, answer and comment fields are kept.
+    """
+
+    __slots__ = ('question', 'answer', 'comment')
+
+    def __init__(self, question, answer='', comment=''):
+        self.question = question
+        self.answer = answer
+        self.comment = comment
+
+    @classmethod
+    def from_fields(cls, fields):
+        """
+        Create a card from a list of fields as written in deck files.
+        """
+        return cls(*(field_text(field) for field in fields[:3]))
+
+    def fields(self):
+        return [self.question, self.answer, self.comment]
+
+    def card_id(self):
+        """
+        Get a stable id derived from the card content, a positive 63-bit integer.
+        """
+        content = FIELD_SEPARATOR.join(self.fields()).encode('utf-8')
+        return int.from_bytes(hashlib.blake2b(content, digest_size=8).digest(), 'big') >> 1
+
+    def back_text(self):
+        """
+        Get the text for the back side of the card, the answer followed by the comment.
+        """
+        if self.comment:
+            return f"{self.answer}\n{self.comment}"
+        return self.answer
+
+    def __eq__(self, other):
+        if not isinstance(other, Card):
+            return NotImplemented
+        return self.fields() == other.fields()
+
+    def __hash__(self):
+        return hash((self.question, self.answer, self.comment))
+
+    def __repr__(self):
+        return f"Card({self.question!r}, {self.answer!r}, {self.comment!r})"
+
+
+def field_text(field):
+    return '' if field is None else str(field)
+
+
+def image_reference(field):
+    """
+    Get the image path a field refers to, None if it is plain text.
+    """
+    if field.startswith(IMAGE_PREFIX):
+        return field[len(IMAGE_PREFIX):].strip() or None
+    return None
+
+
+class StringPool:
+    """
+    Deduplicates equal strings so repeated readings and comments are stored once.
+    """
+
+    def __init__(self):
+        self.strings = {}
+
+    def intern(self, text):
+        return self.strings.setdefault(text, text)
+
+
+class SourceRegistry:
+    """
+    Gives source files small integer ids and remembers which decks each file added cards to.
+    Id 0 stands for cards that weren't added from a file.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.decks = {}
+        self.next_id = 1
+
+    def add(self, source, deck_name):
+        if source is None:
+            return 0
+        if source not in self.ids:
+            self.ids[source] = self.next_id
+            self.decks[self.next_id] = set()
+            self.next_id += 1
+        source_id = self.ids[source]
+        self.decks[source_id].add(deck_name)
+        return source_id
+
+    def pop(self, source):
+        """
+        Forget a source, returns its id and deck names, or None and no decks if it is unknown.
+        """
+        source_id = self.ids.pop(source, None)
+        if source_id is None:
+            return None, set()
+        return source_id, self.decks.pop(source_id)
+
+    def references(self, deck_name):
+        return any(deck_name in deck_names for deck_names in self.decks.values())
+
+
+class SourceRefs:
+    """
+    Which source files reference each card of a deck: a list of card positions per source id
+    and a reference count per card, so every reference costs 4 bytes.
+    """
+
+    __slots__ = ('positions', 'counts')
+
+    def __init__(self):
+        # Source id -> positions of the cards it references
+        self.positions = {}
+        self.counts = array.array('I')
+
+    def __len__(self):
+        return len(self.counts)
+
+    def append(self, source_id):
+        """
+        Add a reference to a new card at the end.
+        """
+        self.add(len(self.counts), source_id, new=True)
+
+    def add(self, position, source_id, new=False):
+        if new:
+            self.counts.append(1)
+        else:
+            # A card repeated within one source is counted, and released, once per repetition
+            self.counts[position] += 1
+        if source_id not in self.positions:
+            self.positions[source_id] = array.array('I')
+        self.positions[source_id].append(position)
+
+    def remove(self, source_id):
+        """
+        Drop every reference of a source. Returns the positions of the cards that are still
+        referenced, in order, or None if no card lost its last reference.
+        """
+        counts = self.counts
+        for position in self.positions.pop(source_id, ()):
+            counts[position] -= 1
+        keep = [position for position, count in enumerate(counts) if count]
+        if len(keep) == len(counts):
+            return None
+        new_positions = array.array('I', bytes(4 * len(counts)))
+        for new, old in enumerate(keep):
+            new_positions[old] = new
+        self.counts = array.array('I', (counts[position] for position in keep))
+        for other_id, positions in self.positions.items():
+            self.positions[other_id] = array.array('I', (new_positions[position] for position in positions))
+        return keep
+
+
+def content_key(fields):
+    """
+    Get a nonzero 64-bit key of the fields of a card for the dedup indexes.
+    Keys are only stable within a process and equal keys still need their fields compared.
+    """
+    return (hash(tuple(fields)) & KEY_MASK) or 1
+
+
+class Deck:
+    """
+    Cards of one deck stored as columns of interned strings rather than a list per card.
+    Every distinct card is stored once, with the ids of the source files that contain it.
+    """
+
+    __slots__ = ('questions', 'answers', 'comments', 'refs', 'index')
+
+    def __init__(self):
+        self.questions = []
+        self.answers = []
+        self.comments = []
+        self.refs = SourceRefs()
+        # Hash of the fields -> position, built when cards are added and dropped by trim
+        self.index = None
+
+    def __len__(self):
+        return len(self.questions)
+
+    def __getitem__(self, index):
+        return Card(self.questions[index], self.answers[index], self.comments[index])
+
+    def __iter__(self):
+        return map(Card, self.questions, self.answers, self.comments)
+
+    def extend(self, cards, pool, source_id=0):
+        """
+        Add cards given as lists of fields, interning their strings in `pool`.
+        Cards already in the deck only get `source_id` added to their references.
+        """
+        intern = pool.intern
+        if self.index is None:
+            self.index = self.build_index()
+        index = self.index
+        for fields in cards:
+            card = Card.from_fields(fields)
+            key = hash((card.question, card.answer, card.comment))
+            position = index.get(key)
+            if position is not None and self[position] == card:
+                self.refs.add(position, source_id)
+                continue
+            if position is None:
+                # A hash collision between different cards just leaves the second one unindexed
+                index[key] = len(self.questions)
+            self.questions.append(intern(card.question))
+            self.answers.append(intern(card.answer))
+            self.comments.append(intern(card.comment))
+            self.refs.append(source_id)
+
+    def remove_source(self, source_id):
+        """
+        Remove the references of a source, and the cards no other source references.
+        """
+        keep = self.refs.remove(source_id)
+        if keep is None:
+            return
+        self.questions = [self.questions[index] for index in keep]
+        self.answers = [self.answers[index] for index in keep]
+        self.comments = [self.comments[index] for index in keep]
+        self.index = None
+
+    def trim(self):
+        self.index = None
+
+    def build_index(self):
+        index = {}
+        for position, key in enumerate(map(hash, zip(self.questions, self.answers, self.comments))):
+            index.setdefault(key, position)
+        return index
+
+
+class HashIndex:
+    """
+    Open addressing hash table of 64-bit keys to 64-bit values in a mapped temporary file in
+    `directory`, so it doesn't grow the Python heap and release() can hand its pages back to
+    the OS, which writes them out and reads them in again on the next lookup.
+    Keys must be nonzero, a key may have several values.
+    """
+
+    def __init__(self, directory=None, capacity=1024):
+        self.directory = directory
+        self.capacity = capacity
+        self.size = 0
+        self.file, self.map = self._create(capacity)
+
+    def _create(self, capacity):
+        file = tempfile.TemporaryFile(dir=self.directory)
+        file.truncate(capacity * SLOT.size)
+        return file, mmap.mmap(file.fileno(), capacity * SLOT.size)
+
+    def values(self, key):
+        mask = self.capacity - 1
+        slot = key & mask
+        while True:
+            slot_key, value = SLOT.unpack_from(self.map, slot * SLOT.size)
+            if not slot_key:
+                return
+            if slot_key == key:
+                yield value
+            slot = (slot + 1) & mask
+
+    def get(self, key):
+        return next(self.values(key), None)
+
+    def add(self, key, value):
+        # Keep probe sequences short
+        if (self.size + 1) * 10 > self.capacity * 7:
+            self._grow()
+        self._insert(self.map, self.capacity, key, value)
+        self.size += 1
+
+    @staticmethod
+    def _insert(table, capacity, key, value):
+        mask = capacity - 1
+        slot = key & mask
+        while SLOT.unpack_from(table, slot * SLOT.size)[0]:
+            slot = (slot + 1) & mask
+        SLOT.pack_into(table, slot * SLOT.size, key, value)
+
+    def _grow(self):
+        capacity = self.capacity * 2
+        file, table = self._create(capacity)
+        for key, value in SLOT.iter_unpack(self.map):
+            if key:
+                self._insert(table, capacity, key, value)
+        self.close()
+        self.file, self.map = file, table
+        self.capacity = capacity
+
+    def release(self):
+        """
+        Drop the table pages from the process' memory, they stay in the file.
+        """
+        if hasattr(mmap, 'MADV_DONTNEED'):
+            self.map.madvise(mmap.MADV_DONTNEED)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class MappedDeck:
+    """
+    A deck of MmapCardStore: the record numbers of its cards and their source references.
+    A dict of record number to position is built when cards are added and dropped by trim,
+    only the content index of the store lives in a mapped file.
+    """
+
+    __slots__ = ('records', 'refs', 'index')
+
+    def __init__(self):
+        self.records = array.array('Q')
+        self.refs = SourceRefs()
+        self.index = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, record, source_id):
+        if self.index is None:
+            self.index = {known: position for position, known in enumerate(self.records)}
+        position = self.index.get(record)
+        if position is not None:
+            self.refs.add(position, source_id)
+            return
+        self.index[record] = len(self.records)
+        self.records.append(record)
+        self.refs.append(source_id)
+
+    def remove_source(self, source_id):
+        keep = self.refs.remove(source_id)
+        if keep is None:
+            return
+        self.records = array.array('Q', (self.records[position] for position in keep))
+        self.trim()
+
+    def trim(self):
+        self.index = None
+
+    def close(self):
+        self.trim()
+
+
+class MemoryCardStore:
+    """
+    Keeps every card in memory, in per-deck columns sharing one string pool.
+    """
+
+    persistent = False
+
+    def __init__(self):
+        self.decks = {}
+        self.pool = StringPool()
+        self.sources = SourceRegistry()
+
+    def __contains__(self, deck_name):
+        return deck_name in self.decks
+
+    def get_decks(self):
+        return list(self.decks.keys())
+
+    def count(self, deck_name):
+        return len(self.decks[deck_name])
+
+    def get_card(self, deck_name, index):
+        return self.decks[deck_name][index]
+
+    def snapshot(self, deck_name):
+        """
+        Get a function iterating over the cards the deck has now, which can be called from another thread.
+        """
+        deck = self.decks[deck_name]
+        # Cards are only appended to these lists, removing cards replaces them
+        columns = (deck.questions, deck.answers, deck.comments)
+        count = len(deck)
+        return lambda: itertools.islice(map(Card, *columns), count)
+
+    def add_cards(self, deck_name, cards, source=None):
+        if deck_name not in self.decks:
+            self.decks[deck_name] = Deck()
+        self.decks[deck_name].extend(cards, self.pool, self.sources.add(source, deck_name))
+
+    def remove_source(self, source):
+        """
+        Remove all cards added from a source file, returns the names of the decks that changed.
+        """
+        source_id, deck_names = self.sources.pop(source)
+        for deck_name in deck_names:
+            deck = self.decks[deck_name]
+            deck.remove_source(source_id)
+            if not len(deck) and not self.sources.references(deck_name):
+                del self.decks[deck_name]
+        return sorted(deck_names)
+
+    def get_sources(self):
+        return list(self.sources.ids)
+
+    def trim(self):
+        """
+        Free the dedup indexes once a batch of files is added, they are rebuilt when needed.
+        """
+        for deck in self.decks.values():
+            deck.trim()
+
+    def close(self):
+        pass
+
+
+def read_record(data_map, index_map, total, data_size, position):
+    """
+    Decode record `position` of the MmapCardStore files of `total` records and `data_size` bytes.
+    """
+    start = OFFSET.unpack_from(index_map, position * OFFSET.size)[0]
+    if position + 1 < total:
+        end = OFFSET.unpack_from(index_map, (position + 1) * OFFSET.size)[0]
+    else:
+        end = data_size
+    question_size, answer_size = FIELD_LENGTHS.unpack_from(data_map, start)
+    start += FIELD_LENGTHS.size
+    answer_start = start + question_size
+    comment_start = answer_start + answer_size
+    return Card(
+        bytes(data_map[start:answer_start]).decode('utf-8'),
+        bytes(data_map[answer_start:comment_start]).decode('utf-8'),
+        bytes(data_map[comment_start:end]).decode('utf-8'),
+    )
+
+
+def encode_record(fields):
+    """
+    Encode the question, answer and comment of a card as an MmapCardStore record. Lengths rather than
+    separators delimit the fields, so they can hold any character.
+    """
+    question, answer, comment = (field.encode('utf-8') for field in fields)
+    return FIELD_LENGTHS.pack(len(question), len(answer)) + question + answer + comment
+
+
+class MmapCardStore:
+    """
+    Keeps cards in a memory-mapped data file with a memory-mapped offset index,
+    so only the cards that are actually read get decoded into Python objects.
+
+    The data file holds the cards back to back, see encode_record, and the index holds
+    the start offset of every record. Every distinct card is written once: a content
+    index finds the record of a card already stored, and decks are lists of record numbers.
+    The content index is a mapped file too, whose pages are handed back to the OS by trim.
+    """
+
+    persistent = False
+
+    def __init__(self, directory=None):
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Anonymous files are removed by the OS once closed, even after a crash
+        self.data_file = tempfile.TemporaryFile(dir=directory)
+        self.index_file = tempfile.TemporaryFile(dir=directory)
+        self.data_map = None
+        self.index_map = None
+        self.data_size = 0
+        self.total = 0
+        # Content key -> record number
+        self.content_index = HashIndex(directory)
+        # Deck name -> MappedDeck
+        self.decks = {}
+        self.sources = SourceRegistry()
+
+    def __contains__(self, deck_name):
+        return deck_name in self.decks
+
+    def get_decks(self):
+        return list(self.decks.keys())
+
+    def count(self, deck_name):
+        return len(self.decks[deck_name])
+
+    def get_card(self, deck_name, index):
+        records = self.decks[deck_name].records
+        if not 0 <= index < len(records):
+            raise IndexError(f"Card index {index} out of range for deck '{deck_name}'.")
+        return self._read(records[index])
+
+    def _read(self, position):
+        return read_record(self.data_map, self.index_map, self.total, self.data_size, position)
+
+    def snapshot(self, deck_name):
+        """
+        Get a function iterating over the cards the deck has now, which can be called from another thread.
+        """
+        records = array.array('Q', self.decks[deck_name].records)
+        total, data_size = self.total, self.data_size
+        data_fd, index_fd = self.data_file.fileno(), self.index_file.fileno()
+
+        def read():
+            if not records:
+                return
+            # Maps of its own, the files are only appended to while the store remaps its maps as they grow
+            with mmap.mmap(data_fd, data_size, access=mmap.ACCESS_READ) if data_size else memoryview(b'') as data_map, \
+                    mmap.mmap(index_fd, total * OFFSET.size, access=mmap.ACCESS_READ) as index_map:
+                for record in records:
+                    yield read_record(data_map, index_map, total, data_size, record)
+        return read
+
+    def _find(self, key, card):
+        for record in self.content_index.values(key):
+            if record < self.total and self._read(record) == card:
+                return record
+        return None
+
+    def add_cards(self, deck_name, cards, source=None):
+        if deck_name not in self.decks:
+            self.decks[deck_name] = MappedDeck()
+        deck = self.decks[deck_name]
+        source_id = self.sources.add(source, deck_name)
+
+        data = bytearray()
+        offsets = bytearray()
+        # Records of this call, not readable from the map yet
+        pending = {}
+        for fields in cards:
+            card = Card.from_fields(fields)
+            fields = tuple(card.fields())
+            key = content_key(fields)
+            record = pending.get(fields)
+            if record is None:
+                record = self._find(key, card)
+            if record is None:
+                record = self.total + len(pending)
+                pending[fields] = record
+                self.content_index.add(key, record)
+                offsets += OFFSET.pack(self.data_size + len(data))
+                data += encode_record(fields)
+            deck.add(record, source_id)
+        if not pending:
+            return
+
+        self.data_file.seek(0, os.SEEK_END)
+        self.data_file.write(data)
+        self.data_file.flush()
+        self.index_file.seek(0, os.SEEK_END)
+        self.index_file.write(offsets)
+        self.index_file.flush()
+
+        self.total += len(pending)
+        self.data_size += len(data)
+        self._remap()
+
+    def remove_source(self, source):
+        """
+        Remove all cards added from a source file, returns the names of the decks that changed.
+        Their records stay in the files and are reused if the cards come back, the space is
+        only reclaimed when the store is rebuilt.
+        """
+        source_id, deck_names = self.sources.pop(source)
+        for deck_name in deck_names:
+            deck = self.decks[deck_name]
+            deck.remove_source(source_id)
+            if not len(deck) and not self.sources.references(deck_name):
+                deck.close()
+                del self.decks[deck_name]
+        return sorted(deck_names)
+
+    def get_sources(self):
+        return list(self.sources.ids)
+
+    def _remap(self):
+        self._unmap()
+        if self.data_size:
+            self.data_map = mmap.mmap(self.data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.total:
+            self.index_map = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _unmap(self):
+        if self.data_map is not None:
+            self.data_map.close()
+            self.data_map = None
+        if self.index_map is not None:
+            self.index_map.close()
+            self.index_map = None
+
+    def trim(self):
+        """
+        Drop the per deck indexes and hand the pages of the content index back to the OS
+        once a batch of files is added.
+        """
+        for deck in self.decks.values():
+            deck.trim()
+        self.content_index.release()
+        if hasattr(mmap, 'MADV_DONTNEED'):
+            # Pages of cards read while looking for duplicates
+            for mapped in (self.data_map, self.index_map):
+                if mapped is not None:
+                    mapped.madvise(mmap.MADV_DONTNEED)
+
+    def close(self):
+        self._unmap()
+        for deck in self.decks.values():
+            deck.close()
+        self.content_index.close()
+        self.data_file.close()
+        self.index_file.close()
+
+
+# Bumped when the schema changes, older databases are rebuilt from the deck files
+SQLITE_SCHEMA_VERSION = 3
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS decks (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    card_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS sources (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    mtime INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cards (
+    id INTEGER PRIMARY KEY,
+    question TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    comment TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS deck_cards (
+    deck_id INTEGER NOT NULL REFERENCES decks (id),
+    position INTEGER NOT NULL,
+    card_id INTEGER NOT NULL REFERENCES cards (id),
+    UNIQUE (deck_id, card_id)
+);
+CREATE INDEX IF NOT EXISTS deck_cards_position ON deck_cards (deck_id, position);
+CREATE INDEX IF NOT EXISTS deck_cards_card ON deck_cards (card_id);
+CREATE TABLE IF NOT EXISTS card_sources (
+    deck_id INTEGER NOT NULL,
+    card_id INTEGER NOT NULL,
+    source_id INTEGER NOT NULL,
+    PRIMARY KEY (deck_id, card_id, source_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS card_sources_source ON card_sources (source_id);
+CREATE TABLE IF NOT EXISTS source_decks (
+    source_id INTEGER NOT NULL,
+    deck_id INTEGER NOT NULL,
+    PRIMARY KEY (source_id, deck_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS source_decks_deck ON source_decks (deck_id);
+"""
+# Largest number of ? in one statement on old SQLite builds
+SQLITE_MAX_VARIABLES = 999
+
+
+class SqliteCardStore:
+    """
+    Keeps cards in a SQLite database that outlives the process.
+
+    Cards are content addressed by their card id and stored once, decks list them by position
+    so a random card is one indexed lookup, card_sources records which files contain each card
+    of a deck and source_decks which decks each file declares, even without cards. Imported files
+    are recorded with their size and mtime, and unchanged files are not imported again on the next start.
+    """
+
+    persistent = True
+
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        version, = self.db.execute('PRAGMA user_version').fetchone()
+        if version != SQLITE_SCHEMA_VERSION:
+            # Everything in here comes from the deck files, dropping it makes them be imported again
+            with self.db:
+                for table, in self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+                    self.db.execute(f'DROP TABLE "{table}"')
+            self.db.execute(f'PRAGMA user_version = {SQLITE_SCHEMA_VERSION}')
+        self.db.executescript(SQLITE_SCHEMA)
+
+    def __contains__(self, deck_name):
+        return self._deck(deck_name) is not None
+
+    def _deck(self, deck_name):
+        return self.db.execute('SELECT id, card_count FROM decks WHERE name = ?', (deck_name,)).fetchone()
+
+    def get_decks(self):
+        return [name for name, in self.db.execute('SELECT name FROM decks ORDER BY id')]
+
+    def count(self, deck_name):
+        deck = self._deck(deck_name)
+        if deck is None:
+            raise KeyError(deck_name)
+        return deck[1]
+
+    def get_card(self, deck_name, index):
+        row = self.db.execute(
+            'SELECT question, answer, comment FROM deck_cards JOIN cards ON cards.id = deck_cards.card_id'
+            ' WHERE deck_id = (SELECT id FROM decks WHERE name = ?) AND position = ?',
+            (deck_name, index),
+        ).fetchone()
+        if row is None:
+            raise IndexError(f"Card index {index} out of range for deck '{deck_name}'.")
+        return Card(*row)
+
+    def snapshot(self, deck_name):
+        """
+        Get a function iterating over the cards the deck has now, which can be called from another thread.
+        """
+        deck_id, count = self._deck(deck_name)
+        db_path = self.db_path
+
+        def read():
+            # A connection of its own, connections are bound to their thread
+            db = sqlite3.connect(db_path)
+            try:
+                rows = db.execute(
+                    'SELECT question, answer, comment FROM deck_cards JOIN cards ON cards.id = deck_cards.card_id'
+                    ' WHERE deck_id = ? AND position < ? ORDER BY position',
+                    (deck_id, count),
+                )
+                for row in rows:
+                    yield Card(*row)
+            finally:
+                db.close()
+        return read
+
+    def _existing(self, deck_id, card_ids):
+        # Ids among `card_ids` that the deck already has
+        existing = set()
+        card_ids = list(card_ids)
+        for start in range(0, len(card_ids), SQLITE_MAX_VARIABLES - 1):
+            chunk = card_ids[start:start + SQLITE_MAX_VARIABLES - 1]
+            existing.update(
+                card_id for card_id, in self.db.execute(
+                    f"SELECT card_id FROM deck_cards WHERE deck_id = ? AND card_id IN ({', '.join('?' * len(chunk))})",
+                    (deck_id, *chunk),
+                )
+            )
+        return existing
+
+    def add_cards(self, deck_name, cards, source=None):
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO decks (name) VALUES (?)', (deck_name,))
+            deck_id, card_count = self._deck(deck_name)
+            # Cards added without a file are referenced by source 0
+            source_id = 0
+            if source is not None:
+                row = self.db.execute('SELECT id FROM sources WHERE path = ?', (source,)).fetchone()
+                if row is None:
+                    # Recorded as changed until mark_source stores the real size and mtime
+                    source_id = self.db.execute(
+                        'INSERT INTO sources (path, mtime, size) VALUES (?, -1, -1)', (source,)
+                    ).lastrowid
+                else:
+                    source_id = row[0]
+                # Even a deck without cards stays until its last file is removed
+                self.db.execute(
+                    'INSERT OR IGNORE INTO source_decks (source_id, deck_id) VALUES (?, ?)', (source_id, deck_id)
+                )
+
+            # Card id -> fields, duplicates within the batch collapse here
+            batch = {}
+            for fields in cards:
+                card = Card.from_fields(fields)
+                batch.setdefault(card.card_id(), card.fields())
+            existing = self._existing(deck_id, batch)
+            new_ids = [card_id for card_id in batch if card_id not in existing]
+            self.db.executemany(
+                'INSERT OR IGNORE INTO cards (id, question, answer, comment) VALUES (?, ?, ?, ?)',
+                ((card_id, *batch[card_id]) for card_id in new_ids),
+            )
+            self.db.executemany(
+                'INSERT INTO deck_cards (deck_id, position, card_id) VALUES (?, ?, ?)',
+                ((deck_id, card_count + position, card_id) for position, card_id in enumerate(new_ids)),
+            )
+            self.db.executemany(
+                'INSERT OR IGNORE INTO card_sources (deck_id, card_id, source_id) VALUES (?, ?, ?)',
+                ((deck_id, card_id, source_id) for card_id in batch),
+            )
+            self.db.execute('UPDATE decks SET card_count = ? WHERE id = ?', (card_count + len(new_ids), deck_id))
+
+    def has_source(self, source, stat):
+        """
+        Check whether a file was imported and hasn't changed since.
+        """
+        row = self.db.execute('SELECT mtime, size FROM sources WHERE path = ?', (source,)).fetchone()
+        return row is not None and tuple(row) == (stat.st_mtime_ns, stat.st_size)
+
+    def mark_source(self, source, stat):
+        """
+        Record that a file was fully imported.
+        """
+        with self.db:
+            self.db.execute(
+                'INSERT INTO sources (path, mtime, size) VALUES (?, ?, ?)'
+                ' ON CONFLICT (path) DO UPDATE SET mtime = excluded.mtime, size = excluded.size',
+                (source, stat.st_mtime_ns, stat.st_size),
+            )
+
+    def get_sources(self):
+        return [path for path, in self.db.execute('SELECT path FROM sources')]
+
+    def remove_source(self, source):
+        """
+        Remove the references of a file, and the cards no other file references.
+        Returns the names of the decks the file had cards in.
+        """
+        with self.db:
+            row = self.db.execute('SELECT id FROM sources WHERE path = ?', (source,)).fetchone()
+            if row is None:
+                return []
+            source_id = row[0]
+            deck_ids = [
+                deck_id for deck_id, in
+                self.db.execute('SELECT deck_id FROM source_decks WHERE source_id = ?', (source_id,))
+            ]
+            # Only these cards can end up unreferenced
+            self.db.execute('CREATE TEMP TABLE IF NOT EXISTS removed_cards (card_id INTEGER PRIMARY KEY)')
+            self.db.execute('DELETE FROM temp.removed_cards')
+            self.db.execute(
+                'INSERT OR IGNORE INTO temp.removed_cards SELECT card_id FROM card_sources WHERE source_id = ?',
+                (source_id,),
+            )
+            self.db.execute('DELETE FROM card_sources WHERE source_id = ?', (source_id,))
+            self.db.execute('DELETE FROM source_decks WHERE source_id = ?', (source_id,))
+            self.db.execute('DELETE FROM sources WHERE id = ?', (source_id,))
+            for deck_id in deck_ids:
+                self.db.execute(
+                    'DELETE FROM deck_cards WHERE deck_id = ? AND NOT EXISTS ('
+                    ' SELECT 1 FROM card_sources'
+                    ' WHERE card_sources.deck_id = deck_cards.deck_id AND card_sources.card_id = deck_cards.card_id)',
+                    (deck_id,),
+                )
+                # Close the gaps so positions stay 0..count-1
+                rowids = self.db.execute(
+                    'SELECT rowid FROM deck_cards WHERE deck_id = ? ORDER BY position', (deck_id,)
+                ).fetchall()
+                self.db.executemany(
+                    'UPDATE deck_cards SET position = ? WHERE rowid = ?',
+                    ((position, rowid) for position, (rowid,) in enumerate(rowids)),
+                )
+                self.db.execute('UPDATE decks SET card_count = ? WHERE id = ?', (len(rowids), deck_id))
+            # Cards no deck lists any more
+            self.db.execute(
+                'DELETE FROM cards WHERE id IN (SELECT card_id FROM temp.removed_cards)'
+                ' AND NOT EXISTS (SELECT 1 FROM deck_cards WHERE deck_cards.card_id = cards.id)'
+            )
+            deck_names = [
+                name for name, in self.db.execute(
+                    f"SELECT name FROM decks WHERE id IN ({', '.join('?' * len(deck_ids))}) ORDER BY name", deck_ids
+                )
+            ]
+            # Decks of this file left without cards and without another file declaring them
+            self.db.executemany(
+                'DELETE FROM decks WHERE id = ? AND card_count = 0'
+                ' AND NOT EXISTS (SELECT 1 FROM source_decks WHERE source_decks.deck_id = decks.id)',
+                ((deck_id,) for deck_id in deck_ids),
+            )
+        return deck_names
+
+    def trim(self):
+        pass
+
+    def close(self):
+        self.db.close()
+
+
+CARD_STORES = {
+    'memory': lambda directory: MemoryCardStore(),
+    'mmap': MmapCardStore,
+    'sqlite': lambda directory: SqliteCardStore(os.path.join(directory or '.', 'collection.db')),
+}
+
+
+def open_store(kind, directory=None):
+    """
+    Create an empty card store of the given kind, with its files in `directory` if it needs any.
+    """
+    if kind not in CARD_STORES:
+        raise ValueError(f"Unknown card store '{kind}', expected one of: {', '.join(CARD_STORES)}")
+    return CARD_STORES[kind](directory)
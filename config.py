@@ -1,24 +1,37 @@
+import io
 import os
 import configparser
+import functools
 import platform
+import threading
 
-def get_config_path(config=True):
+# Changes made within this many seconds of each other are written to disk together
+WRITE_DELAY = 1.0
+
+
+@functools.lru_cache(maxsize=None)
+def get_config_dir():
     app_name = 'PyJi'
-    config_filename = 'config.ini'
 
     if platform.system() == 'Windows':
         config_dir = os.path.join(os.getenv('APPDATA'), app_name)
     else:
         config_dir = os.path.join(os.getenv('HOME'), '.config', app_name)
 
-    if not os.path.exists(config_dir):
-        os.makedirs(config_dir)
-
-    if not os.path.exists(os.path.join(config_dir, 'decks')):
-        os.makedirs(os.path.join(config_dir, 'decks'))
+    os.makedirs(os.path.join(config_dir, 'decks'), exist_ok=True)
+    return config_dir
 
+def get_config_path(config=True):
+    config_filename = 'config.ini'
+    config_dir = get_config_dir()
     return os.path.join(config_dir, config_filename) if config else config_dir
 
+@functools.lru_cache(maxsize=None)
+def get_cache_path():
+    cache_dir = os.path.join(get_config_dir(), 'cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
 def read_config(config_path):
     config = configparser.ConfigParser()
     if os.path.exists(config_path):
@@ -31,17 +44,133 @@ def read_config(config_path):
             'bg_color': 'darkCyan',
             'text_color': 'black'
         }
-        with open(config_path, 'w') as configfile:
-            config.write(configfile)
+        write_config(config, config_path)
     return config
 
 
-def write_config(config):
-    config_path = get_config_path()
-    with open(config_path, 'w') as configfile:
-        config.write(configfile)
+def write_config(config, config_path=None):
+    config_path = config_path or get_config_path()
+    buffer = io.StringIO()
+    config.write(buffer)
+    write_text(config_path, buffer.getvalue())
+
+def write_text(path, text):
+    # Write next to the target and rename over it, so a crash never leaves half a file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as configfile:
+        configfile.write(text)
+    os.replace(tmp_path, path)
+
+
+class ConfigService:
+    """
+    Settings kept in memory. Listeners are called with (section, key, value) on every change,
+    and changes are written to disk atomically from a timer thread once they settle for `delay` seconds.
+    """
+
+    def __init__(self, config_path, delay=WRITE_DELAY):
+        self.config_path = config_path
+        self.delay = delay
+        self.config = read_config(config_path)
+        self.listeners = []
+        # Guards the parser and the pending write
+        self.lock = threading.Lock()
+        # Keeps writes in order when a flush overlaps a timer
+        self.write_lock = threading.Lock()
+        self.dirty = False
+        self.timer = None
+
+    def get(self, section, key, fallback=None):
+        return self.config.get(section, key, fallback=fallback)
+
+    def getint(self, section, key, fallback=None):
+        return self.config.getint(section, key, fallback=fallback)
+
+    def getfloat(self, section, key, fallback=None):
+        return self.config.getfloat(section, key, fallback=fallback)
+
+    def getboolean(self, section, key, fallback=None):
+        return self.config.getboolean(section, key, fallback=fallback)
+
+    def get_section(self, section):
+        """
+        Get a copy of the keys and values of a section, empty if there is no such section.
+        """
+        with self.lock:
+            return dict(self.config.items(section, raw=True)) if self.config.has_section(section) else {}
+
+    def set(self, section, key, value):
+        self.update(section, {key: value})
+
+    def update(self, section, values):
+        """
+        Set several keys of a section at once, only the ones that change are notified and written.
+        """
+        changed = []
+        with self.lock:
+            if not self.config.has_section(section):
+                self.config.add_section(section)
+            for key, value in values.items():
+                value = str(value)
+                if self.config.get(section, key, fallback=None) != value:
+                    self.config.set(section, key, value)
+                    changed.append((key, value))
+            if changed:
+                self.dirty = True
+                self.schedule_write()
+        for key, value in changed:
+            self.notify(section, key, value)
+
+    def remove_section(self, section):
+        # Listeners aren't told, nothing watches a section that goes away
+        with self.lock:
+            if self.config.remove_section(section):
+                self.dirty = True
+                self.schedule_write()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def notify(self, section, key, value):
+        for listener in list(self.listeners):
+            listener(section, key, value)
+
+    def schedule_write(self):
+        # Called with the lock held, restarts the delay on every change
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = threading.Timer(self.delay, self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def flush(self):
+        """
+        Write pending changes to disk now.
+        """
+        with self.write_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                buffer = io.StringIO()
+                self.config.write(buffer)
+                self.dirty = False
+            try:
+                write_text(self.config_path, buffer.getvalue())
+            except OSError as e:
+                print(f"Error writing config {self.config_path}: {e}")
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        self.flush()
+
 
 def init():
     config_path = get_config_path()
-    config = read_config(config_path)
-    return config
+    return ConfigService(config_path)
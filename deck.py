@@ -1,14 +1,51 @@
+import collections
+import concurrent.futures
+import functools
+import itertools
+import multiprocessing
 import random
-import yaml
 import os
 
+# Locals
+import cache
+import cardstore
+import deckstream
+import metrics
+import search
+
+# Below this many files to parse the process pool startup costs more than it saves
+PARALLEL_MIN_FILES = 16
+
+# File extension -> parser class of deck files in that format, see deckstream.ChunkedParser
+DECK_READERS = {
+    '.yaml': deckstream.DeckParser,
+    '.tsv': functools.partial(deckstream.DelimitedParser, delimiter='\t'),
+    '.csv': functools.partial(deckstream.DelimitedParser, delimiter=','),
+    '.apkg': deckstream.AnkiParser,
+}
+
+
+def register_reader(extension, parser):
+    """
+    Read deck files with the given extension with a parser taking (stream, chunk_cards, name).
+    """
+    DECK_READERS[extension.lower()] = parser
+
+
+def deck_reader(file_path):
+    """
+    Get the parser for a deck file by its extension, files of unknown types are read as YAML.
+    """
+    return DECK_READERS.get(os.path.splitext(file_path)[1].lower(), deckstream.DeckParser)
+
 
 def read_yaml(file_path):
     """
     Read YAML data from a file.
     """
+    import yaml
     with open(file_path, 'r', encoding='utf-8') as file:
-        data = yaml.safe_load(file)
+        data = yaml.load(file, Loader=deckstream.yaml_loader())
     return data
 
 
@@ -20,74 +57,784 @@ def is_valid_deck_data(data):
     return isinstance(data, dict) and 'decks' in data and isinstance(data['decks'], list)
 
 
-def load_all_decks(directory_path):
+def stream_deck_file(file_path, cache_dir=None, chunk_cards=deckstream.CHUNK_CARDS, skipped=None):
+    """
+    Parse a deck file in any format of DECK_READERS, yielding lists of decks with the cards read
+    since the previous list, or a single list of all decks if `chunk_cards` is None. Malformed cards
+    are skipped and described in `skipped`. The chunks are written to the compiled deck cache as they
+    are read, the entry is completed once the whole file is. Raises ValueError if the file is not a list of decks.
+    """
+    metrics.count('deck.files_parsed')
+    stat = os.stat(file_path)
+    # Formats without deck names put their cards in a deck named after the file
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    writer = cache.EntryWriter(cache_dir, file_path) if cache_dir else None
+    try:
+        with open(file_path, 'rb') as file:
+            reader = deckstream.HashingReader(file)
+            parser = deck_reader(file_path)(reader, chunk_cards, name)
+            for decks in parser:
+                if writer is not None:
+                    writer.add(decks)
+                yield decks
+            digest = reader.hexdigest()
+        if skipped is not None:
+            skipped.extend(parser.skipped)
+        if writer is not None:
+            writer.finish(parser.skipped, digest, stat)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+@metrics.timed('deck.parse_file')
+def parse_deck_file(file_path, cache_dir=None):
+    """
+    Parse deck data from a deck file and store it in the compiled deck cache.
+    Descriptions of the malformed cards that were skipped are under 'skipped'.
+    """
+    skipped = []
+    decks = []
+    for chunk in stream_deck_file(file_path, cache_dir, chunk_cards=None, skipped=skipped):
+        decks.extend(chunk)
+    return {'decks': decks, 'skipped': skipped}
+
+
+def read_deck_file(file_path, cache_dir=None):
+    """
+    Read deck data from a deck file, using the compiled deck cache when it is fresh.
+    """
+    if cache_dir:
+        data = cache.load(cache_dir, file_path)
+        if data is not None:
+            metrics.count('deck_cache.hit')
+            return data
+        metrics.count('deck_cache.miss')
+    return parse_deck_file(file_path, cache_dir)
+
+
+def validate_deck_data(data):
+    """
+    Get the list of decks from parsed deck data.
+    Raises ValueError if the data is not a valid deck structure.
+    """
+    if not is_valid_deck_data(data):
+        raise ValueError("Invalid deck format")
+    for deck in data['decks']:
+        if not isinstance(deck, dict) or 'name' not in deck or not isinstance(deck.get('cards'), list):
+            raise ValueError("Invalid deck format: every deck needs a 'name' and a list of 'cards'")
+    return data['decks']
+
+
+def merge_decks(all_decks, decks, pool):
+    """
+    Merge a list of parsed decks into a dictionary of compact decks, interning strings in `pool`.
+    Cards of decks with the same name are appended to the existing deck, except for the ones it already has.
+    """
+    for deck in decks:
+        deck_name = deck['name']
+        if deck_name not in all_decks:
+            all_decks[deck_name] = cardstore.Deck()
+        all_decks[deck_name].extend(deck['cards'], pool)
+
+
+DeckLoadError = collections.namedtuple('DeckLoadError', ['file_name', 'message'])
+
+
+def file_state(stat):
+    """
+    Get what identifies a version of a file for change detection.
+    """
+    return stat.st_mtime_ns, stat.st_size
+
+
+class LoadReport:
+    """
+    Outcome of loading a directory of deck files.
+    """
+
+    def __init__(self):
+        self.loaded_files = []
+        self.removed_files = []
+        self.errors = []
+        # Malformed cards and decks that were left out of files that loaded
+        self.skipped = []
+
+    def add_error(self, file_name, message):
+        self.errors.append(DeckLoadError(file_name, message))
+
+    def add_skipped(self, file_name, message):
+        self.skipped.append(DeckLoadError(file_name, message))
+
+    def __bool__(self):
+        # True when everything loaded without errors
+        return not self.errors
+
+
+def _load_deck_file(file_path, cache_dir):
+    # Runs in worker processes, so errors are returned rather than raised
+    try:
+        data = parse_deck_file(file_path, cache_dir)
+        return validate_deck_data(data), None, data.get('skipped', [])
+    except Exception as e:
+        return None, str(e), []
+
+
+def list_deck_files(directory_path):
+    """
+    Get the deck file names in a directory, sorted so loading order is deterministic.
+    """
+    return sorted(
+        file_name for file_name in os.listdir(directory_path)
+        if os.path.splitext(file_name)[1].lower() in DECK_READERS
+    )
+
+
+def iter_deck_files(directory_path, cache_dir=None, parallel=None, max_workers=None, report=None, file_names=None,
+                    progress=None):
     """
-    Load all valid decks from YAML files in the specified directory into a dictionary.
+    Read all valid deck files in the specified directory, yielding (file_name, decks) in file name order.
+    Files missing from the cache are parsed in a process pool when `parallel` is True,
+    or automatically when there are at least PARALLEL_MIN_FILES of them if `parallel` is None.
+    Only `file_names` are read if given. Problems with individual files are added to `report`.
+    `progress` is called with (done, total) after every file.
     """
+    file_decks = []
+    for file_name, decks, last in iter_deck_chunks(
+        directory_path, cache_dir, parallel, max_workers, report, file_names, progress, chunk_cards=None
+    ):
+        if decks is None:
+            file_decks = []
+            continue
+        file_decks.extend(decks)
+        if last:
+            yield file_name, file_decks
+            file_decks = []
+
+
+def iter_deck_chunks(directory_path, cache_dir=None, parallel=None, max_workers=None, report=None, file_names=None,
+                     progress=None, chunk_cards=deckstream.CHUNK_CARDS):
+    """
+    Like iter_deck_files, but files read in this process, from the cache or parsed, are yielded as they
+    are read, in chunks of up to `chunk_cards` cards. Yields (file_name, decks, last) with `last` True on
+    the final chunk of a file.
+    A file that turns out to be broken after some of its chunks were yielded ends with a None chunk,
+    a None chunk before the last one drops the chunks of a broken cache entry before the file is parsed.
+    """
+    if file_names is None:
+        file_names = list_deck_files(directory_path)
+    paths = [os.path.join(directory_path, file_name) for file_name in file_names]
+
+    # Warm cache entries are cheap to read, only the misses need parsing
+    fresh = [bool(cache_dir) and cache.is_fresh(cache_dir, path) for path in paths]
+    missing = [path for path, is_fresh in zip(paths, fresh) if not is_fresh]
+    if parallel is None:
+        parallel = len(missing) >= PARALLEL_MIN_FILES
+
+    pool = None
+    parsed = iter(())
+    if parallel and len(missing) > 1:
+        try:
+            # Called from Qt worker threads, a forked child would inherit their locks held mid-use
+            pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')
+            )
+            parsed = pool.map(_load_deck_file, missing, itertools.repeat(cache_dir), chunksize=4)
+        except (OSError, RuntimeError) as e:
+            print(f"Parallel deck loading unavailable, loading sequentially: {e}")
+            pool = None
+
+    try:
+        for done, (file_name, path, is_fresh) in enumerate(zip(file_names, paths, fresh), 1):
+            if not is_fresh and pool is not None:
+                decks, error, skipped = next(parsed)
+                if error is None:
+                    yield file_name, decks, True
+            else:
+                skipped = []
+                error = None
+                chunks = 0
+                if is_fresh:
+                    metrics.count('deck_cache.hit')
+                    try:
+                        for decks in cache.iter_chunks(cache_dir, path, skipped):
+                            chunks += 1
+                            yield file_name, decks, False
+                    except ValueError as e:
+                        # The entry is dropped, parse the file instead
+                        print(f"{e}, reading {file_name} again")
+                        is_fresh = False
+                        skipped = []
+                        if chunks:
+                            yield file_name, None, False
+                if not is_fresh:
+                    try:
+                        for decks in stream_deck_file(path, cache_dir, chunk_cards, skipped):
+                            chunks += 1
+                            yield file_name, decks, False
+                    except Exception as e:
+                        error = str(e)
+                if chunks or error is None:
+                    # Close the file, dropping what it added if it broke part way
+                    yield file_name, (None if error else []), True
+            if progress is not None:
+                progress(done, len(file_names))
+            if report is None:
+                continue
+            if error is not None:
+                report.add_error(file_name, error)
+                continue
+            report.loaded_files.append(file_name)
+            for message in skipped:
+                report.add_skipped(file_name, message)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+
+@metrics.timed('deck.load_decks')
+def load_decks(directory_path, cache_dir=None, parallel=None, max_workers=None):
+    """
+    Load all valid decks from the deck files in the specified directory.
+    Returns a tuple of a dictionary of deck name to cardstore.Deck and a LoadReport.
+    """
+    report = LoadReport()
     all_decks = {}
+    pool = cardstore.StringPool()
+    # Merged in file name order so same-name decks always combine the same way
+    for _, decks in iter_deck_files(directory_path, cache_dir, parallel, max_workers, report):
+        merge_decks(all_decks, decks, pool)
+    for deck in all_decks.values():
+        deck.trim()
+    return all_decks, report
 
-    # Iterate through all files in the directory
-    for file_name in os.listdir(directory_path):
-        if file_name.endswith('.yaml'):  # Process only YAML files
-            file_path = os.path.join(directory_path, file_name)
-            try:
-                data = read_yaml(file_path)
-                if is_valid_deck_data(data):
-                    for deck in data['decks']:
-                        deck_name = deck['name']
-                        if deck_name not in all_decks:
-                            all_decks[deck_name] = []
-                        # Append cards to the existing deck
-                        all_decks[deck_name].extend(deck['cards'])
-                else:
-                    print(f"Invalid deck format in file: {file_name}")
-            except Exception as e:
-                print(f"Error processing file {file_name}: {e}")
 
+@metrics.timed('deck.load_all_decks')
+def load_all_decks(directory_path, cache_dir=None):
+    """
+    Load all valid decks from the deck files in the specified directory into a dictionary.
+    Parsed files are cached in `cache_dir` if given.
+    """
+    all_decks, report = load_decks(directory_path, cache_dir)
+    for error in report.errors:
+        print(f"Error processing file {error.file_name}: {error.message}")
+    for skipped in report.skipped:
+        print(f"In file {skipped.file_name}, {skipped.message}")
     return all_decks
 
 
 class Collection:
-    def __init__(self, directory_path):
+    def __init__(self, directory_path, cache_dir=None, parallel=None, store=None, load=True):
         """
-        Initialize the Collection by loading all valid decks from YAML files in the given directory.
+        Initialize the Collection by loading all valid decks from the deck files in the given directory.
+        Cards are kept in `store`, an in-memory card store by default.
+        Problems with individual files are kept in `load_report`.
+        With `load` False the collection starts empty, see plan_load for loading it in steps.
+        Card text is indexed for search when first searched, the index is kept in `cache_dir` between runs.
         """
-        self.decks = load_all_decks(directory_path)
+        self.directory_path = os.path.abspath(directory_path)
+        self.cache_dir = cache_dir
+        self.store = store if store is not None else cardstore.MemoryCardStore()
+        self.search_path = os.path.join(cache_dir, search.INDEX_FILE) if cache_dir else None
+        self.search_index = search.SearchIndex()
+        # The saved index is read by the first index build, in its thread
+        self.search_loaded = self.search_path is None
+        # Deck name -> number of changes, a deck index is only used for the version it was built from
+        self.deck_versions = collections.Counter()
+        self.load_report = LoadReport()
+        # Callbacks taking a deck name, called when cards of that deck change
+        self.listeners = []
+        # File name -> (mtime, size) of every deck file read from the directory
+        self.file_states = {}
+        # Path -> stat of files being added in chunks
+        self.partial_files = {}
+
+        if load:
+            file_names, stats = self.plan_load()
+            self.load_files(file_names, stats, parallel, self.load_report)
+
+    def plan_load(self):
+        """
+        Find the deck files that need reading. Returns their names and their stats taken before reading.
+        The files can then be parsed anywhere with iter_deck_files and handed to add_file_decks,
+        or with iter_deck_chunks and handed to add_chunk, followed by record_files once they are all done.
+        """
+        stats = self.stat_deck_files()
+        file_names = sorted(stats)
+        if self.store.persistent:
+            file_names = self.sync_persistent_store(stats)
+        return file_names, stats
+
+    def stat_deck_files(self):
+        stats = {}
+        for file_name in list_deck_files(self.directory_path):
+            try:
+                stats[file_name] = os.stat(os.path.join(self.directory_path, file_name))
+            except FileNotFoundError:
+                # Removed while listing
+                pass
+        return stats
+
+    @metrics.timed('deck.load_files')
+    def load_files(self, file_names, stats, parallel=None, report=None):
+        """
+        Read deck files from the directory, replacing whatever each of them added before.
+        """
+        # Files are added one at a time so only one parsed file is held in memory
+        for file_name, decks in iter_deck_files(
+            self.directory_path, self.cache_dir, parallel, report=report, file_names=file_names
+        ):
+            self.add_file_decks(os.path.join(self.directory_path, file_name), decks, stats[file_name])
+        self.record_files(file_names, stats)
+
+    def record_files(self, file_names, stats):
+        """
+        Remember the versions of files that were read.
+        Broken files are recorded too, so they are only retried once they change.
+        """
+        for file_name in file_names:
+            self.file_states[file_name] = file_state(stats[file_name])
+        self.store.trim()
+
+    def sync_persistent_store(self, stats):
+        """
+        Drop files that are gone from a persistent store and find the files that still need importing.
+        """
+        for source in self.store.get_sources():
+            if os.path.dirname(source) == self.directory_path and os.path.basename(source) not in stats:
+                self.remove_file(source)
+        outdated = []
+        for file_name, stat in sorted(stats.items()):
+            file_path = os.path.join(self.directory_path, file_name)
+            if self.store.has_source(file_path, stat):
+                self.load_report.loaded_files.append(file_name)
+                self.file_states[file_name] = file_state(stat)
+            else:
+                outdated.append(file_name)
+        return outdated
+
+    def refresh(self):
+        """
+        Re-read only the deck files that were added, changed or removed since they were read.
+        Returns a LoadReport of the files that were read again or removed.
+        """
+        report, file_names, stats = self.plan_refresh()
+        self.load_files(file_names, stats, report=report)
+        return report
+
+    def plan_refresh(self):
+        """
+        Remove the cards of deck files that are gone and find the files added or changed since they were read.
+        Returns a LoadReport of the removed files, the names of the files to read and their stats taken
+        before reading. The files can then be read anywhere with iter_deck_chunks and handed to add_chunk,
+        followed by record_files, like plan_load.
+        """
+        report = LoadReport()
+        stats = self.stat_deck_files()
+        for file_name in sorted(set(self.file_states) - set(stats)):
+            self.remove_file(os.path.join(self.directory_path, file_name))
+            report.removed_files.append(file_name)
+        changed = [
+            file_name for file_name, stat in sorted(stats.items())
+            if self.file_states.get(file_name) != file_state(stat)
+        ]
+        return report, changed, stats
+
+    def remove_file(self, file_path):
+        """
+        Remove all cards that were added from a deck file.
+        """
+        file_path = os.path.abspath(file_path)
+        for deck_name in self.store.remove_source(file_path):
+            self.notify(deck_name)
+        self.partial_files.pop(file_path, None)
+        if os.path.dirname(file_path) == self.directory_path:
+            self.file_states.pop(os.path.basename(file_path), None)
+
+    def add_chunk(self, file_name, decks, last, stat):
+        """
+        Add a (file name, decks, last) chunk of iter_deck_chunks read from a file of the decks directory.
+        `stat` is the file's stat taken before reading.
+        """
+        file_path = os.path.join(self.directory_path, file_name)
+        if file_path not in self.partial_files:
+            self.start_file(file_path, stat)
+        if decks is None:
+            # Broke part way through, drop what it added
+            self.remove_file(file_path)
+            return
+        self.add_file_chunk(file_path, decks)
+        if last:
+            self.finish_file(file_path)
+
+    def add_file_decks(self, file_path, decks, stat=None):
+        """
+        Add the decks parsed from a file, replacing the cards previously added from it.
+        """
+        self.start_file(file_path, stat)
+        self.add_file_chunk(file_path, decks)
+        self.finish_file(file_path)
+
+    def start_file(self, file_path, stat=None):
+        """
+        Remove the cards previously added from a file, so its new cards can be added in chunks
+        with add_file_chunk as it is read. finish_file records the file once all chunks are in.
+        """
+        file_path = os.path.abspath(file_path)
+        stat = stat or os.stat(file_path)
+        for deck_name in self.store.remove_source(file_path):
+            self.notify(deck_name)
+        self.partial_files[file_path] = stat
+
+    def add_file_chunk(self, file_path, decks):
+        self.add_decks(decks, source=os.path.abspath(file_path))
+
+    def finish_file(self, file_path):
+        file_path = os.path.abspath(file_path)
+        stat = self.partial_files.pop(file_path)
+        if self.store.persistent:
+            self.store.mark_source(file_path, stat)
+        if os.path.dirname(file_path) == self.directory_path:
+            self.file_states[os.path.basename(file_path)] = file_state(stat)
+
+    def add_decks(self, decks, source=None):
+        """
+        Add parsed decks to the collection, appending cards that are new to decks that already exist.
+        """
+        for deck in decks:
+            self.store.add_cards(deck['name'], deck['cards'], source=source)
+            self.notify(deck['name'])
+        if metrics.enabled:
+            metrics.count('deck.cards_added', sum(len(deck['cards']) for deck in decks))
+
+    def add_listener(self, callback):
+        """
+        Register a callback that gets the name of every deck whose cards change.
+        """
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def notify(self, deck_name):
+        self.deck_versions[deck_name] += 1
+        for callback in self.listeners:
+            callback(deck_name)
+
+    def count(self, deck_name):
+        """
+        Get the number of cards in a deck, 0 if there is no such deck.
+        """
+        return self.store.count(deck_name) if deck_name in self.store else 0
 
     def get_random_card(self, deck_name):
         """
-        Get a random card from the specified deck.
+        Get a random card from the specified deck as a cardstore.Card.
         """
-        if deck_name not in self.decks:
+        if deck_name not in self.store:
             raise ValueError(f"Deck '{deck_name}' not found in the collection.")
 
-        cards = self.decks[deck_name]
-        if not cards:
+        count = self.store.count(deck_name)
+        if not count:
             raise ValueError(f"No cards available in the deck '{deck_name}'.")
 
-        return random.choice(cards)
+        return self.store.get_card(deck_name, random.randrange(count))
 
     def get_decks(self):
         """
         Get a list of all available deck names.
         """
-        return list(self.decks.keys())
+        return self.store.get_decks()
+
+    def outdated_search_decks(self):
+        """
+        Get the names of the decks that have no search index for their current cards.
+        """
+        indexes = self.search_index.decks
+        return [
+            deck_name for deck_name in self.store.get_decks()
+            if deck_name not in indexes or indexes[deck_name].version != self.deck_versions[deck_name]
+        ]
+
+    def search_snapshots(self):
+        """
+        Get what search.build_deck_indexes needs to index the outdated decks in another thread:
+        their (deck name, version, read) snapshots and the path of the saved index, if not read yet.
+        """
+        snapshots = [
+            (deck_name, self.deck_versions[deck_name], self.store.snapshot(deck_name))
+            for deck_name in self.outdated_search_decks()
+        ]
+        return snapshots, None if self.search_loaded else self.search_path
+
+    def add_search_indexes(self, deck_indexes):
+        """
+        Use deck indexes built by search.build_deck_indexes, indexes of removed decks are dropped.
+        """
+        decks = self.search_index.decks
+        decks.update(deck_indexes)
+        for deck_name in [deck_name for deck_name in decks if deck_name not in self.store]:
+            del decks[deck_name]
+        self.search_index.dirty = True
+        self.search_loaded = True
+
+    @metrics.timed('search.query')
+    def search(self, query, limit=100, deck_names=None):
+        """
+        Find cards whose question, answer or comment contain every word of the query.
+        Only decks whose index is up to date are searched, see outdated_search_decks.
+        Returns up to `limit` (deck name, cardstore.Card) pairs.
+        """
+        current = set(self.store.get_decks()).difference(self.outdated_search_decks())
+        if deck_names is not None:
+            current.intersection_update(deck_names)
+        return self.search_index.search(query, self.store.get_card, limit, current)
+
+    def save_search_index(self):
+        """
+        Write the search index to the cache directory if it changed.
+        """
+        if not self.search_path or not self.search_index.dirty:
+            return
+        # Indexes of decks that changed since they were built would be thrown away on reading
+        self.search_index.decks = {
+            deck_name: deck_index for deck_name, deck_index in self.search_index.decks.items()
+            if deck_name in self.store and deck_index.version == self.deck_versions[deck_name]
+        }
+        try:
+            self.search_index.save(self.search_path)
+        except OSError as e:
+            print(f"Error writing search index {self.search_path}: {e}")
 
     def add_new_deck(self, file_path):
         """
-        Load a new deck from a YAML file and add it to the collection.
+        Load a new deck from a deck file in any format of DECK_READERS and add it to the collection.
+        Adding a file again replaces the cards it added before, a file of the decks directory
+        that didn't change since it was read is left as it is.
         """
         try:
-            data = read_yaml(file_path)
-            if is_valid_deck_data(data):
-                for deck in data['decks']:
-                    deck_name = deck['name']
-                    if deck_name not in self.decks:
-                        self.decks[deck_name] = []
-                    # Append cards to the existing deck
-                    self.decks[deck_name].extend(deck['cards'])
-                print(f"Deck '{deck_name}' successfully added.")
-            else:
-                print(f"Invalid deck format in file: {file_path}")
+            file_path = os.path.abspath(file_path)
+            stat = os.stat(file_path)
+            if (os.path.dirname(file_path) == self.directory_path
+                    and self.file_states.get(os.path.basename(file_path)) == file_state(stat)):
+                print(f"Deck file {file_path} is already up to date.")
+                return
+            decks = validate_deck_data(read_deck_file(file_path, self.cache_dir))
+            self.add_file_decks(file_path, decks, stat)
+            self.store.trim()
+            for deck in decks:
+                print(f"Deck '{deck['name']}' successfully added.")
         except Exception as e:
             print(f"Error processing file {file_path}: {e}")
+
+    def close(self):
+        """
+        Save the search index and release the resources held by the card store.
+        """
+        self.save_search_index()
+        self.store.close()
+
+
+class FenwickTree:
+    """
+    Binary indexed tree over a growable list of non-negative weights.
+    Updating a weight, appending one and sampling are all O(log n).
+    """
+
+    def __init__(self, weights=()):
+        self.weights = []
+        # 1-based, tree[i] holds the sum of weights in (i - lowbit(i), i]
+        self.tree = [0.0]
+        self.total = 0.0
+        for weight in weights:
+            self.append(weight)
+
+    def __len__(self):
+        return len(self.weights)
+
+    def prefix_sum(self, count):
+        """
+        Sum of the first `count` weights.
+        """
+        result = 0.0
+        while count > 0:
+            result += self.tree[count]
+            count -= count & -count
+        return result
+
+    def append(self, weight):
+        index = len(self.weights) + 1
+        lowbit = index & -index
+        self.weights.append(weight)
+        self.tree.append(weight + self.prefix_sum(index - 1) - self.prefix_sum(index - lowbit))
+        self.total += weight
+        return index - 1
+
+    def update(self, position, weight):
+        delta = weight - self.weights[position]
+        if not delta:
+            return
+        self.weights[position] = weight
+        self.total += delta
+        index = position + 1
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    def find(self, value):
+        """
+        Get the position of the weight that covers `value` in [0, total).
+        """
+        position = 0
+        remaining = value
+        step = 1 << (len(self.tree) - 1).bit_length()
+        while step:
+            index = position + step
+            if index < len(self.tree) and self.tree[index] <= remaining:
+                position = index
+                remaining -= self.tree[index]
+            step >>= 1
+        # Float error may land on the end or on a zero weight, fall back to the nearest real weight
+        position = min(position, len(self.weights) - 1)
+        if not self.weights[position]:
+            for candidate in itertools.chain(range(position - 1, -1, -1), range(position + 1, len(self.weights))):
+                if self.weights[candidate]:
+                    return candidate
+        return position
+
+    def sample(self):
+        """
+        Get a random position with probability proportional to its weight, None if all weights are 0.
+        """
+        if self.total <= 0:
+            return None
+        return self.find(random.random() * self.total)
+
+
+SAMPLING_MODES = ('card', 'deck')
+
+
+class WeightedSampler:
+    """
+    Picks random cards across the selected decks of a collection.
+
+    In 'card' mode every card of the selected decks is equally likely, in 'deck' mode
+    every selected deck is. Custom deck weights and per-card weights override that.
+    The sampler follows deck changes of the collection and selection changes incrementally.
+    """
+
+    def __init__(self, collection, mode='card', selected_decks=()):
+        if mode not in SAMPLING_MODES:
+            raise ValueError(f"Unknown sampling mode '{mode}', expected one of: {', '.join(SAMPLING_MODES)}")
+        self.collection = collection
+        self.mode = mode
+        self.decks = FenwickTree()
+        self.deck_names = []
+        self.positions = {}
+        self.selected = set()
+        self.deck_weights = {}
+        # Deck name -> FenwickTree over its cards, only for decks with per-card weights
+        self.card_weights = {}
+        self.select(selected_decks)
+        collection.add_listener(self.refresh_deck)
+
+    def close(self):
+        self.collection.remove_listener(self.refresh_deck)
+
+    def deck_weight(self, deck_name):
+        # Decks removed from the collection count 0 cards
+        count = self.collection.count(deck_name)
+        if deck_name not in self.selected or not count:
+            return 0.0
+        if deck_name in self.deck_weights:
+            return self.deck_weights[deck_name]
+        if deck_name in self.card_weights:
+            card_total = self.card_weights[deck_name].total
+        else:
+            card_total = float(count)
+        if self.mode == 'deck':
+            return 1.0 if card_total > 0 else 0.0
+        return card_total
+
+    def refresh_deck(self, deck_name):
+        """
+        Recompute the weight of one deck, e.g. after cards were added to it.
+        """
+        count = self.collection.count(deck_name)
+        trees = self.card_weights.get(deck_name)
+        if trees is not None:
+            if len(trees) > count:
+                # Cards were removed and the rest renumbered, the weights no longer line up with them
+                del self.card_weights[deck_name]
+            else:
+                # New cards get the default weight
+                for _ in range(len(trees), count):
+                    trees.append(1.0)
+        weight = self.deck_weight(deck_name)
+        if deck_name in self.positions:
+            self.decks.update(self.positions[deck_name], weight)
+        elif weight:
+            self.positions[deck_name] = self.decks.append(weight)
+            self.deck_names.append(deck_name)
+
+    def select(self, deck_names):
+        """
+        Set the selected decks, only decks whose selection changed are updated.
+        Names of decks that are not in the collection are kept and picked up once they appear.
+        """
+        deck_names = set(deck_names)
+        changed = self.selected.symmetric_difference(deck_names)
+        self.selected = deck_names
+        for deck_name in changed:
+            self.refresh_deck(deck_name)
+
+    def set_deck_selected(self, deck_name, selected):
+        if selected:
+            self.selected.add(deck_name)
+        else:
+            self.selected.discard(deck_name)
+        self.refresh_deck(deck_name)
+
+    def set_mode(self, mode):
+        if mode not in SAMPLING_MODES:
+            raise ValueError(f"Unknown sampling mode '{mode}', expected one of: {', '.join(SAMPLING_MODES)}")
+        self.mode = mode
+        for deck_name in self.deck_names:
+            self.refresh_deck(deck_name)
+
+    def set_deck_weight(self, deck_name, weight):
+        """
+        Set a custom weight for a deck, None to go back to the weight given by the mode.
+        """
+        if weight is None:
+            self.deck_weights.pop(deck_name, None)
+        else:
+            self.deck_weights[deck_name] = float(weight)
+        self.refresh_deck(deck_name)
+
+    def set_card_weight(self, deck_name, index, weight):
+        """
+        Set a custom weight for one card of a deck, all other cards default to 1.
+        """
+        if deck_name not in self.card_weights:
+            self.card_weights[deck_name] = FenwickTree([1.0] * self.collection.count(deck_name))
+        self.card_weights[deck_name].update(index, float(weight))
+        self.refresh_deck(deck_name)
+
+    def sample(self):
+        """
+        Get a random (deck name, card) pair from the selected decks, None if there is nothing to pick.
+        """
+        position = self.decks.sample()
+        if position is None:
+            return None
+        deck_name = self.deck_names[position]
+        count = self.collection.count(deck_name)
+        if deck_name in self.card_weights:
+            index = self.card_weights[deck_name].sample()
+        else:
+            index = random.randrange(count) if count else None
+        if index is None:
+            return None
+        return deck_name, self.collection.store.get_card(deck_name, index)
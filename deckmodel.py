@@ -0,0 +1,113 @@
+from PySide6.QtCore import QAbstractTableModel, QModelIndex, QSortFilterProxyModel, Qt
+
+NAME_COLUMN = 0
+COUNT_COLUMN = 1
+
+
+class DeckTableModel(QAbstractTableModel):
+    """
+    Checkable list of deck names, with a card count column if `count` is given.
+
+    Only the names and the set of checked names are stored, the views ask for the rows
+    they show, so a long list costs no widgets. Counts are asked from `count` on first
+    display and kept until the deck changes.
+    """
+
+    def __init__(self, deck_names=(), checked=(), count=None, parent=None):
+        super().__init__(parent)
+        self.deck_names = list(deck_names)
+        self.rows = {deck_name: row for row, deck_name in enumerate(self.deck_names)}
+        self.checked = set(checked)
+        self.count = count
+        self.counts = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.deck_names)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else (2 if self.count is not None else 1)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return "Deck Name" if section == NAME_COLUMN else "Cards"
+        return None
+
+    def flags(self, index):
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if index.column() == NAME_COLUMN:
+            flags |= Qt.ItemIsUserCheckable
+        return flags
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        deck_name = self.deck_names[index.row()]
+        if index.column() == NAME_COLUMN:
+            if role == Qt.DisplayRole:
+                return deck_name
+            if role == Qt.CheckStateRole:
+                return Qt.Checked if deck_name in self.checked else Qt.Unchecked
+        elif role == Qt.DisplayRole:
+            if deck_name not in self.counts:
+                self.counts[deck_name] = self.count(deck_name)
+            return self.counts[deck_name]
+        elif role == Qt.TextAlignmentRole:
+            return int(Qt.AlignRight | Qt.AlignVCenter)
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid() or index.column() != NAME_COLUMN or role != Qt.CheckStateRole:
+            return False
+        deck_name = self.deck_names[index.row()]
+        # Views pass the state as an int
+        if Qt.CheckState(value) == Qt.Checked:
+            self.checked.add(deck_name)
+        else:
+            self.checked.discard(deck_name)
+        self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+        return True
+
+    def set_decks(self, deck_names):
+        """
+        Replace the listed decks, checked names stay checked.
+        """
+        self.beginResetModel()
+        self.deck_names = list(deck_names)
+        self.rows = {deck_name: row for row, deck_name in enumerate(self.deck_names)}
+        self.counts.clear()
+        self.endResetModel()
+
+    def set_checked(self, deck_names):
+        self.checked = set(deck_names)
+        if self.deck_names:
+            self.dataChanged.emit(
+                self.index(0, NAME_COLUMN), self.index(len(self.deck_names) - 1, NAME_COLUMN), [Qt.CheckStateRole]
+            )
+
+    def refresh_deck(self, deck_name):
+        """
+        Forget the card count of a deck so it is asked again.
+        """
+        self.counts.pop(deck_name, None)
+        row = self.rows.get(deck_name)
+        if row is not None and self.count is not None:
+            index = self.index(row, COUNT_COLUMN)
+            self.dataChanged.emit(index, index, [Qt.DisplayRole])
+
+    def selected_decks(self):
+        """
+        Get the checked deck names that are listed, in list order.
+        """
+        return [deck_name for deck_name in self.deck_names if deck_name in self.checked]
+
+
+def make_proxy(model, parent=None):
+    """
+    Wrap a DeckTableModel for sorting and for filtering by deck name, ignoring case.
+    """
+    proxy = QSortFilterProxyModel(parent)
+    proxy.setSourceModel(model)
+    proxy.setFilterKeyColumn(NAME_COLUMN)
+    proxy.setFilterCaseSensitivity(Qt.CaseInsensitive)
+    proxy.setSortCaseSensitivity(Qt.CaseInsensitive)
+    return proxy
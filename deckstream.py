@@ -0,0 +1,440 @@
+import functools
+import hashlib
+import html
+import io
+import itertools
+import json
+import os
+import re
+import shutil
+import tempfile
+
+# Cards handed out per chunk while a file is read
+CHUNK_CARDS = 1000
+
+
+@functools.lru_cache(maxsize=None)
+def yaml_loader():
+    """
+    Get the YAML loader class. yaml is imported on first use, decks served from the cache don't need it.
+    """
+    import yaml
+    # Prefer the libyaml based loader, it is several times faster than the pure Python one
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class HashingReader:
+    """
+    File wrapper that computes the SHA-256 digest of everything read through it.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.digest.update(data)
+        return data
+
+    # Enough of the file interface to be wrapped in io.TextIOWrapper
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def seekable(self):
+        return False
+
+    @property
+    def closed(self):
+        return self.file.closed
+
+    def flush(self):
+        pass
+
+    def hexdigest(self):
+        # Include whatever the parser didn't need to read
+        while self.read(1 << 16):
+            pass
+        return self.digest.hexdigest()
+
+
+def card_problem(card):
+    """
+    Get why a parsed card can't be used, None if it is fine.
+    """
+    if not isinstance(card, list):
+        return "a card must be a list of fields"
+    if not card or card[0] is None or card[0] == '':
+        return "a card needs a question"
+    if any(isinstance(field, (list, dict)) for field in card[:3]):
+        return "card fields must be text"
+    return None
+
+
+class ChunkedParser:
+    """
+    Base of the deck file parsers. Iterating a parser yields lists of {'name', 'cards'} decks
+    holding the cards read since the previous chunk, `chunk_cards` at a time, or all decks at
+    once at the end if it is None. Every deck read so far is in `decks`, with its cards only in
+    the second case, so reading in chunks keeps no more than a chunk of cards. The last chunk
+    lists every deck, those without cards too. Malformed cards are skipped and described in
+    `skipped`. `name` is the deck of cards whose file doesn't say.
+    """
+
+    def __init__(self, stream, chunk_cards=CHUNK_CARDS, name=None):
+        self.stream = stream
+        self.chunk_cards = chunk_cards
+        self.name = name
+        self.decks = []
+        self.skipped = []
+        self.chunk = []
+        self.chunk_size = 0
+
+    def add_card(self, deck, card):
+        """
+        Add a card to a deck, returning the chunk it completes if any.
+        """
+        if self.chunk_cards is None:
+            deck['cards'].append(card)
+            return None
+        if not self.chunk or self.chunk[-1]['deck'] is not deck:
+            self.chunk.append({'name': deck['name'], 'cards': [], 'deck': deck})
+        self.chunk[-1]['cards'].append(card)
+        self.chunk_size += 1
+        if self.chunk_size >= self.chunk_cards:
+            return self.take_chunk()
+        return None
+
+    def take_chunk(self):
+        chunk = [{'name': entry['name'], 'cards': entry['cards']} for entry in self.chunk]
+        self.chunk = []
+        self.chunk_size = 0
+        return chunk
+
+    def finish(self):
+        """
+        Yield what is left once the whole file is read.
+        """
+        if self.chunk_cards is None:
+            yield self.decks
+        else:
+            yield self.take_chunk() + [{'name': deck['name'], 'cards': []} for deck in self.decks]
+
+    def skip(self, where, problem):
+        self.skipped.append(f"{where}: {problem}, skipped")
+
+
+class DeckParser(ChunkedParser):
+    """
+    Reads a YAML deck file event by event, building one card at a time.
+    Only the YAML nodes of the card being read are kept, not the tree of the whole document.
+    A file that isn't a mapping with a list of decks raises ValueError.
+    """
+
+    def __init__(self, stream, chunk_cards=CHUNK_CARDS, name=None):
+        super().__init__(stream, chunk_cards, name)
+        self.loader = yaml_loader()(stream)
+        self.anchors = {}
+
+    def __iter__(self):
+        import yaml
+        loader = self.loader
+        try:
+            loader.get_event()
+            if loader.check_event(yaml.StreamEndEvent):
+                raise ValueError("Invalid deck format")
+            loader.get_event()
+            if not loader.check_event(yaml.MappingStartEvent):
+                raise ValueError("Invalid deck format")
+            loader.get_event()
+            found = False
+            while not loader.check_event(yaml.MappingEndEvent):
+                key = self.construct(self.compose())
+                if key == 'decks' and loader.check_event(yaml.SequenceStartEvent):
+                    found = True
+                    loader.get_event()
+                    while not loader.check_event(yaml.SequenceEndEvent):
+                        yield from self.read_deck()
+                    loader.get_event()
+                else:
+                    self.compose()
+            if not found:
+                raise ValueError("Invalid deck format")
+            yield from self.finish()
+        finally:
+            loader.dispose()
+
+    def read_deck(self):
+        import yaml
+        loader = self.loader
+        mark = loader.peek_event().start_mark
+        if not loader.check_event(yaml.MappingStartEvent):
+            self.compose()
+            self.skip_at(mark, "a deck must be a mapping with a 'name' and 'cards'")
+            return
+        loader.get_event()
+        deck = None
+        # Cards listed before the name wait for it
+        waiting = []
+        has_cards = False
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = self.construct(self.compose())
+            if key == 'name' and deck is None:
+                name = self.construct(self.compose())
+                if name is None or isinstance(name, (list, dict)):
+                    continue
+                deck = {'name': name, 'cards': []}
+                for card in waiting:
+                    chunk = self.add_card(deck, card)
+                    if chunk:
+                        yield chunk
+                waiting = []
+            elif key == 'cards' and loader.check_event(yaml.SequenceStartEvent):
+                has_cards = True
+                loader.get_event()
+                while not loader.check_event(yaml.SequenceEndEvent):
+                    card_mark = loader.peek_event().start_mark
+                    card = self.construct(self.compose())
+                    problem = card_problem(card)
+                    if problem:
+                        self.skip_at(card_mark, problem)
+                    elif deck is None:
+                        waiting.append(card)
+                    else:
+                        chunk = self.add_card(deck, card)
+                        if chunk:
+                            yield chunk
+                loader.get_event()
+            else:
+                self.compose()
+        loader.get_event()
+        if deck is None:
+            self.skip_at(mark, "a deck needs a 'name'")
+        elif not has_cards:
+            self.skip_at(mark, f"deck '{deck['name']}' needs a list of 'cards'")
+        else:
+            self.decks.append(deck)
+
+    def skip_at(self, mark, problem):
+        self.skip(f"line {mark.line + 1}", problem)
+
+    def compose(self):
+        """
+        Build the node of the value starting at the next event, like yaml's composer does for a whole document.
+        """
+        import yaml
+        loader = self.loader
+        event = loader.get_event()
+        if isinstance(event, yaml.AliasEvent):
+            if event.anchor not in self.anchors:
+                raise yaml.composer.ComposerError(
+                    None, None, f"found undefined alias {event.anchor!r}", event.start_mark
+                )
+            return self.anchors[event.anchor]
+        if isinstance(event, yaml.ScalarEvent):
+            tag = event.tag
+            if tag is None or tag == '!':
+                tag = loader.resolve(yaml.ScalarNode, event.value, event.implicit)
+            node = yaml.ScalarNode(tag, event.value, event.start_mark, event.end_mark, style=event.style)
+        elif isinstance(event, yaml.SequenceStartEvent):
+            tag = event.tag
+            if tag is None or tag == '!':
+                tag = loader.resolve(yaml.SequenceNode, None, event.implicit)
+            node = yaml.SequenceNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+            if event.anchor is not None:
+                self.anchors[event.anchor] = node
+            while not loader.check_event(yaml.SequenceEndEvent):
+                node.value.append(self.compose())
+            node.end_mark = loader.get_event().end_mark
+        elif isinstance(event, yaml.MappingStartEvent):
+            tag = event.tag
+            if tag is None or tag == '!':
+                tag = loader.resolve(yaml.MappingNode, None, event.implicit)
+            node = yaml.MappingNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+            if event.anchor is not None:
+                self.anchors[event.anchor] = node
+            while not loader.check_event(yaml.MappingEndEvent):
+                key = self.compose()
+                node.value.append((key, self.compose()))
+            node.end_mark = loader.get_event().end_mark
+        else:
+            raise yaml.composer.ComposerError(None, None, f"unexpected {event.__class__.__name__}", event.start_mark)
+        if event.anchor is not None:
+            self.anchors[event.anchor] = node
+        return node
+
+    def construct(self, node):
+        value = self.loader.construct_object(node, deep=True)
+        # Nothing refers back to earlier values, so the constructor needn't remember them
+        self.loader.constructed_objects.clear()
+        return value
+
+
+# Leading `#key:value` lines of Anki's plain text export
+HEADER_RE = re.compile(r'#([^:\r\n]+):(.*)')
+SEPARATORS = {'tab': '\t', 'comma': ',', 'semicolon': ';', 'pipe': '|', 'space': ' '}
+BREAK_RE = re.compile(r'<br\s*/?>|</(?:div|p|li)>', re.IGNORECASE)
+TAG_RE = re.compile(r'<[^>]*>')
+# {{c1::text::hint}} -> text
+CLOZE_RE = re.compile(r'\{\{c\d+::(.*?)(?:::[^}]*)?\}\}', re.DOTALL)
+SOUND_RE = re.compile(r'\[sound:[^\]]*\]')
+
+
+def strip_markup(text):
+    """
+    Get the plain text of an Anki field: line breaks kept, tags, sounds and cloze markers dropped.
+    """
+    if '<' in text:
+        text = TAG_RE.sub('', BREAK_RE.sub('\n', text))
+    if '{{' in text:
+        text = CLOZE_RE.sub(r'\1', text)
+    if '[sound:' in text:
+        text = SOUND_RE.sub('', text)
+    if '&' in text:
+        text = html.unescape(text).replace('\xa0', ' ')
+    return text.strip()
+
+
+class DelimitedParser(ChunkedParser):
+    """
+    Reads a TSV or CSV deck file row by row with the csv module, every row a card of
+    question, answer and comment. Cards go to the deck `name` unless the file starts with
+    header lines like the ones Anki exports: `#deck:<name>` names the deck, `#deck column:<n>`
+    takes it from the n-th column, `#separator:<name>` changes the delimiter and `#html:true`
+    strips markup from the fields. Other `... column:<n>` headers, like Anki's notetype and
+    tags, name columns that are left out.
+    """
+
+    def __init__(self, stream, chunk_cards=CHUNK_CARDS, name=None, delimiter='\t'):
+        super().__init__(stream, chunk_cards, name)
+        self.delimiter = delimiter
+
+    def __iter__(self):
+        import csv
+        text = io.TextIOWrapper(self.stream, encoding='utf-8-sig', newline='')
+        try:
+            options = {}
+            first = None
+            for line in text:
+                match = HEADER_RE.match(line)
+                if not match:
+                    first = line
+                    break
+                options[match.group(1).strip().lower()] = match.group(2).strip()
+            header_lines = len(options)
+            delimiter = options.get('separator', self.delimiter)
+            delimiter = SEPARATORS.get(delimiter.lower(), delimiter)
+            strip = options.get('html', '').lower() == 'true'
+            default_deck = deck_name = options.get('deck', self.name)
+            columns = {
+                key: int(value) - 1 for key, value in options.items()
+                if key.endswith(' column') and value.isdigit() and int(value) > 0
+            }
+            deck_column = columns.get('deck column')
+            ignored = set(columns.values())
+
+            rows = csv.reader(itertools.chain([first] if first is not None else [], text), delimiter=delimiter)
+            decks = {}
+            deck = None
+            line_num = 0
+            for row in rows:
+                start = header_lines + line_num + 1
+                line_num = rows.line_num
+                if deck_column is not None:
+                    if deck_column >= len(row):
+                        if any(row):
+                            self.skip(f"line {start}", "the row has no deck column")
+                        continue
+                    deck_name = row[deck_column] or default_deck
+                card = [field for index, field in enumerate(row) if index not in ignored] if ignored else row
+                # Only the fields the cards use are kept
+                if len(card) > 3:
+                    card = card[:3]
+                if strip:
+                    card = [strip_markup(field) for field in card]
+                if not card or not card[0]:
+                    if any(row):
+                        self.skip(f"line {start}", "a card needs a question")
+                    continue
+                if deck is None or deck['name'] != deck_name:
+                    deck = decks.get(deck_name)
+                    if deck is None:
+                        deck = decks[deck_name] = {'name': deck_name, 'cards': []}
+                        self.decks.append(deck)
+                chunk = self.add_card(deck, card)
+                if chunk:
+                    yield chunk
+            yield from self.finish()
+        finally:
+            # Leave the file open for the caller
+            text.detach()
+
+
+# Newest first. collection.anki21b alone is compressed with zstd, which isn't supported
+ANKI_COLLECTIONS = ('collection.anki21', 'collection.anki2')
+ANKI_NOTES_QUERY = (
+    "SELECT notes.id, notes.flds, cards.did, MIN(cards.ord) FROM notes JOIN cards ON cards.nid = notes.id "
+    "GROUP BY notes.id ORDER BY notes.id"
+)
+
+
+class AnkiParser(ChunkedParser):
+    """
+    Reads an Anki package (.apkg), a zip holding the collection as an SQLite database.
+    Every note is a card of the deck its first card is in, its first three fields giving the
+    question, answer and comment without markup. Scheduling data and media are left out.
+    Zip and SQLite need random access, so the package is copied to a temporary directory.
+    """
+
+    def __iter__(self):
+        import sqlite3
+        import zipfile
+        with tempfile.TemporaryDirectory() as directory:
+            package_path = os.path.join(directory, 'package.apkg')
+            with open(package_path, 'wb') as file:
+                shutil.copyfileobj(self.stream, file, 1 << 20)
+            with zipfile.ZipFile(package_path) as package:
+                names = set(package.namelist())
+                if 'collection.anki21b' in names and 'collection.anki21' not in names:
+                    raise ValueError("Anki package needs to be exported with 'Support older Anki versions'")
+                member = next((name for name in ANKI_COLLECTIONS if name in names), None)
+                if member is None:
+                    raise ValueError("Not an Anki package")
+                collection_path = package.extract(member, directory)
+            os.remove(package_path)
+
+            connection = sqlite3.connect(collection_path)
+            try:
+                deck_names = self.read_deck_names(connection)
+                decks = {}
+                for note_id, fields, deck_id, _ in connection.execute(ANKI_NOTES_QUERY):
+                    card = [strip_markup(field) for field in fields.split('\x1f')[:3]]
+                    if not card[0]:
+                        self.skip(f"note {note_id}", "a card needs a question")
+                        continue
+                    deck = decks.get(deck_id)
+                    if deck is None:
+                        deck = decks[deck_id] = {'name': deck_names.get(deck_id, self.name), 'cards': []}
+                        self.decks.append(deck)
+                    chunk = self.add_card(deck, card)
+                    if chunk:
+                        yield chunk
+            finally:
+                connection.close()
+        yield from self.finish()
+
+    @staticmethod
+    def read_deck_names(connection):
+        """
+        Get deck id -> name. Collections since Anki 2.1.28 have a decks table, older ones a JSON column.
+        """
+        tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if 'decks' in tables:
+            # Levels of nested decks are separated by \x1f in the table and by :: everywhere else
+            rows = connection.execute("SELECT id, name FROM decks")
+            return {deck_id: name.replace('\x1f', '::') for deck_id, name in rows}
+        row = connection.execute("SELECT decks FROM col").fetchone()
+        return {int(deck_id): deck['name'] for deck_id, deck in json.loads(row[0]).items()} if row else {}
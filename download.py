@@ -0,0 +1,421 @@
+import collections
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Locals
+import config as conf
+
+REPO_URL = "https://raw.githubusercontent.com/house-of-vanity/pyji/master/decs"
+# Connect and read timeouts in seconds
+TIMEOUT = (5, 30)
+MAX_WORKERS = 4
+# Don't ask the server for the repository index again within this many seconds
+INDEX_TTL = 10 * 60
+HTTP_CACHE_FILE = 'http_cache.json'
+INDEX_CACHE_FILE = 'repo.yaml'
+# Path -> [mtime, size, sha256] of downloaded decks, so unchanged files aren't hashed on every sync
+DIGEST_CACHE_FILE = 'deck_digests.json'
+# Unfinished downloads are kept here to be resumed
+PARTIAL_DIR = 'downloads'
+DOWNLOAD_CHUNK = 1 << 16
+
+DownloadResult = collections.namedtuple('DownloadResult', ['deck_name', 'file_path', 'changed', 'error'])
+
+
+class DownloadManager:
+    """
+    Downloads the online repository index and decks over one pooled session.
+
+    Decks are fetched concurrently with bounded parallelism. When the repository index has a
+    manifest of deck hashes, only decks whose local copy differs are downloaded, compressed if
+    the repository has a gzip copy, resuming unfinished downloads and checking the hash before
+    the local file is replaced. Without a manifest every request is conditional on the ETag and
+    Last-Modified the server sent last time, so unchanged decks cost a 304.
+    The repository index is kept in `cache_dir` and served from there when offline.
+    """
+
+    def __init__(self, cache_dir, base_url=REPO_URL, max_workers=MAX_WORKERS, timeout=TIMEOUT):
+        # requests takes a while to import and is only needed once the user goes online
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.cache_dir = cache_dir
+        self.base_url = base_url.rstrip('/')
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=2)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.http_cache_path = os.path.join(cache_dir, HTTP_CACHE_FILE)
+        self.http_cache = read_json(self.http_cache_path)
+        self.digest_cache_path = os.path.join(cache_dir, DIGEST_CACHE_FILE)
+        self.digests = read_json(self.digest_cache_path)
+        self.partial_dir = os.path.join(cache_dir, PARTIAL_DIR)
+        self.index = None
+        # Deck name -> manifest entry, empty if the repository has no manifest
+        self.manifest = {}
+        self.index_time = 0.0
+
+    def write_http_cache(self):
+        with self.lock:
+            http_cache = json.dumps(self.http_cache)
+            digests = json.dumps(self.digests)
+        write_file(self.http_cache_path, http_cache.encode('utf-8'))
+        write_file(self.digest_cache_path, digests.encode('utf-8'))
+
+    def conditional_get(self, url, local_path):
+        """
+        GET a URL, sending the validators of the last response if `local_path` still holds it.
+        Returns the response, whose status is 304 if the local copy is current.
+        """
+        headers = {}
+        with self.lock:
+            validators = self.http_cache.get(url, {})
+        if os.path.exists(local_path):
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+        if response.status_code == 304:
+            return response
+        response.raise_for_status()
+        with self.lock:
+            self.http_cache[url] = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+        return response
+
+    def fetch_repository(self, force=False):
+        """
+        Get the list of deck names in the online repository, and its manifest into `manifest`.
+        """
+        import requests
+        import yaml
+
+        if not force and self.index is not None and time.monotonic() - self.index_time < INDEX_TTL:
+            return self.index
+
+        index_path = os.path.join(self.cache_dir, INDEX_CACHE_FILE)
+        try:
+            response = self.conditional_get(f"{self.base_url}/{INDEX_CACHE_FILE}", index_path)
+            if response.status_code != 304:
+                write_file(index_path, response.content)
+                self.write_http_cache()
+        except requests.RequestException:
+            # Offline, fall back to the last index we got
+            if not os.path.exists(index_path):
+                raise
+        with open(index_path, 'rb') as file:
+            data = yaml.safe_load(file) or {}
+        self.manifest = data.get('manifest') or {}
+        self.index = data.get('decks') or list(self.manifest)
+        self.index_time = time.monotonic()
+        return self.index
+
+    def installed_decks(self, decks_path):
+        """
+        Get the names of the repository decks that have a local copy in `decks_path`.
+        """
+        return [
+            deck_name for deck_name in self.index or []
+            if os.path.exists(os.path.join(decks_path, deck_file_name(deck_name, self.manifest.get(deck_name))))
+        ]
+
+    def local_digest(self, file_path):
+        """
+        Get the SHA-256 of a local file, None if there is none. Hashes are remembered until the file changes.
+        """
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+        key = os.path.abspath(file_path)
+        with self.lock:
+            entry = self.digests.get(key)
+        if entry and entry[:2] == [stat.st_mtime_ns, stat.st_size]:
+            return entry[2]
+        digest = file_digest(file_path)
+        with self.lock:
+            self.digests[key] = [stat.st_mtime_ns, stat.st_size, digest]
+        return digest
+
+    def download_deck(self, deck_name, decks_path):
+        entry = self.manifest.get(deck_name)
+        if entry:
+            return self.sync_deck(deck_name, entry, decks_path)
+        file_path = os.path.join(decks_path, f"{deck_name}.yaml")
+        try:
+            response = self.conditional_get(f"{self.base_url}/{deck_name}.yaml", file_path)
+            if response.status_code == 304:
+                return DownloadResult(deck_name, file_path, False, None)
+            write_file(file_path, response.content)
+            return DownloadResult(deck_name, file_path, True, None)
+        except Exception as e:
+            return DownloadResult(deck_name, file_path, False, str(e))
+
+    def sync_deck(self, deck_name, entry, decks_path):
+        """
+        Bring the local copy of a deck in line with its manifest entry, downloading it only if the hashes differ.
+        """
+        file_path = os.path.join(decks_path, deck_file_name(deck_name, entry))
+        try:
+            if self.local_digest(file_path) == entry['sha256']:
+                return DownloadResult(deck_name, file_path, False, None)
+            compressed = bool(entry.get('gzip'))
+            remote_name = os.path.basename(entry['gzip']) if compressed else os.path.basename(file_path)
+            part_path = self.resume_download(
+                f"{self.base_url}/{remote_name}",
+                self.partial_path(deck_name, entry['sha256'], remote_name),
+                entry.get('gzip_size') if compressed else entry.get('size'),
+            )
+            install_download(part_path, file_path, entry['sha256'], entry.get('size'), compressed)
+            self.local_digest(file_path)
+            return DownloadResult(deck_name, file_path, True, None)
+        except Exception as e:
+            return DownloadResult(deck_name, file_path, False, str(e))
+
+    def partial_path(self, deck_name, sha256, remote_name):
+        """
+        Get where an unfinished download of a deck version is kept, dropping the ones of other versions.
+        """
+        os.makedirs(self.partial_dir, exist_ok=True)
+        prefix = f"{deck_name}-"
+        part_name = f"{prefix}{sha256[:16]}-{remote_name}.part"
+        for name in os.listdir(self.partial_dir):
+            if name.startswith(prefix) and name != part_name:
+                try:
+                    os.remove(os.path.join(self.partial_dir, name))
+                except OSError:
+                    pass
+        return os.path.join(self.partial_dir, part_name)
+
+    def resume_download(self, url, part_path, size=None):
+        """
+        Download a URL into `part_path`, asking only for the bytes after the ones it already holds.
+        Servers that ignore the range send the whole file, which then replaces the partial one.
+        """
+        for _ in range(2):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if size is not None and offset >= size:
+                if offset == size:
+                    return part_path
+                os.remove(part_path)
+                offset = 0
+            # Ranges are counted in the bytes as stored, so the server mustn't encode them again
+            headers = {'Accept-Encoding': 'identity'}
+            if offset:
+                headers['Range'] = f"bytes={offset}-"
+            with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+                if response.status_code == 416:
+                    # The partial file is longer than the remote one, start over
+                    os.remove(part_path)
+                    continue
+                response.raise_for_status()
+                resumed = response.status_code == 206 and response.headers.get('Content-Range', '').startswith(
+                    f"bytes {offset}-"
+                )
+                with open(part_path, 'ab' if resumed else 'wb') as file:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK):
+                        file.write(chunk)
+            return part_path
+        raise ValueError(f"Could not resume the download of {url}")
+
+    def download_decks(self, deck_names, decks_path, progress=None, cancelled=None):
+        """
+        Download decks into `decks_path` concurrently.
+        `progress` is called with (done, total) after every deck. Once `cancelled()` returns True
+        no more downloads are started.
+        Returns a DownloadResult per finished deck in the order of `deck_names`.
+        """
+        os.makedirs(decks_path, exist_ok=True)
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {pool.submit(self.download_deck, deck_name, decks_path): deck_name for deck_name in deck_names}
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = future.result()
+                if progress is not None:
+                    progress(len(results), len(deck_names))
+                if cancelled is not None and cancelled():
+                    for pending in futures:
+                        pending.cancel()
+                    break
+        self.write_http_cache()
+        return [results[deck_name] for deck_name in deck_names if deck_name in results]
+
+    def sync(self, decks_path, progress=None, cancelled=None):
+        """
+        Update every downloaded deck that changed in the repository, see download_decks.
+        With a manifest, an unchanged repository costs only the request for the index.
+        """
+        self.fetch_repository(force=True)
+        return self.download_decks(self.installed_decks(decks_path), decks_path, progress, cancelled)
+
+    def close(self):
+        self.session.close()
+
+
+def read_json(file_path):
+    try:
+        with open(file_path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_file(file_path, content):
+    """
+    Write a file atomically so readers never see a partial download.
+    """
+    tmp_path = f"{file_path}.part"
+    with open(tmp_path, 'wb') as file:
+        file.write(content)
+    os.replace(tmp_path, file_path)
+
+
+def file_digest(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def deck_file_name(deck_name, entry=None):
+    """
+    Get the local file name of a repository deck. Only the base name of the manifest entry is used.
+    """
+    if entry and entry.get('file'):
+        return os.path.basename(entry['file'])
+    return f"{deck_name}.yaml"
+
+
+def install_download(part_path, file_path, sha256, size=None, compressed=False):
+    """
+    Unpack a finished download next to `file_path`, check it against the manifest hash and size,
+    and move it into place atomically. A download that doesn't match is deleted and raises ValueError.
+    """
+    tmp_path = f"{file_path}.part"
+    digest = hashlib.sha256()
+    try:
+        with (gzip.open if compressed else open)(part_path, 'rb') as source, open(tmp_path, 'wb') as target:
+            for chunk in iter(lambda: source.read(DOWNLOAD_CHUNK), b''):
+                digest.update(chunk)
+                target.write(chunk)
+        if digest.hexdigest() != sha256 or (size is not None and os.path.getsize(tmp_path) != size):
+            raise ValueError("Downloaded deck doesn't match the repository manifest")
+        os.replace(tmp_path, file_path)
+    except (OSError, ValueError, EOFError):
+        for path in (tmp_path, part_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    os.remove(part_path)
+
+
+def build_manifest(directory, compress=True):
+    """
+    Write the repository index of a directory of YAML decks: their names and a manifest with the
+    hash, size and version of each. Versions of decks whose hash changed since the last index are
+    bumped. With `compress` a gzip copy is written next to every deck it makes smaller.
+    """
+    import yaml
+
+    index_path = os.path.join(directory, INDEX_CACHE_FILE)
+    data = {}
+    if os.path.exists(index_path):
+        with open(index_path, 'rb') as file:
+            data = yaml.safe_load(file) or {}
+    previous = data.get('manifest') or {}
+
+    manifest = {}
+    for file_name in sorted(os.listdir(directory)):
+        deck_name, extension = os.path.splitext(file_name)
+        if extension != '.yaml' or file_name == INDEX_CACHE_FILE:
+            continue
+        file_path = os.path.join(directory, file_name)
+        with open(file_path, 'rb') as file:
+            content = file.read()
+        sha256 = hashlib.sha256(content).hexdigest()
+        old = previous.get(deck_name, {})
+        version = old.get('version', 0)
+        entry = {
+            'file': file_name,
+            'sha256': sha256,
+            'size': len(content),
+            'version': version if old.get('sha256') == sha256 else version + 1,
+        }
+        gzip_path = f"{file_path}.gz"
+        # mtime 0 keeps the compressed copy identical as long as the deck is
+        compressed = gzip.compress(content, 9, mtime=0)
+        if compress and len(compressed) < len(content):
+            write_file(gzip_path, compressed)
+            entry['gzip'] = os.path.basename(gzip_path)
+            entry['gzip_size'] = len(compressed)
+        elif os.path.exists(gzip_path):
+            os.remove(gzip_path)
+        manifest[deck_name] = entry
+
+    # Listed decks keep their order, new ones go last
+    deck_names = [deck_name for deck_name in data.get('decks') or [] if deck_name in manifest]
+    deck_names.extend(deck_name for deck_name in manifest if deck_name not in deck_names)
+    data = {'decks': deck_names, 'manifest': manifest}
+    write_file(index_path, yaml.safe_dump(data, sort_keys=False, allow_unicode=True).encode('utf-8'))
+    return manifest
+
+
+_manager = None
+
+
+def get_manager():
+    """
+    Get the download manager shared by the whole application.
+    """
+    global _manager
+    if _manager is None:
+        _manager = DownloadManager(conf.get_cache_path())
+    return _manager
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="PyJi online deck repository")
+    commands = parser.add_subparsers(dest='command', required=True)
+    manifest_parser = commands.add_parser('manifest', help="write repo.yaml with the deck hashes of a directory")
+    manifest_parser.add_argument('directory')
+    manifest_parser.add_argument('--no-gzip', action='store_true', help="don't write compressed copies of the decks")
+    sync_parser = commands.add_parser('sync', help="update the downloaded decks that changed in the repository")
+    sync_parser.add_argument('--decks', help="decks directory, the one in the config folder by default")
+    sync_parser.add_argument('--url', default=REPO_URL, help="repository URL")
+    args = parser.parse_args()
+
+    if args.command == 'manifest':
+        for deck_name, entry in build_manifest(args.directory, not args.no_gzip).items():
+            print(f"{deck_name}: version {entry['version']}, {entry['size']} bytes")
+        return
+    decks_path = args.decks or os.path.join(conf.get_config_path(config=False), 'decks')
+    manager = DownloadManager(conf.get_cache_path(), args.url)
+    try:
+        for result in manager.sync(decks_path):
+            if result.error:
+                print(f"Failed to download deck {result.deck_name}: {result.error}")
+            elif result.changed:
+                print(f"Deck {result.deck_name} updated")
+    finally:
+        manager.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import collections
+import hashlib
+import os
+
+from PySide6.QtCore import QSize, Qt
+from PySide6.QtGui import QIcon, QImage, QImageReader, QPixmap
+
+# Locals
+import config as conf
+import metrics
+
+# Upper bound of the decoded pixmaps kept in memory
+CACHE_BYTES = 32 * 1024 * 1024
+# Images are decoded and thumbnailed at box sizes rounded up to this step, so a resize drag
+# doesn't decode the file or write a thumbnail for every size it passes through
+SIZE_STEP = 128
+THUMBNAIL_DIR = 'thumbnails'
+
+
+def file_stamp(path):
+    """
+    Get (mtime_ns, size) of a file, None if it can't be read.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def round_up(value):
+    return max(SIZE_STEP, -(-value // SIZE_STEP) * SIZE_STEP)
+
+
+class ImageCache:
+    """
+    Decodes images on first use and keeps them in a byte-bounded LRU cache.
+
+    Pixmaps are cached per path and target size. Images larger than the target are
+    decoded straight at a reduced size, and these reduced copies are written to
+    `thumbnail_dir` so the next start doesn't decode the full image again.
+    """
+
+    def __init__(self, thumbnail_dir=None, max_bytes=CACHE_BYTES):
+        self.thumbnail_dir = thumbnail_dir
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.pixmaps = collections.OrderedDict()
+        self.icons = {}
+        if thumbnail_dir:
+            os.makedirs(thumbnail_dir, exist_ok=True)
+
+    def _put(self, key, pixmap):
+        self.pixmaps[key] = pixmap
+        self.used_bytes += pixmap_bytes(pixmap)
+        while self.used_bytes > self.max_bytes and len(self.pixmaps) > 1:
+            _, old = self.pixmaps.popitem(last=False)
+            self.used_bytes -= pixmap_bytes(old)
+
+    def thumbnail_path(self, path, stamp, width, height):
+        key = f"{os.path.abspath(path)}|{stamp[0]}|{stamp[1]}|{width}x{height}"
+        return os.path.join(self.thumbnail_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.png')
+
+    @metrics.timed('images.decode')
+    def decode(self, path, stamp, width, height):
+        """
+        Read an image scaled down to fit `width` x `height`, through the thumbnail cache.
+        """
+        thumbnail_path = None
+        if self.thumbnail_dir:
+            thumbnail_path = self.thumbnail_path(path, stamp, width, height)
+            image = QImage(thumbnail_path)
+            if not image.isNull():
+                return image
+
+        reader = QImageReader(path)
+        size = reader.size()
+        scaled = size.isValid() and (size.width() > width or size.height() > height)
+        if scaled:
+            # Let the decoder skip the detail we'd throw away
+            reader.setScaledSize(size.scaled(width, height, Qt.KeepAspectRatio))
+        image = reader.read()
+        if image.isNull():
+            print(f"Error reading image {path}: {reader.errorString()}")
+            return image
+        if scaled and thumbnail_path:
+            tmp_path = f"{thumbnail_path}.tmp"
+            if image.save(tmp_path, 'PNG'):
+                os.replace(tmp_path, thumbnail_path)
+        return image
+
+    def pixmap(self, path, width=None, height=None):
+        """
+        Get the image at `path` scaled to fit `width` x `height` keeping its aspect ratio,
+        unscaled if no size is given. Returns None if the image can't be read.
+        """
+        stamp = file_stamp(path)
+        if stamp is None:
+            return None
+        key = (path, stamp, width, height)
+        pixmap = self.pixmaps.get(key)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(key)
+            metrics.count('images.hit')
+            return pixmap
+        metrics.count('images.miss')
+
+        if width is None or height is None:
+            image = self.decode(path, stamp, 1 << 30, 1 << 30)
+        else:
+            width, height = max(width, 1), max(height, 1)
+            image = self.decode(path, stamp, round_up(width), round_up(height))
+            if not image.isNull() and (image.width() > width or image.height() > height):
+                image = image.scaled(QSize(width, height), Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        if image.isNull():
+            return None
+        pixmap = QPixmap.fromImage(image)
+        self._put(key, pixmap)
+        return pixmap
+
+    def icon(self, path, size):
+        """
+        Get a QIcon for an image scaled to fit `size` x `size`, every path and size is read once.
+        """
+        key = (path, size)
+        icon = self.icons.get(key)
+        if icon is None:
+            pixmap = self.pixmap(path, size, size)
+            icon = QIcon(pixmap) if pixmap is not None else QIcon()
+            self.icons[key] = icon
+        return icon
+
+    def icon_pixmap(self, path, size):
+        """
+        Get an image scaled to fit `size` x `size` for a label, an empty pixmap if it can't be read.
+        """
+        pixmap = self.pixmap(path, size, size)
+        return pixmap if pixmap is not None else QPixmap()
+
+    def clear(self):
+        self.pixmaps.clear()
+        self.icons.clear()
+        self.used_bytes = 0
+
+
+def pixmap_bytes(pixmap):
+    return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+
+
+_cache = None
+
+
+def get_cache():
+    """
+    Get the image cache shared by the whole application.
+    """
+    global _cache
+    if _cache is None:
+        _cache = ImageCache(os.path.join(conf.get_cache_path(), THUMBNAIL_DIR))
+    return _cache
@@ -1,15 +1,73 @@
+import multiprocessing
 import sys
+import time
 
 # Locals
 import config as conf
-import ui
+import metrics
+
+PROFILE_FLAG = '--profile-startup'
+# Records timings and counters, written to the cache directory on exit
+METRICS_FLAG = '--metrics'
+
+
+class StartupProfile:
+    """
+    Times the startup steps from the start of main, printed when run with --profile-startup.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.steps = []
+
+    def mark(self, step):
+        # Only the first time a step happens counts
+        if any(name == step for name, _, _ in self.steps):
+            return
+        now = time.perf_counter()
+        self.steps.append((step, now - self.last, now - self.start))
+        self.last = now
+
+    def report(self):
+        print("Startup profile (step, ms, ms since start):")
+        for step, duration, elapsed in self.steps:
+            print(f"  {step:<12} {duration * 1000:8.1f} {elapsed * 1000:8.1f}")
+
 
 def main():
+    # Deck loading may use a pool of spawned processes, which start this executable again in frozen
+    # builds (PyInstaller --onefile included); this turns them into pool workers before anything else runs
+    multiprocessing.freeze_support()
+    profile = None
+    if PROFILE_FLAG in sys.argv:
+        sys.argv.remove(PROFILE_FLAG)
+        profile = StartupProfile()
+    if METRICS_FLAG in sys.argv:
+        sys.argv.remove(METRICS_FLAG)
+        # Before the instrumented modules are imported
+        metrics.enable()
+
+    # Imported here so the Qt import is part of the profile
+    import ui
+    if profile:
+        profile.mark("imports")
     config = conf.init()
+    if profile:
+        profile.mark("config")
     app = ui.QApplication(sys.argv)
-    window = ui.MainWindow(config)
-    window.show()
-    sys.exit(app.exec())
+    # Every card window shares the decks, loaded once
+    windows = ui.WindowGroup(config)
+    windows.open_windows(startup_profile=profile)
+    if profile:
+        profile.mark("window")
+    code = app.exec()
+    # Write settings changed just before quitting, and the search index
+    config.close()
+    windows.close()
+    if metrics.enabled:
+        ui.dump_metrics()
+    sys.exit(code)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,172 @@
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+# Off by default, counters and measure blocks then only check this flag
+enabled = False
+
+# Durations are kept in power of two microsecond buckets, the last one takes everything above ~18 minutes
+BUCKETS = 31
+
+
+class Histogram:
+    """
+    Distribution of durations, with exact count, total, min and max.
+    """
+
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.buckets = [0] * BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.buckets[min(int(seconds * 1e6).bit_length(), BUCKETS - 1)] += 1
+
+    def percentile(self, fraction):
+        """
+        Get the upper bound in seconds of the bucket holding the given fraction of the durations.
+        """
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                return min((1 << index) / 1e6, self.max)
+        return self.max
+
+    def to_dict(self):
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'total_ms': self.total * 1000,
+            'mean_ms': self.total / self.count * 1000,
+            'min_ms': self.min * 1000,
+            'max_ms': self.max * 1000,
+            'p50_ms': self.percentile(0.5) * 1000,
+            'p90_ms': self.percentile(0.9) * 1000,
+            'p99_ms': self.percentile(0.99) * 1000,
+            # Upper bound in microseconds -> count
+            'buckets': {str(1 << index): count for index, count in enumerate(self.buckets) if count},
+        }
+
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_started = time.time()
+
+
+def enable():
+    """
+    Start recording. Functions decorated with `timed` before this stay unmeasured,
+    so it has to run before the instrumented modules are imported.
+    """
+    global enabled
+    enabled = True
+
+
+def record(name, seconds):
+    if not enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.add(seconds)
+
+
+def count(name, amount=1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def timed(name):
+    """
+    Decorator recording the duration of every call under `name`. Returns the function
+    itself if metrics are disabled when it is applied.
+    """
+    def decorate(fn):
+        if not enabled:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+@contextlib.contextmanager
+def _measure(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def measure(name):
+    """
+    Context manager recording the duration of its block under `name`.
+    """
+    return _measure(name) if enabled else contextlib.nullcontext()
+
+
+def snapshot():
+    """
+    Get every histogram and counter as plain data.
+    """
+    with _lock:
+        return {
+            'started': _started,
+            'uptime_s': time.time() - _started,
+            'timings': {name: histogram.to_dict() for name, histogram in sorted(_histograms.items())},
+            'counters': dict(sorted(_counters.items())),
+        }
+
+
+def summary_lines():
+    """
+    Get a short line per timing and counter, for showing on screen.
+    """
+    data = snapshot()
+    lines = [
+        f"{name}: n={timing['count']} p50={timing['p50_ms']:.2f} p99={timing['p99_ms']:.2f} max={timing['max_ms']:.2f} ms"
+        for name, timing in data['timings'].items() if timing['count']
+    ]
+    lines.extend(f"{name}: {value}" for name, value in data['counters'].items())
+    return lines
+
+
+def dump(path):
+    """
+    Write a snapshot to a JSON file.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(snapshot(), file, indent=2)
+    os.replace(tmp_path, path)
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
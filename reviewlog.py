@@ -0,0 +1,343 @@
+import heapq
+import mmap
+import os
+import queue
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+
+# Event types
+SHOWN = 1
+REVEALED = 2
+EVENT_NAMES = {SHOWN: 'shown', REVEALED: 'revealed'}
+
+LOG_FILE = 'reviews.log'
+SUMMARY_FILE = 'review_summary.db'
+MAGIC = b'PYJILOG1'
+# Magic and generation, a new generation starts whenever the log is compacted
+HEADER = struct.Struct('<8sQ')
+# Card id, timestamp, deck id and event type, followed by a CRC-32 of these bytes
+RECORD = struct.Struct('<QdIB3xI')
+RECORD_BODY = struct.Struct('<QdIB3x')
+RECORD_SIZE = RECORD.size
+# The log is folded into the summary tables once it holds this many records
+COMPACT_RECORDS = 100000
+# Appended records are synced to disk at least this often, in seconds
+SYNC_INTERVAL = 5.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS decks (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS card_events (
+    card_id INTEGER NOT NULL,
+    deck_id INTEGER NOT NULL,
+    event INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    last_seen REAL NOT NULL,
+    PRIMARY KEY (card_id, deck_id, event)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# Queued to make the writer thread stop
+_CLOSE = object()
+
+
+def pack_record(card_id, timestamp, deck_id, event):
+    body = RECORD_BODY.pack(card_id, timestamp, deck_id, event)
+    return body + zlib.crc32(body).to_bytes(4, 'little')
+
+
+def iter_records(buffer, start, end):
+    """
+    Yield (card_id, timestamp, deck_id, event) of the records in buffer[start:end],
+    skipping the ones whose CRC doesn't match.
+    """
+    with memoryview(buffer) as view, view[start:end - (end - start) % RECORD_SIZE] as records:
+        for offset, (*fields, crc) in zip(range(0, len(records), RECORD_SIZE), RECORD.iter_unpack(records)):
+            if zlib.crc32(records[offset:offset + RECORD_BODY.size]) == crc:
+                yield fields
+
+
+def read_meta(db):
+    """
+    Get the generation of the log the summary tables hold records of and the log offset they hold them up to.
+    """
+    meta = dict(db.execute("SELECT key, value FROM meta"))
+    return meta.get('generation', 0), meta.get('folded', 0)
+
+
+class ReviewLog:
+    """
+    Append-only log of the cards shown and revealed, with counts folded into summary tables.
+
+    record() only queues an event. A writer thread appends the queued records in batches to
+    a file of fixed size records, each with a CRC: a record torn by a crash is cut off when
+    the log is opened, one damaged in place is skipped. Once the log holds `compact_records`
+    records the writer thread folds them into per card counts in an SQLite database and starts
+    a new log. Queries map the log file and add the records not folded yet to the counts.
+
+    The summary database remembers which generation of the log it holds records of and up to
+    where, so a log that was folded but not replaced before a crash isn't counted twice.
+    """
+
+    def __init__(self, directory, compact_records=COMPACT_RECORDS):
+        self.log_path = os.path.join(directory, LOG_FILE)
+        self.summary_path = os.path.join(directory, SUMMARY_FILE)
+        self.compact_records = compact_records
+        self.queue = queue.SimpleQueue()
+        # Held while the log file is mapped by a query or replaced by a compaction
+        self.lock = threading.Lock()
+        # Set once the log is open, queries wait for a repair to finish
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='review-log', daemon=True)
+        self.thread.start()
+
+    def record(self, card_id, deck_name, event, timestamp=None):
+        """
+        Queue an event of a card for writing, never blocks. Dropped if the writer thread stopped on an error.
+        """
+        if self.thread.is_alive():
+            self.queue.put((card_id, deck_name, event, time.time() if timestamp is None else timestamp))
+
+    def flush(self, timeout=None):
+        """
+        Wait until everything queued so far is written to the log file.
+        """
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        """
+        Write and sync what is queued and stop the writer thread.
+        """
+        if self.thread.is_alive():
+            self.queue.put(_CLOSE)
+            self.thread.join()
+
+    def connect(self):
+        db = sqlite3.connect(self.summary_path)
+        db.executescript(SCHEMA)
+        return db
+
+    def run(self):
+        db = self.connect()
+        try:
+            deck_ids = dict(db.execute("SELECT name, id FROM decks"))
+            with self.lock:
+                file, records = self.open_log(db)
+            self.ready.set()
+            if records >= self.compact_records:
+                file, records = self.compact(db, file)
+            unsynced = False
+            last_sync = time.monotonic()
+            closing = False
+            while not closing:
+                try:
+                    items = [self.queue.get(timeout=SYNC_INTERVAL if unsynced else None)]
+                except queue.Empty:
+                    items = []
+                # Everything queued meanwhile goes into the same write
+                while True:
+                    try:
+                        items.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                data = bytearray()
+                waiting = []
+                for item in items:
+                    if item is _CLOSE:
+                        closing = True
+                    elif isinstance(item, threading.Event):
+                        waiting.append(item)
+                    else:
+                        card_id, deck_name, event, timestamp = item
+                        deck_id = deck_ids.get(deck_name)
+                        if deck_id is None:
+                            # Committed before any record refers to it
+                            with db:
+                                deck_id = db.execute("INSERT INTO decks (name) VALUES (?)", (deck_name,)).lastrowid
+                            deck_ids[deck_name] = deck_id
+                        data += pack_record(card_id, timestamp, deck_id, event)
+                if data:
+                    # One write of whole records, the file is unbuffered
+                    file.write(data)
+                    records += len(data) // RECORD_SIZE
+                    unsynced = True
+                if unsynced and (closing or not items or time.monotonic() - last_sync >= SYNC_INTERVAL):
+                    os.fsync(file.fileno())
+                    unsynced = False
+                    last_sync = time.monotonic()
+                if records >= self.compact_records:
+                    file, records = self.compact(db, file)
+                for done in waiting:
+                    done.set()
+            file.close()
+        except Exception as e:
+            print(f"Error writing review log {self.log_path}: {e}")
+        finally:
+            self.ready.set()
+            db.close()
+
+    def write_log(self, generation, tail=b''):
+        """
+        Replace the log atomically with an empty one of a new generation, followed by `tail`.
+        """
+        tmp_path = f"{self.log_path}.tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, generation) + tail)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.log_path)
+
+    def open_log(self, db):
+        """
+        Open the log for appending, repairing what a crash left. Returns the file and its number of records.
+        """
+        summary_generation, folded = read_meta(db)
+        try:
+            with open(self.log_path, 'rb') as file:
+                header = file.read(HEADER.size)
+            magic, generation = HEADER.unpack(header) if len(header) == HEADER.size else (None, 0)
+        except FileNotFoundError:
+            magic, generation = None, 0
+        if magic != MAGIC:
+            if os.path.exists(self.log_path):
+                print(f"Review log {self.log_path} is not readable, starting a new one")
+            generation = summary_generation + 1
+            self.write_log(generation)
+        elif generation == summary_generation:
+            # Folded into the summary, but the crash came before the log was replaced
+            with open(self.log_path, 'rb') as file:
+                file.seek(folded)
+                tail = file.read()
+            generation += 1
+            self.write_log(generation, tail[:len(tail) - len(tail) % RECORD_SIZE])
+
+        file = open(self.log_path, 'r+b', buffering=0)
+        size = os.fstat(file.fileno()).st_size
+        # Cut off a record torn by a crash, and any whole records at the end that didn't make it to disk intact
+        end = size - (size - HEADER.size) % RECORD_SIZE
+        if end > HEADER.size:
+            with mmap.mmap(file.fileno(), end, access=mmap.ACCESS_READ) as mapped:
+                while end > HEADER.size:
+                    body = mapped[end - RECORD_SIZE:end - 4]
+                    if zlib.crc32(body) == int.from_bytes(mapped[end - 4:end], 'little'):
+                        break
+                    end -= RECORD_SIZE
+        if end != size:
+            file.truncate(end)
+            os.fsync(file.fileno())
+        file.close()
+        return open(self.log_path, 'ab', buffering=0), (end - HEADER.size) // RECORD_SIZE
+
+    def compact(self, db, file):
+        """
+        Fold the records of the log into the summary tables and start a new generation of the log.
+        """
+        with self.lock:
+            file.close()
+            with open(self.log_path, 'rb') as log:
+                generation = HEADER.unpack(log.read(HEADER.size))[1]
+                data = log.read()
+            end = HEADER.size + len(data) - len(data) % RECORD_SIZE
+            counts = {}
+            for card_id, timestamp, deck_id, event in iter_records(data, 0, end - HEADER.size):
+                key = (card_id, deck_id, event)
+                count, last_seen = counts.get(key, (0, 0.0))
+                counts[key] = (count + 1, max(last_seen, timestamp))
+            with db:
+                db.executemany(
+                    "INSERT INTO card_events (card_id, deck_id, event, count, last_seen) VALUES (?, ?, ?, ?, ?)"
+                    " ON CONFLICT (card_id, deck_id, event) DO UPDATE SET"
+                    " count = count + excluded.count, last_seen = MAX(last_seen, excluded.last_seen)",
+                    [(*key, count, last_seen) for key, (count, last_seen) in counts.items()],
+                )
+                db.executemany(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    [('generation', generation), ('folded', end)],
+                )
+            self.write_log(generation + 1)
+            return open(self.log_path, 'ab', buffering=0), 0
+
+    def log_counts(self, db):
+        """
+        Get (card_id, deck_id, event) -> count of the records in the log that aren't in the summary yet.
+        """
+        summary_generation, folded = read_meta(db)
+        counts = {}
+        with self.lock:
+            try:
+                file = open(self.log_path, 'rb')
+            except FileNotFoundError:
+                return counts
+            with file:
+                size = os.fstat(file.fileno()).st_size
+                if size <= HEADER.size:
+                    return counts
+                with mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+                    magic, generation = HEADER.unpack(mapped[:HEADER.size])
+                    if magic != MAGIC:
+                        return counts
+                    start = folded if generation == summary_generation else HEADER.size
+                    for card_id, _, deck_id, event in iter_records(mapped, start, size):
+                        key = (card_id, deck_id, event)
+                        counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def card_counts(self, event):
+        """
+        Get (card_id, deck name) -> number of times an event happened to the card.
+        """
+        self.ready.wait()
+        db = self.connect()
+        try:
+            deck_names = dict(db.execute("SELECT id, name FROM decks"))
+            counts = {}
+            rows = db.execute("SELECT card_id, deck_id, count FROM card_events WHERE event = ?", (event,))
+            for card_id, deck_id, count in rows:
+                counts[(card_id, deck_names[deck_id])] = count
+            for (card_id, deck_id, record_event), count in self.log_counts(db).items():
+                if record_event == event and deck_id in deck_names:
+                    key = (card_id, deck_names[deck_id])
+                    counts[key] = counts.get(key, 0) + count
+            return counts
+        finally:
+            db.close()
+
+    def most_revealed(self, limit=10):
+        """
+        Get the (card_id, deck name, count) of the cards whose answer was looked at most often.
+        """
+        counts = self.card_counts(REVEALED)
+        return [(*key, count) for key, count in heapq.nlargest(limit, counts.items(), key=lambda item: item[1])]
+
+    def deck_counts(self):
+        """
+        Get deck name -> {event name: count} for every deck with recorded events.
+        """
+        self.ready.wait()
+        db = self.connect()
+        try:
+            deck_names = dict(db.execute("SELECT id, name FROM decks"))
+            totals = {}
+            rows = db.execute("SELECT deck_id, event, SUM(count) FROM card_events GROUP BY deck_id, event")
+            for deck_id, event, count in rows:
+                totals[(deck_id, event)] = count
+            for (_, deck_id, event), count in self.log_counts(db).items():
+                totals[(deck_id, event)] = totals.get((deck_id, event), 0) + count
+        finally:
+            db.close()
+        result = {}
+        for (deck_id, event), count in totals.items():
+            if deck_id in deck_names and event in EVENT_NAMES:
+                result.setdefault(deck_names[deck_id], {})[EVENT_NAMES[event]] = count
+        return result
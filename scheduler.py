@@ -0,0 +1,228 @@
+import heapq
+import sqlite3
+import time
+
+# Locals
+import cardstore
+
+# Review grades on the SM-2 0-5 scale
+AGAIN = 1
+GOOD = 4
+
+DAY = 24 * 60 * 60
+# Cards answered wrong come back after this many seconds
+RELEARN_DELAY = 10 * 60
+MIN_EASE = 1.3
+# How many due entries are read from the database at a time
+LOAD_BATCH = 256
+# How many random cards are tried for one that wasn't reviewed yet
+NEW_CARD_TRIES = 32
+# Reviews are committed at most this often, in seconds, and on close
+COMMIT_INTERVAL = 30.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reviews (
+    card_id INTEGER PRIMARY KEY,
+    deck TEXT NOT NULL,
+    question TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    comment TEXT NOT NULL,
+    due REAL NOT NULL,
+    interval REAL NOT NULL,
+    ease REAL NOT NULL,
+    repetitions INTEGER NOT NULL,
+    lapses INTEGER NOT NULL,
+    last_review REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reviews_due ON reviews (due, card_id);
+"""
+
+COLUMNS = 'card_id, deck, question, answer, comment, due, interval, ease, repetitions, lapses, last_review'
+
+
+class ReviewState:
+    """
+    SM-2 scheduling state of one card.
+    """
+
+    __slots__ = (
+        'card_id', 'deck', 'card', 'due', 'interval', 'ease', 'repetitions', 'lapses', 'last_review',
+    )
+
+    def __init__(self, card_id, deck, card, due=0.0, interval=0.0, ease=2.5, repetitions=0, lapses=0,
+                 last_review=0.0):
+        self.card_id = card_id
+        self.deck = deck
+        self.card = card
+        self.due = due
+        self.interval = interval
+        self.ease = ease
+        self.repetitions = repetitions
+        self.lapses = lapses
+        self.last_review = last_review
+
+    @classmethod
+    def from_row(cls, row):
+        card_id, deck, question, answer, comment, *state = row
+        return cls(card_id, deck, cardstore.Card(question, answer, comment), *state)
+
+    def to_row(self):
+        return (
+            self.card_id, self.deck, self.card.question, self.card.answer, self.card.comment,
+            self.due, self.interval, self.ease, self.repetitions, self.lapses, self.last_review,
+        )
+
+    def apply(self, grade, now):
+        """
+        Update the state for a review with the given grade using the SM-2 rules.
+        """
+        if grade < 3:
+            self.repetitions = 0
+            self.lapses += 1
+            self.interval = 0.0
+            self.due = now + RELEARN_DELAY
+        else:
+            self.repetitions += 1
+            if self.repetitions == 1:
+                self.interval = 1.0
+            elif self.repetitions == 2:
+                self.interval = 6.0
+            else:
+                self.interval = round(self.interval * self.ease, 2)
+            self.due = now + self.interval * DAY
+        self.ease = max(MIN_EASE, self.ease + 0.1 - (5 - grade) * (0.08 + (5 - grade) * 0.02))
+        self.last_review = now
+
+
+class Scheduler:
+    """
+    Spaced repetition on top of a collection. Reviewed cards are kept in a SQLite database
+    and due ones in per-deck heaps keyed by their next review time. Due entries are read
+    from the database in batches as time passes, so startup never scans every card.
+    Reviews are committed in batches, the write-ahead log keeps a commit from waiting on the disk.
+    """
+
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.last_commit = time.monotonic()
+        # Card id -> ReviewState for every entry currently in a heap
+        self.entries = {}
+        # Deck name -> heap of (due, card_id)
+        self.heaps = {}
+        # (due, card_id) of the last entry read from the database
+        self.loaded_until = (float('-inf'), -1)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def _load_due(self, now):
+        # Read entries due by `now` that aren't in the heaps yet
+        while self.loaded_until[0] <= now:
+            rows = self.db.execute(
+                f"SELECT {COLUMNS} FROM reviews WHERE (due, card_id) > (?, ?) AND due <= ?"
+                " ORDER BY due, card_id LIMIT ?",
+                (*self.loaded_until, now, LOAD_BATCH),
+            ).fetchall()
+            for row in rows:
+                self._push(ReviewState.from_row(row))
+            if len(rows) < LOAD_BATCH:
+                # Everything due by now is loaded, later entries are read on a later call
+                self.loaded_until = (now, float('inf'))
+                break
+            last = rows[-1]
+            self.loaded_until = (last[5], last[0])
+
+    def _push(self, state):
+        self.entries[state.card_id] = state
+        heapq.heappush(self.heaps.setdefault(state.deck, []), (state.due, state.card_id))
+
+    def _top(self, heap):
+        # Drop entries that were rescheduled after being pushed
+        while heap:
+            due, card_id = heap[0]
+            state = self.entries.get(card_id)
+            if state is not None and state.due == due:
+                return heap[0]
+            heapq.heappop(heap)
+        return None
+
+    def next_due(self, deck_names, now=None, exclude=None):
+        """
+        Get the (deck name, card) that is most overdue among the given decks, None if nothing is due.
+        The card with id `exclude` is passed over.
+        """
+        now = time.time() if now is None else now
+        self._load_due(now)
+        best = None
+        for deck_name in deck_names:
+            heap = self.heaps.get(deck_name)
+            top = self._top(heap)
+            if top is not None and top[1] == exclude:
+                # Look underneath it, then put it back
+                excluded = heapq.heappop(heap)
+                top = self._top(heap)
+                heapq.heappush(heap, excluded)
+            if top is not None and top[0] <= now and (best is None or top < best[0]):
+                best = (top, deck_name)
+        if best is None:
+            return None
+        (_, card_id), deck_name = best
+        return deck_name, self.entries[card_id].card
+
+    def pick(self, sampler, now=None, exclude=None):
+        """
+        Get the next (deck name, card) to show: a due card from the sampler's selected decks
+        if there is one, otherwise a random card that wasn't reviewed yet. Once every card tried
+        is scheduled for later, one of them is shown ahead of time; is_due tells it apart.
+        A due card with id `exclude` is passed over.
+        """
+        now = time.time() if now is None else now
+        deck_names = [name for name in sampler.selected if sampler.collection.count(name)]
+        due = self.next_due(deck_names, now, exclude)
+        if due is not None:
+            return due
+        picked = None
+        for _ in range(NEW_CARD_TRIES):
+            picked = sampler.sample()
+            if picked is None or self.get_state(picked[1].card_id()) is None:
+                break
+        return picked
+
+    def is_due(self, card, now=None):
+        """
+        Whether a card is new or due for review, only those are graded.
+        """
+        state = self.get_state(card.card_id())
+        return state is None or state.due <= (time.time() if now is None else now)
+
+    def get_state(self, card_id):
+        if card_id in self.entries:
+            return self.entries[card_id]
+        row = self.db.execute(f"SELECT {COLUMNS} FROM reviews WHERE card_id = ?", (card_id,)).fetchone()
+        return ReviewState.from_row(row) if row else None
+
+    def review(self, deck_name, card, grade, now=None):
+        """
+        Record a review of a card and reschedule it. Committed with the next batch.
+        """
+        now = time.time() if now is None else now
+        card_id = card.card_id()
+        state = self.get_state(card_id) or ReviewState(card_id, deck_name, card)
+        state.apply(grade, now)
+        self.db.execute(
+            f"INSERT OR REPLACE INTO reviews ({COLUMNS}) VALUES ({', '.join('?' * 11)})",
+            state.to_row(),
+        )
+        if time.monotonic() - self.last_commit >= COMMIT_INTERVAL:
+            self.db.commit()
+            self.last_commit = time.monotonic()
+        # Entries due beyond what was loaded are picked up by _load_due later
+        if state.due <= self.loaded_until[0]:
+            self._push(state)
+        else:
+            self.entries.pop(card_id, None)
+        return state
@@ -0,0 +1,242 @@
+import array
+import bisect
+import os
+import pickle
+import re
+import unicodedata
+import zlib
+
+INDEX_VERSION = 2
+INDEX_FILE = 'search.idx'
+# Kanji and kana, without the ・ separator. Runs of these are indexed as character n-grams
+CJK_CHARS = '々ぁ-ゖゝ-ゟァ-ヺー-ヿ㐀-䶿一-鿿豈-﫿'
+TOKEN_RE = re.compile(rf'([{CJK_CHARS}]+)|((?:(?![{CJK_CHARS}])[^\W_])+)')
+# Shorter word prefixes match too many words to be useful
+MIN_PREFIX = 2
+
+
+def normalize(text):
+    """
+    Fold width, compatibility forms and case so ｶﾀｶﾅ matches カタカナ and Word matches word.
+    """
+    return unicodedata.normalize('NFKC', text).casefold()
+
+
+def cjk_tokens(run):
+    """
+    Get the tokens of a kanji and kana run: its characters and character bigrams, as ints.
+    Code points are below 2 ** 21, so a bigram packed into one int never equals a character.
+    """
+    codes = [ord(char) for char in run]
+    tokens = set(codes)
+    tokens.update((first << 21) | second for first, second in zip(codes, codes[1:]))
+    return tokens
+
+
+def text_tokens(text):
+    """
+    Get the set of index tokens of a text: characters and character bigrams of kanji and kana runs,
+    whole words of everything else.
+    """
+    tokens = set()
+    for cjk, word in TOKEN_RE.findall(normalize(text)):
+        if word:
+            tokens.add(word)
+        else:
+            tokens.update(cjk_tokens(cjk))
+    return tokens
+
+
+def card_text(card):
+    # Fields on separate lines, so words and kanji runs don't join across them
+    return '\n'.join(card.fields())
+
+
+def cards_fingerprint(cards):
+    """
+    Get (count, CRC-32 of the text) of cards, to tell whether a saved deck index still matches them.
+    """
+    count = 0
+    crc = 0
+    for card in cards:
+        crc = zlib.crc32(card_text(card).encode('utf-8', 'surrogatepass'), crc)
+        count += 1
+    return count, crc
+
+
+class DeckIndex:
+    """
+    Inverted index of the question, answer and comment of the cards of one deck.
+    Posting lists hold card positions in the card store, so no card text is copied.
+    """
+
+    __slots__ = ('fingerprint', 'postings', 'vocabulary', 'version')
+
+    def __init__(self, fingerprint, postings):
+        self.fingerprint = fingerprint
+        # Token -> a card position, or an array of them once there are several
+        self.postings = postings
+        # Sorted words for prefix queries, built on the first one
+        self.vocabulary = None
+        # Collection version of the deck the positions are valid for
+        self.version = None
+
+    def __getstate__(self):
+        return self.fingerprint, self.postings
+
+    def __setstate__(self, state):
+        self.fingerprint, self.postings = state
+        self.vocabulary = None
+        self.version = None
+
+    @classmethod
+    def build(cls, cards, fingerprint):
+        postings = {}
+        for position, card in enumerate(cards):
+            for token in text_tokens(card_text(card)):
+                posting = postings.get(token)
+                if posting is None:
+                    postings[token] = position
+                elif isinstance(posting, int):
+                    postings[token] = array.array('I', (posting, position))
+                else:
+                    posting.append(position)
+        return cls(fingerprint, postings)
+
+    def posting(self, token):
+        posting = self.postings.get(token, ())
+        return (posting,) if isinstance(posting, int) else posting
+
+    def prefix_positions(self, prefix):
+        if self.vocabulary is None:
+            # Kanji and kana tokens are ints, only words are matched by prefix
+            self.vocabulary = sorted(token for token in self.postings if isinstance(token, str))
+        positions = set()
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        for token in self.vocabulary[start:]:
+            if not token.startswith(prefix):
+                break
+            positions.update(self.posting(token))
+        return positions
+
+    def match(self, terms):
+        """
+        Get the sorted positions of the cards having every term: (token, is_prefix) pairs.
+        """
+        candidates = [self.prefix_positions(token) if prefix else self.posting(token) for token, prefix in terms]
+        candidates.sort(key=len)
+        matches = set(candidates[0])
+        for posting in candidates[1:]:
+            if not matches:
+                break
+            matches.intersection_update(posting)
+        return sorted(matches)
+
+
+def query_terms(query):
+    """
+    Split a query into (token, is_prefix) terms, and the kanji and kana runs whose n-grams must be adjacent.
+    The last word also matches as a prefix while it is being typed.
+    """
+    query = normalize(query)
+    terms = []
+    phrases = []
+    parts = TOKEN_RE.findall(query)
+    for index, (cjk, word) in enumerate(parts):
+        if word:
+            last = index == len(parts) - 1 and not query[-1:].isspace()
+            terms.append((word, last and len(word) >= MIN_PREFIX))
+        else:
+            # Bigrams alone say enough, the characters are only needed for one character queries
+            terms.extend((token, False) for token in cjk_tokens(cjk) if len(cjk) == 1 or token >> 21)
+            if len(cjk) > 2:
+                phrases.append(cjk)
+    return terms, phrases
+
+
+class SearchIndex:
+    """
+    Per deck inverted indexes over the cards of a collection.
+
+    Deck indexes are built from the card store when a search needs them, see
+    Collection.search_snapshots, and dropped or rebuilt as their deck changes.
+    Saved indexes are reused for decks whose cards still match their fingerprint.
+    """
+
+    def __init__(self, decks=None):
+        # Deck name -> DeckIndex
+        self.decks = decks or {}
+        self.dirty = False
+
+    def search(self, query, get_card, limit=100, deck_names=None):
+        """
+        Find cards matching every word of the query in the indexed decks, or in `deck_names` of them.
+        Cards are read with get_card(deck name, position). Returns up to `limit` (deck name, cardstore.Card) pairs.
+        """
+        terms, phrases = query_terms(query)
+        if not terms:
+            return []
+        results = []
+        for deck_name, deck_index in self.decks.items():
+            if deck_names is not None and deck_name not in deck_names:
+                continue
+            for position in deck_index.match(terms):
+                card = get_card(deck_name, position)
+                if phrases:
+                    folded = normalize(card_text(card))
+                    if not all(phrase in folded for phrase in phrases):
+                        continue
+                results.append((deck_name, card))
+                if len(results) >= limit:
+                    return results
+        return results
+
+    def save(self, path):
+        """
+        Write the index to a file atomically.
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as file:
+            pickle.dump((INDEX_VERSION, self.decks), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read an index saved with save, an empty index if there is none or it can't be read.
+        """
+        try:
+            with open(path, 'rb') as file:
+                version, decks = pickle.load(file)
+        except FileNotFoundError:
+            return cls()
+        except Exception as e:
+            print(f"Error reading search index {path}: {e}")
+            return cls()
+        if version != INDEX_VERSION:
+            return cls()
+        return cls(decks)
+
+
+def build_deck_indexes(snapshots, saved_path=None, progress=None, cancelled=None):
+    """
+    Index decks given as (deck name, version, read) snapshots, where read() iterates over the cards.
+    Decks whose cards match the index saved at `saved_path` take it from there. Can run in any thread.
+    `progress` is called with (done, total) after every deck, once `cancelled()` returns True the
+    decks left are skipped. Returns deck name -> DeckIndex.
+    """
+    saved = SearchIndex.load(saved_path).decks if saved_path else {}
+    deck_indexes = {}
+    for done, (deck_name, version, read) in enumerate(snapshots):
+        if cancelled is not None and cancelled():
+            break
+        fingerprint = cards_fingerprint(read())
+        deck_index = saved.get(deck_name)
+        if deck_index is None or deck_index.fingerprint != fingerprint:
+            deck_index = DeckIndex.build(read(), fingerprint)
+        deck_index.version = version
+        deck_indexes[deck_name] = deck_index
+        if progress is not None:
+            progress(done + 1, len(snapshots))
+    return deck_indexes
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows
+    resource = None
+
+# Locals
+import cardstore
+
+
+class MmapCardStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.store = cardstore.MmapCardStore(os.path.join(self.directory, 'cards'))
+        self.addCleanup(self.store.close)
+
+    def test_fields_keep_unit_separators(self):
+        cards = [
+            ['a\x1fb', 'c', ''],
+            ['a', 'b\x1fc', ''],
+            ['\x1f', '', '\x1f\x1f'],
+            ['口', 'こう\x1fくち', 'Mouth'],
+        ]
+        self.store.add_cards('Deck', cards, source='deck.yaml')
+        expected = [cardstore.Card(*fields) for fields in cards]
+        self.assertEqual([self.store.get_card('Deck', index) for index in range(len(cards))], expected)
+        self.assertEqual(list(self.store.snapshot('Deck')()), expected)
+
+    def test_cards_are_stored_once(self):
+        self.store.add_cards('Deck', [['a\x1fb', 'c'], ['a', 'b\x1fc']], source='one.yaml')
+        self.store.add_cards('Other', [['a', 'b\x1fc'], ['a\x1fb', 'c']], source='two.yaml')
+        self.assertEqual(self.store.total, 2)
+        self.assertEqual(self.store.get_card('Other', 0), cardstore.Card('a', 'b\x1fc'))
+
+    def test_many_decks(self):
+        # Decks must not hold a file each, thousands of them would run out of descriptors
+        deck_count = 3000
+        if resource is not None:
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if soft == resource.RLIM_INFINITY or soft > 256:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (256, hard))
+                self.addCleanup(resource.setrlimit, resource.RLIMIT_NOFILE, (soft, hard))
+        for number in range(deck_count):
+            self.store.add_cards(f'Deck {number}', [[f'q{number}', 'a'], ['shared', 'a'], [f'q{number}', 'a']],
+                                 source=f'deck{number}.tsv')
+        self.store.trim()
+        self.assertEqual(len(self.store.get_decks()), deck_count)
+        self.assertEqual(self.store.total, deck_count + 1)
+        self.assertEqual(self.store.count('Deck 2999'), 2)
+        self.assertEqual(self.store.get_card('Deck 2999', 0), cardstore.Card('q2999', 'a'))
+        self.store.add_cards('Deck 0', [['new', 'a'], ['shared', 'a']], source='deck0.tsv')
+        self.assertEqual(self.store.count('Deck 0'), 3)
+
+    def test_empty_fields(self):
+        self.store.add_cards('Deck', [['', '', ''], ['q']], source='deck.yaml')
+        self.assertEqual(self.store.get_card('Deck', 0), cardstore.Card(''))
+        self.assertEqual(self.store.get_card('Deck', 1), cardstore.Card('q'))
+
+
+class SqliteCardStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.store = cardstore.SqliteCardStore(os.path.join(self.directory, 'collection.db'))
+        self.addCleanup(self.store.close)
+
+    def test_remove_source_keeps_empty_decks_of_other_files(self):
+        self.store.add_cards('Empty', [], source='empty.yaml')
+        self.store.add_cards('Kanji', [['口', 'くち']], source='kanji.yaml')
+        self.assertEqual(self.store.remove_source('kanji.yaml'), ['Kanji'])
+        self.assertEqual(self.store.get_decks(), ['Empty'])
+        self.assertEqual(self.store.count('Empty'), 0)
+
+    def test_remove_source_drops_its_empty_decks(self):
+        self.store.add_cards('Empty', [], source='empty.yaml')
+        self.store.add_cards('Kanji', [['口', 'くち']], source='kanji.yaml')
+        self.assertEqual(self.store.remove_source('empty.yaml'), ['Empty'])
+        self.assertEqual(self.store.get_decks(), ['Kanji'])
+
+    def test_remove_source_keeps_empty_decks_other_files_declare(self):
+        self.store.add_cards('Empty', [], source='one.yaml')
+        self.store.add_cards('Empty', [], source='two.yaml')
+        self.assertEqual(self.store.remove_source('one.yaml'), ['Empty'])
+        self.assertIn('Empty', self.store)
+        self.assertEqual(self.store.remove_source('two.yaml'), ['Empty'])
+        self.assertNotIn('Empty', self.store)
+
+    def test_remove_source_keeps_decks_other_files_have_cards_in(self):
+        self.store.add_cards('Kanji', [['口', 'くち'], ['目', 'め']], source='one.yaml')
+        self.store.add_cards('Kanji', [['目', 'め']], source='two.yaml')
+        self.assertEqual(self.store.remove_source('one.yaml'), ['Kanji'])
+        self.assertEqual(self.store.count('Kanji'), 1)
+        self.assertEqual(self.store.get_card('Kanji', 0), cardstore.Card('目', 'め'))
+        self.assertEqual(self.store.remove_source('two.yaml'), ['Kanji'])
+        self.assertNotIn('Kanji', self.store)
+
+
+if __name__ == '__main__':
+    unittest.main()
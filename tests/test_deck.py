@@ -0,0 +1,203 @@
+import collections
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+# Locals
+import cache
+import deck
+from deck import FenwickTree
+
+DECK_YAML = """decks:
+  - name: 'Kanji'
+    cards:
+      - ['口', 'こう・くち', 'Mouth']
+      - ['目', 'もく・め', 'Eye']
+"""
+
+
+class DeckCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.decks_path = os.path.join(self.directory, 'decks')
+        self.cache_dir = os.path.join(self.directory, 'cache')
+        os.makedirs(self.decks_path)
+        self.deck_path = os.path.join(self.decks_path, 'kanji.yaml')
+        with open(self.deck_path, 'w', encoding='utf-8') as file:
+            file.write(DECK_YAML)
+
+    def load(self):
+        """
+        Load the decks directory, returns the decks by file and the paths that were parsed.
+        """
+        with mock.patch.object(deck, 'stream_deck_file', wraps=deck.stream_deck_file) as stream:
+            decks = dict(deck.iter_deck_files(self.decks_path, self.cache_dir, parallel=False))
+        return decks, [call.args[0] for call in stream.call_args_list]
+
+    def test_unchanged_file_is_read_from_the_cache(self):
+        first, parsed = self.load()
+        self.assertEqual(parsed, [self.deck_path])
+        second, parsed = self.load()
+        self.assertEqual(parsed, [])
+        self.assertEqual(second, first)
+
+    def test_touched_file_is_not_parsed_again(self):
+        first, _ = self.load()
+        stat = os.stat(self.deck_path)
+        os.utime(self.deck_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        second, parsed = self.load()
+        self.assertEqual(parsed, [])
+        self.assertEqual(second, first)
+        # The entry now has the new mtime, so the next start doesn't even hash the file
+        with mock.patch.object(cache, 'file_digest') as digest:
+            self.assertTrue(cache.is_fresh(self.cache_dir, self.deck_path))
+        digest.assert_not_called()
+
+    def test_changed_file_is_parsed_again(self):
+        self.load()
+        with open(self.deck_path, 'w', encoding='utf-8') as file:
+            # Same size, other content
+            file.write(DECK_YAML.replace('Mouth', 'MOUTH'))
+        stat = os.stat(self.deck_path)
+        os.utime(self.deck_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        decks, parsed = self.load()
+        self.assertEqual(parsed, [self.deck_path])
+        self.assertEqual(decks['kanji.yaml'][0]['cards'][0][2], 'MOUTH')
+
+
+
+def seed_random(test, seed=1234):
+    state = random.getstate()
+    test.addCleanup(random.setstate, state)
+    random.seed(seed)
+
+
+class FenwickTreeTest(unittest.TestCase):
+
+    def assert_finds(self, tree):
+        # Every value from the start of a nonzero weight to just before its end lands on it
+        for position, weight in enumerate(tree.weights):
+            if not weight:
+                continue
+            start = tree.prefix_sum(position)
+            for value in (start, start + weight / 2, start + weight * 0.999):
+                self.assertEqual(tree.find(value), position, (tree.weights, value))
+
+    def test_find_skips_zero_weights_at_the_edges(self):
+        tree = FenwickTree([0.0, 0.0, 1.0, 2.0, 0.0, 0.0])
+        self.assert_finds(tree)
+        self.assertEqual(tree.find(0.0), 2)
+        # Float error past the end falls back to the last nonzero weight
+        self.assertEqual(tree.find(tree.total), 3)
+        self.assertEqual(tree.find(tree.total * 1.5), 3)
+
+    def test_find_skips_zero_weights_in_between(self):
+        weights = [0.0, 3.0, 0.0, 0.0, 0.5, 0.0, 2.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0]
+        tree = FenwickTree(weights)
+        self.assertEqual(tree.total, sum(weights))
+        self.assert_finds(tree)
+        for count in range(len(weights) + 1):
+            self.assertEqual(tree.prefix_sum(count), sum(weights[:count]))
+
+    def test_single_weight(self):
+        tree = FenwickTree([0.0] * 7 + [1.0] + [0.0] * 8)
+        for value in (0.0, 0.5, 0.999, 1.0):
+            self.assertEqual(tree.find(value), 7)
+
+    def test_all_zero_weights_sample_nothing(self):
+        self.assertIsNone(FenwickTree().sample())
+        self.assertIsNone(FenwickTree([0.0, 0.0]).sample())
+
+    def test_updates_after_removal(self):
+        tree = FenwickTree([1.0] * 9)
+        # Removed entries get weight 0
+        for position in (0, 4, 8):
+            tree.update(position, 0.0)
+        self.assertEqual(tree.total, 6.0)
+        self.assert_finds(tree)
+        seed_random(self)
+        drawn = {tree.sample() for _ in range(2000)}
+        self.assertEqual(drawn, {1, 2, 3, 5, 6, 7})
+        tree.update(4, 3.0)
+        tree.update(1, 0.0)
+        tree.append(2.0)
+        self.assertEqual(tree.total, 10.0)
+        self.assert_finds(tree)
+        self.assertEqual(tree.find(tree.prefix_sum(4)), 4)
+        for count in range(len(tree) + 1):
+            self.assertEqual(tree.prefix_sum(count), sum(tree.weights[:count]))
+
+    def test_sampling_proportions(self):
+        weights = [1.0, 2.0, 0.0, 7.0, 0.0]
+        tree = FenwickTree(weights)
+        seed_random(self)
+        draws = 20000
+        counts = collections.Counter(tree.sample() for _ in range(draws))
+        self.assertEqual(set(counts), {0, 1, 3})
+        for position, weight in enumerate(weights):
+            self.assertAlmostEqual(counts[position] / draws, weight / sum(weights), delta=0.015)
+
+
+class WeightedSamplerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        for deck_name, count in (('a', 4), ('b', 1)):
+            self.write_deck(deck_name, count)
+        self.collection = deck.Collection(self.directory, parallel=False)
+        self.addCleanup(self.collection.close)
+        seed_random(self)
+
+    def write_deck(self, deck_name, count):
+        with open(os.path.join(self.directory, f'{deck_name}.tsv'), 'w', encoding='utf-8') as file:
+            file.write(''.join(f'{deck_name}{number}\tx\n' for number in range(count)))
+
+    def draw(self, sampler, draws=4000):
+        return collections.Counter(
+            (deck_name, card.question) for deck_name, card in (sampler.sample() for _ in range(draws))
+        )
+
+    def test_card_and_deck_modes(self):
+        sampler = deck.WeightedSampler(self.collection, selected_decks=['a', 'b'])
+        counts = self.draw(sampler)
+        self.assertAlmostEqual(counts[('b', 'b0')] / 4000, 1 / 5, delta=0.03)
+        sampler.set_mode('deck')
+        counts = self.draw(sampler)
+        self.assertAlmostEqual(counts[('b', 'b0')] / 4000, 1 / 2, delta=0.03)
+
+    def test_zero_weight_cards_are_never_drawn(self):
+        sampler = deck.WeightedSampler(self.collection, selected_decks=['a'])
+        sampler.set_card_weight('a', 0, 0.0)
+        sampler.set_card_weight('a', 3, 0.0)
+        sampler.set_card_weight('a', 1, 3.0)
+        counts = self.draw(sampler)
+        self.assertEqual(set(counts), {('a', 'a1'), ('a', 'a2')})
+        self.assertAlmostEqual(counts[('a', 'a1')] / 4000, 3 / 4, delta=0.03)
+
+    def test_removed_deck_is_never_drawn(self):
+        sampler = deck.WeightedSampler(self.collection, selected_decks=['a', 'b'])
+        sampler.set_card_weight('a', 2, 10.0)
+        self.collection.remove_file(os.path.join(self.directory, 'a.tsv'))
+        self.assertNotIn('a', sampler.card_weights)
+        self.assertEqual(set(self.draw(sampler, 500)), {('b', 'b0')})
+        # Back with fewer cards, drawn evenly again
+        self.write_deck('a', 2)
+        self.collection.refresh()
+        self.assertEqual(set(self.draw(sampler)), {('a', 'a0'), ('a', 'a1'), ('b', 'b0')})
+
+    def test_nothing_selected(self):
+        sampler = deck.WeightedSampler(self.collection)
+        self.assertIsNone(sampler.sample())
+        sampler.set_deck_selected('a', True)
+        sampler.set_deck_selected('a', False)
+        self.assertIsNone(sampler.sample())
+
+
+if __name__ == '__main__':
+    unittest.main()
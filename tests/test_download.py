@@ -0,0 +1,305 @@
+import hashlib
+import http.server
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+# Locals
+import download
+
+
+class RepoHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the files of its server, honouring If-None-Match and single open ended ranges, and failing or
+    cutting short the ones asked to.
+    """
+
+    def do_GET(self):
+        server = self.server
+        name = self.path.lstrip('/')
+        server.requests.append((name, self.headers))
+        if name in server.failing:
+            self.send_error(500)
+            return
+        if name not in server.files:
+            self.send_error(404)
+            return
+        body, etag = server.files[name]
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        offset = self.range_start()
+        if offset is not None and server.ranges:
+            if offset >= len(body):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {offset}-{len(body) - 1}/{len(body)}")
+            body = body[offset:]
+        else:
+            self.send_response(200)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if name in server.truncated:
+            # Drop the connection half way through the promised body
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def range_start(self):
+        value = self.headers.get('Range', '')
+        if not value.startswith('bytes=') or not value.endswith('-'):
+            return None
+        return int(value[len('bytes='):-1])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RepoServer(http.server.ThreadingHTTPServer):
+
+    def __init__(self, handler=RepoHandler):
+        super().__init__(('127.0.0.1', 0), handler)
+        # Name -> (content, ETag or None)
+        self.files = {}
+        self.failing = set()
+        self.truncated = set()
+        self.ranges = True
+        # (name, headers) of every request
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def requested(self, name):
+        return [headers for request_name, headers in self.requests if request_name == name]
+
+
+class ServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RepoServer()
+        self.server.thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.decks_path = os.path.join(self.directory, 'decks')
+        self.manager = download.DownloadManager(os.path.join(self.directory, 'cache'), self.server.url,
+                                                timeout=(5, 5))
+        self.addCleanup(self.manager.close)
+
+    def read_deck(self, file_name):
+        with open(os.path.join(self.decks_path, file_name), 'rb') as file:
+            return file.read()
+
+
+class ConditionalGetTest(ServerTestCase):
+    """
+    Decks of a repository without a manifest, fetched with the validators of the last response.
+    """
+
+    def download(self, deck_name='kanji'):
+        results = self.manager.download_decks([deck_name], self.decks_path)
+        self.assertEqual(len(results), 1)
+        return results[0]
+
+    def test_unchanged_deck_is_not_modified(self):
+        self.server.files['kanji.yaml'] = (b"decks: []\n", '"v1"')
+        first = self.download()
+        self.assertIsNone(first.error)
+        self.assertTrue(first.changed)
+        self.assertEqual(self.read_deck('kanji.yaml'), b"decks: []\n")
+
+        second = self.download()
+        self.assertIsNone(second.error)
+        self.assertFalse(second.changed)
+        self.assertEqual(self.read_deck('kanji.yaml'), b"decks: []\n")
+        requests = self.server.requested('kanji.yaml')
+        self.assertIsNone(requests[0].get('If-None-Match'))
+        self.assertEqual(requests[1].get('If-None-Match'), '"v1"')
+
+    def test_validators_survive_a_new_manager(self):
+        self.server.files['kanji.yaml'] = (b"decks: []\n", '"v1"')
+        self.download()
+        self.manager.close()
+        self.manager = download.DownloadManager(self.manager.cache_dir, self.server.url, timeout=(5, 5))
+        self.assertFalse(self.download().changed)
+
+    def test_stale_etag_gets_the_new_deck(self):
+        self.server.files['kanji.yaml'] = (b"old\n", '"v1"')
+        self.download()
+        self.server.files['kanji.yaml'] = (b"new\n", '"v2"')
+        result = self.download()
+        self.assertIsNone(result.error)
+        self.assertTrue(result.changed)
+        self.assertEqual(self.read_deck('kanji.yaml'), b"new\n")
+        # The next request carries the new ETag
+        self.assertFalse(self.download().changed)
+        self.assertEqual(self.server.requested('kanji.yaml')[-1].get('If-None-Match'), '"v2"')
+
+    def test_validators_are_not_sent_without_a_local_copy(self):
+        self.server.files['kanji.yaml'] = (b"decks: []\n", '"v1"')
+        self.download()
+        os.remove(os.path.join(self.decks_path, 'kanji.yaml'))
+        result = self.download()
+        self.assertTrue(result.changed)
+        self.assertIsNone(self.server.requested('kanji.yaml')[-1].get('If-None-Match'))
+        self.assertEqual(self.read_deck('kanji.yaml'), b"decks: []\n")
+
+    def test_failed_download_keeps_the_previous_deck(self):
+        self.server.files['kanji.yaml'] = (b"old\n", '"v1"')
+        self.download()
+        self.server.files['kanji.yaml'] = (b"new\n", '"v2"')
+        self.server.failing.add('kanji.yaml')
+        result = self.download()
+        self.assertIsNotNone(result.error)
+        self.assertFalse(result.changed)
+        self.assertEqual(self.read_deck('kanji.yaml'), b"old\n")
+        # The old validators still describe the local copy
+        self.server.failing.clear()
+        self.server.files['kanji.yaml'] = (b"old\n", '"v1"')
+        self.assertFalse(self.download().changed)
+
+    def test_partial_download_keeps_the_previous_deck(self):
+        self.server.files['kanji.yaml'] = (b"old\n", '"v1"')
+        self.download()
+        self.server.files['kanji.yaml'] = (b"new " * 4096, '"v2"')
+        self.server.truncated.add('kanji.yaml')
+        result = self.download()
+        self.assertIsNotNone(result.error)
+        self.assertEqual(self.read_deck('kanji.yaml'), b"old\n")
+        self.assertEqual(os.listdir(self.decks_path), ['kanji.yaml'])
+
+
+
+class ManifestSyncTest(ServerTestCase):
+    """
+    Decks of a repository with a manifest of their hashes, see download.build_manifest.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.repo_path = os.path.join(self.directory, 'repo')
+        os.makedirs(self.repo_path)
+
+    def publish(self, decks, compress=True):
+        """
+        Write decks into the repository, rebuild its manifest and serve it. Returns the manifest.
+        """
+        for deck_name, content in decks.items():
+            with open(os.path.join(self.repo_path, f"{deck_name}.yaml"), 'wb') as file:
+                file.write(content)
+        manifest = download.build_manifest(self.repo_path, compress)
+        self.server.files.clear()
+        for file_name in os.listdir(self.repo_path):
+            with open(os.path.join(self.repo_path, file_name), 'rb') as file:
+                content = file.read()
+            self.server.files[file_name] = (content, f'"{hashlib.sha256(content).hexdigest()}"')
+        return manifest
+
+    def remote_name(self, entry):
+        return entry.get('gzip') or entry['file']
+
+    def deck_requests(self):
+        return [name for name, _ in self.server.requests if name != download.INDEX_CACHE_FILE]
+
+    def install(self, *deck_names):
+        self.manager.fetch_repository(force=True)
+        results = self.manager.download_decks(list(deck_names), self.decks_path)
+        self.assertEqual([result.error for result in results], [None] * len(deck_names))
+        self.server.requests.clear()
+
+    def test_unchanged_manifest_downloads_nothing(self):
+        self.publish({'kanji': b"kanji\n" * 100, 'kana': b"kana\n" * 100})
+        self.install('kanji', 'kana')
+        results = self.manager.sync(self.decks_path)
+        self.assertEqual([(result.deck_name, result.changed, result.error) for result in results],
+                         [('kana', False, None), ('kanji', False, None)])
+        self.assertEqual(self.deck_requests(), [])
+        # A touched deck is hashed again and still matches
+        deck_path = os.path.join(self.decks_path, 'kanji.yaml')
+        os.utime(deck_path, ns=(0, 0))
+        self.assertFalse(any(result.changed for result in self.manager.sync(self.decks_path)))
+        self.assertEqual(self.deck_requests(), [])
+
+    def test_changed_deck_is_the_only_one_downloaded(self):
+        self.publish({'kanji': b"kanji\n" * 100, 'kana': b"kana\n" * 100})
+        self.install('kanji', 'kana')
+        manifest = self.publish({'kanji': b"new kanji\n" * 100})
+        results = {result.deck_name: result for result in self.manager.sync(self.decks_path)}
+        self.assertTrue(results['kanji'].changed)
+        self.assertFalse(results['kana'].changed)
+        self.assertEqual(self.deck_requests(), [self.remote_name(manifest['kanji'])])
+        self.assertEqual(self.read_deck('kanji.yaml'), b"new kanji\n" * 100)
+
+    def test_truncated_part_is_resumed_with_a_range(self):
+        content = os.urandom(1 << 17).hex().encode('ascii')
+        manifest = self.publish({'kanji': content})
+        entry = manifest['kanji']
+        remote_name = self.remote_name(entry)
+        remote = self.server.files[remote_name][0]
+        self.manager.fetch_repository(force=True)
+        part_path = self.manager.partial_path('kanji', entry['sha256'], remote_name)
+        half = len(remote) // 2
+        with open(part_path, 'wb') as file:
+            file.write(remote[:half])
+
+        results = self.manager.download_decks(['kanji'], self.decks_path)
+        self.assertIsNone(results[0].error)
+        self.assertTrue(results[0].changed)
+        self.assertEqual(self.read_deck('kanji.yaml'), content)
+        deck_requests = [headers for name, headers in self.server.requests if name == remote_name]
+        self.assertEqual([headers.get('Range') for headers in deck_requests], [f"bytes={half}-"])
+        self.assertFalse(os.path.exists(part_path))
+
+    def test_part_is_replaced_when_the_server_ignores_ranges(self):
+        content = b"kanji\n" * 1000
+        manifest = self.publish({'kanji': content}, compress=False)
+        self.server.ranges = False
+        self.manager.fetch_repository(force=True)
+        part_path = self.manager.partial_path('kanji', manifest['kanji']['sha256'], 'kanji.yaml')
+        with open(part_path, 'wb') as file:
+            file.write(content[:100])
+        results = self.manager.download_decks(['kanji'], self.decks_path)
+        self.assertIsNone(results[0].error)
+        self.assertEqual(self.read_deck('kanji.yaml'), content)
+
+    def test_part_longer_than_the_deck_starts_over(self):
+        content = b"kanji\n" * 1000
+        manifest = self.publish({'kanji': content}, compress=False)
+        self.manager.fetch_repository(force=True)
+        part_path = self.manager.partial_path('kanji', manifest['kanji']['sha256'], 'kanji.yaml')
+        with open(part_path, 'wb') as file:
+            file.write(content + b"junk")
+        results = self.manager.download_decks(['kanji'], self.decks_path)
+        self.assertIsNone(results[0].error)
+        self.assertEqual(self.read_deck('kanji.yaml'), content)
+
+    def test_hash_mismatch_is_rejected(self):
+        self.publish({'kanji': b"kanji\n" * 100}, compress=False)
+        self.install('kanji')
+        self.publish({'kanji': b"new kanji\n" * 100}, compress=False)
+        # The server sends other content than its manifest describes
+        self.server.files['kanji.yaml'] = (b"tampered\n" * 100, None)
+        results = self.manager.sync(self.decks_path)
+        self.assertEqual(len(results), 1)
+        self.assertIsNotNone(results[0].error)
+        self.assertFalse(results[0].changed)
+        self.assertEqual(self.read_deck('kanji.yaml'), b"kanji\n" * 100)
+        # Neither the download nor its unpacked copy is kept
+        self.assertEqual(os.listdir(self.decks_path), ['kanji.yaml'])
+        self.assertEqual(os.listdir(self.manager.partial_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+# Locals
+import reviewlog
+from reviewlog import REVEALED, SHOWN
+
+
+class CrashingReviewLog(reviewlog.ReviewLog):
+    """
+    A review log whose process dies after a compaction commits the summary, before the log is replaced.
+    """
+
+    def write_log(self, generation, tail=b''):
+        if generation > 1:
+            raise OSError("crashed")
+        super().write_log(generation, tail)
+
+
+class ReviewLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.log_path = os.path.join(self.directory, reviewlog.LOG_FILE)
+        self.log = None
+
+    def open(self, log_class=reviewlog.ReviewLog, compact_records=reviewlog.COMPACT_RECORDS):
+        self.close()
+        self.log = log_class(self.directory, compact_records)
+        self.addCleanup(self.log.close)
+        # Past the repair and the compaction of the writer thread's start
+        self.assertTrue(self.log.flush(timeout=10))
+        return self.log
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+
+    def record(self, *events):
+        for card_id, deck_name, event in events:
+            self.log.record(card_id, deck_name, event, timestamp=1000.0 + card_id)
+        self.assertTrue(self.log.flush(timeout=10))
+
+    def log_records(self):
+        return (os.path.getsize(self.log_path) - reviewlog.HEADER.size) // reviewlog.RECORD_SIZE
+
+    def summary(self, query):
+        db = sqlite3.connect(os.path.join(self.directory, reviewlog.SUMMARY_FILE))
+        try:
+            return db.execute(query).fetchall()
+        finally:
+            db.close()
+
+    def test_records_survive_reopening(self):
+        self.open()
+        self.record((1, 'Kanji', SHOWN), (1, 'Kanji', REVEALED), (2, 'Kana', SHOWN))
+        self.open()
+        self.assertEqual(self.log.card_counts(SHOWN), {(1, 'Kanji'): 1, (2, 'Kana'): 1})
+        self.assertEqual(self.log.card_counts(REVEALED), {(1, 'Kanji'): 1})
+
+    def test_torn_final_record_is_cut_off(self):
+        self.open()
+        self.record((1, 'Kanji', SHOWN), (2, 'Kanji', SHOWN), (3, 'Kanji', SHOWN))
+        self.close()
+        record = reviewlog.pack_record(4, 1004.0, 1, SHOWN)
+        with open(self.log_path, 'ab') as file:
+            file.write(record[:reviewlog.RECORD_SIZE // 2])
+        self.open()
+        self.assertEqual(self.log.card_counts(SHOWN), {(1, 'Kanji'): 1, (2, 'Kanji'): 1, (3, 'Kanji'): 1})
+        self.assertEqual(os.path.getsize(self.log_path), reviewlog.HEADER.size + 3 * reviewlog.RECORD_SIZE)
+        # Appends carry on from the last whole record
+        self.record((5, 'Kanji', SHOWN))
+        self.open()
+        self.assertEqual(len(self.log.card_counts(SHOWN)), 4)
+
+    def test_whole_records_that_fail_their_crc_at_the_end_are_cut_off(self):
+        self.open()
+        self.record((1, 'Kanji', SHOWN), (2, 'Kanji', SHOWN))
+        self.close()
+        with open(self.log_path, 'ab') as file:
+            file.write(bytes(reviewlog.RECORD_SIZE))
+        self.open()
+        self.assertEqual(self.log_records(), 2)
+        self.assertEqual(self.log.card_counts(SHOWN), {(1, 'Kanji'): 1, (2, 'Kanji'): 1})
+
+    def test_damaged_record_in_the_middle_is_skipped(self):
+        self.open()
+        self.record(*((card_id, 'Kanji', SHOWN) for card_id in range(1, 6)))
+        self.close()
+        with open(self.log_path, 'r+b') as file:
+            # Flip a byte of the card id of the second record
+            offset = reviewlog.HEADER.size + reviewlog.RECORD_SIZE
+            file.seek(offset)
+            byte = file.read(1)
+            file.seek(offset)
+            file.write(bytes([byte[0] ^ 0xff]))
+        self.open()
+        counts = self.log.card_counts(SHOWN)
+        self.assertEqual(sorted(card_id for card_id, _ in counts), [1, 3, 4, 5])
+        self.assertEqual(self.log_records(), 5)
+        # Folding skips it too
+        self.open(compact_records=1)
+        self.assertEqual(self.log_records(), 0)
+        self.assertEqual(sorted(card_id for card_id, _ in self.log.card_counts(SHOWN)), [1, 3, 4, 5])
+
+    def test_compaction_folds_and_rotates_the_log(self):
+        self.open(compact_records=4)
+        self.record((1, 'Kanji', SHOWN), (1, 'Kanji', SHOWN), (2, 'Kanji', REVEALED), (3, 'Kana', SHOWN))
+        self.assertEqual(self.log_records(), 0)
+        self.assertEqual(self.summary("SELECT value FROM meta WHERE key = 'generation'"), [(1,)])
+        self.assertEqual(self.summary("SELECT count, last_seen FROM card_events WHERE card_id = 1"), [(2, 1001.0)])
+        self.record((1, 'Kanji', SHOWN), (3, 'Kana', REVEALED))
+        self.assertEqual(self.log_records(), 2)
+        self.assertEqual(self.log.card_counts(SHOWN), {(1, 'Kanji'): 3, (3, 'Kana'): 1})
+        self.open()
+        self.assertEqual(self.log.card_counts(SHOWN), {(1, 'Kanji'): 3, (3, 'Kana'): 1})
+
+    def test_crash_between_fold_and_rotation_counts_records_once(self):
+        self.open(CrashingReviewLog, compact_records=3)
+        for card_id in (1, 1, 2):
+            self.log.record(card_id, 'Kanji', SHOWN, timestamp=1000.0)
+        # The writer thread dies in the compaction
+        self.log.thread.join(timeout=10)
+        self.assertFalse(self.log.thread.is_alive())
+        self.assertEqual(self.summary("SELECT SUM(count) FROM card_events"), [(3,)])
+        self.assertEqual(self.log_records(), 3)
+        # A record written after the fold, before the crash
+        with open(self.log_path, 'ab') as file:
+            file.write(reviewlog.pack_record(3, 1001.0, 1, SHOWN))
+
+        self.open()
+        self.assertEqual(self.log.card_counts(SHOWN), {(1, 'Kanji'): 2, (2, 'Kanji'): 1, (3, 'Kanji'): 1})
+        # The log was replaced by one holding only the record that wasn't folded
+        self.assertEqual(self.log_records(), 1)
+        self.open(compact_records=1)
+        self.assertEqual(self.log.card_counts(SHOWN), {(1, 'Kanji'): 2, (2, 'Kanji'): 1, (3, 'Kanji'): 1})
+        self.assertEqual(self.summary("SELECT SUM(count) FROM card_events"), [(4,)])
+
+    def test_queries_add_the_log_to_the_summary(self):
+        self.open(compact_records=5)
+        self.record(
+            (1, 'Kanji', SHOWN), (1, 'Kanji', REVEALED), (2, 'Kanji', SHOWN), (2, 'Kanji', REVEALED),
+            (2, 'Kanji', REVEALED),
+        )
+        self.assertEqual(self.log_records(), 0)
+        self.record((3, 'Kana', SHOWN), (3, 'Kana', REVEALED), (1, 'Kanji', REVEALED), (1, 'Kanji', REVEALED))
+        self.assertEqual(self.log.most_revealed(), [(1, 'Kanji', 3), (2, 'Kanji', 2), (3, 'Kana', 1)])
+        self.assertEqual(self.log.most_revealed(limit=1), [(1, 'Kanji', 3)])
+        self.assertEqual(self.log.deck_counts(), {
+            'Kanji': {'shown': 2, 'revealed': 5},
+            'Kana': {'shown': 1, 'revealed': 1},
+        })
+
+    def test_empty_log(self):
+        self.open()
+        self.assertEqual(self.log.most_revealed(), [])
+        self.assertEqual(self.log.deck_counts(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
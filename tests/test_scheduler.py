@@ -0,0 +1,189 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+# Locals
+import cardstore
+import scheduler
+from scheduler import DAY, ReviewState
+
+
+def new_state():
+    card = cardstore.Card('口', 'くち')
+    return ReviewState(card.card_id(), 'Kanji', card)
+
+
+class ReviewStateTest(unittest.TestCase):
+    """
+    SM-2: intervals of 1 and 6 days, then the last one times the ease, and
+    EF' = EF + (0.1 - (5 - q) * (0.08 + (5 - q) * 0.02)) with a floor of 1.3.
+    """
+
+    def test_ease_change_for_each_grade(self):
+        expected = {5: 2.6, 4: 2.5, 3: 2.36, 2: 2.18, 1: 1.96, 0: 1.7}
+        for grade, ease in expected.items():
+            with self.subTest(grade=grade):
+                state = new_state()
+                state.apply(grade, 0.0)
+                self.assertAlmostEqual(state.ease, ease)
+
+    def test_intervals_of_perfect_answers(self):
+        state = new_state()
+        intervals = []
+        eases = []
+        for review in range(4):
+            state.apply(5, 0.0)
+            intervals.append(state.interval)
+            eases.append(round(state.ease, 2))
+        # The third interval is 6 days times the ease after the second review
+        self.assertEqual(intervals, [1.0, 6.0, 16.2, 45.36])
+        self.assertEqual(eases, [2.6, 2.7, 2.8, 2.9])
+        self.assertEqual(state.repetitions, 4)
+
+    def test_intervals_of_good_answers(self):
+        state = new_state()
+        intervals = []
+        for review in range(4):
+            now = review * 100.0
+            state.apply(4, now)
+            intervals.append(state.interval)
+            self.assertEqual(state.due, now + state.interval * DAY)
+            self.assertEqual(state.last_review, now)
+        self.assertEqual(intervals, [1.0, 6.0, 15.0, 37.5])
+        self.assertAlmostEqual(state.ease, 2.5)
+
+    def test_hard_answers_lower_the_ease(self):
+        state = new_state()
+        for _ in range(3):
+            state.apply(3, 0.0)
+        self.assertEqual(state.interval, round(6.0 * 2.22, 2))
+        self.assertAlmostEqual(state.ease, 2.08)
+
+    def test_failed_answers_start_over(self):
+        for grade in (0, 1, 2):
+            with self.subTest(grade=grade):
+                state = new_state()
+                for _ in range(3):
+                    state.apply(4, 0.0)
+                state.apply(grade, 1000.0)
+                self.assertEqual(state.repetitions, 0)
+                self.assertEqual(state.lapses, 1)
+                self.assertEqual(state.interval, 0.0)
+                self.assertEqual(state.due, 1000.0 + scheduler.RELEARN_DELAY)
+                # The intervals start again from the first one
+                state.apply(4, 2000.0)
+                self.assertEqual(state.interval, 1.0)
+                state.apply(4, 2000.0)
+                self.assertEqual(state.interval, 6.0)
+
+    def test_ease_floor(self):
+        for grade in (0, 3):
+            with self.subTest(grade=grade):
+                state = new_state()
+                for _ in range(20):
+                    state.apply(grade, 0.0)
+                    self.assertGreaterEqual(state.ease, scheduler.MIN_EASE)
+                self.assertEqual(state.ease, scheduler.MIN_EASE)
+        state = new_state()
+        state.ease = scheduler.MIN_EASE
+        state.apply(5, 0.0)
+        self.assertAlmostEqual(state.ease, scheduler.MIN_EASE + 0.1)
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.db_path = os.path.join(self.directory, 'reviews.db')
+        # Small batches so a few cards cross several batch boundaries
+        patcher = mock.patch.object(scheduler, 'LOAD_BATCH', 4)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def open(self, states=()):
+        """
+        Open a scheduler on a database holding `states`, none of them loaded yet.
+        """
+        writer = scheduler.Scheduler(self.db_path)
+        with writer.db:
+            writer.db.executemany(
+                f"INSERT OR REPLACE INTO reviews ({scheduler.COLUMNS}) VALUES ({', '.join('?' * 11)})",
+                [state.to_row() for state in states],
+            )
+        writer.close()
+        opened = scheduler.Scheduler(self.db_path)
+        self.addCleanup(opened.close)
+        return opened
+
+    def make_states(self, dues, deck='Kanji'):
+        states = []
+        for number, due in enumerate(dues):
+            card = cardstore.Card(f'q{deck}{number}', 'a')
+            states.append(ReviewState(card.card_id(), deck, card, due=due, interval=1.0, repetitions=1))
+        return states
+
+    def drain(self, opened, deck_names, now):
+        """
+        Take due cards until none is left, answering each so it leaves the queue. Returns their card ids.
+        """
+        taken = []
+        while True:
+            due = opened.next_due(deck_names, now)
+            if due is None:
+                return taken
+            deck_name, card = due
+            taken.append(card.card_id())
+            opened.review(deck_name, card, scheduler.GOOD, now)
+
+    def test_due_cards_across_batches_come_in_due_order(self):
+        # Ties on the due time straddle the batch boundaries
+        dues = [100.0] * 6 + [200.0, 300.0, 300.0, 300.0, 400.0] + [5000.0] * 3
+        states = self.make_states(dues)
+        opened = self.open(states)
+        expected = [state.card_id for state in sorted(states, key=lambda state: (state.due, state.card_id))]
+        self.assertEqual(self.drain(opened, ['Kanji'], 1000.0), expected[:11])
+        # Not due yet, then due once time passes
+        self.assertEqual(self.drain(opened, ['Kanji'], 4999.0), [])
+        self.assertEqual(self.drain(opened, ['Kanji'], 5000.0), expected[11:])
+
+    def test_only_due_entries_are_loaded(self):
+        states = self.make_states([float(due) for due in range(10)] + [10.0 ** 9] * 20)
+        opened = self.open(states)
+        self.assertIsNotNone(opened.next_due(['Kanji'], 9.0))
+        self.assertEqual(len(opened.entries), 10)
+
+    def test_due_cards_of_several_decks(self):
+        kanji = self.make_states([10.0, 30.0, 50.0, 70.0, 90.0], 'Kanji')
+        kana = self.make_states([20.0, 40.0, 60.0, 80.0, 100.0, 2000.0], 'Kana')
+        other = self.make_states([5.0], 'Other')
+        opened = self.open(kanji + kana + other)
+        taken = self.drain(opened, ['Kanji', 'Kana'], 1000.0)
+        expected = sorted(kanji + kana[:5], key=lambda state: state.due)
+        self.assertEqual(taken, [state.card_id for state in expected])
+
+    def test_failed_card_comes_back_after_the_relearn_delay(self):
+        states = self.make_states([100.0])
+        opened = self.open(states)
+        deck_name, card = opened.next_due(['Kanji'], 1000.0)
+        opened.review(deck_name, card, scheduler.AGAIN, 1000.0)
+        self.assertIsNone(opened.next_due(['Kanji'], 1000.0))
+        self.assertEqual(opened.next_due(['Kanji'], 1000.0 + scheduler.RELEARN_DELAY), (deck_name, card))
+
+    def test_reviews_persist(self):
+        opened = scheduler.Scheduler(self.db_path)
+        card = cardstore.Card('口', 'くち')
+        opened.review('Kanji', card, scheduler.GOOD, 0.0)
+        opened.close()
+        reopened = scheduler.Scheduler(self.db_path)
+        self.addCleanup(reopened.close)
+        state = reopened.get_state(card.card_id())
+        self.assertEqual((state.repetitions, state.interval, state.due), (1, 1.0, DAY))
+        self.assertFalse(reopened.is_due(card, DAY - 1))
+        self.assertTrue(reopened.is_due(card, DAY))
+
+
+if __name__ == '__main__':
+    unittest.main()
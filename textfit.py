@@ -0,0 +1,68 @@
+import collections
+
+from PySide6.QtCore import QRect, Qt
+from PySide6.QtGui import QFontMetrics
+
+# Locals
+import metrics
+
+# Smallest point size text is shrunk to, below this it is unreadable anyway
+MIN_POINT_SIZE = 6
+# Number of (text, font, box) fits remembered
+CACHE_SIZE = 512
+
+
+class TextFitter:
+    """
+    Finds the largest font point size at which a text fits a box when word wrapped.
+    Sizes are binary searched with QFontMetrics and the results kept in an LRU cache,
+    so showing the same card or going back to a window size costs a dict lookup.
+    """
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+
+    def fits(self, text, font, point_size, width, height):
+        font.setPointSize(point_size)
+        rect = QFontMetrics(font).boundingRect(QRect(0, 0, width, height), Qt.AlignCenter | Qt.TextWordWrap, text)
+        return rect.width() <= width and rect.height() <= height
+
+    def fit(self, text, font, width, height, max_size, min_size=MIN_POINT_SIZE):
+        """
+        Get the largest point size up to `max_size` at which `text` in the family of `font`
+        fits in `width` x `height`. Returns `min_size` if it doesn't fit even at that size.
+        """
+        max_size = max(int(max_size), min_size)
+        key = (text, font.family(), width, height, max_size)
+        size = self.cache.get(key)
+        if size is not None:
+            self.cache.move_to_end(key)
+            metrics.count('textfit.hit')
+            return size
+        metrics.count('textfit.miss')
+
+        # Measure on a copy, the caller's font is left alone
+        font = type(font)(font)
+        if width <= 0 or height <= 0:
+            size = min_size
+        elif self.fits(text, font, max_size, width, height):
+            size = max_size
+        else:
+            low, high = min_size, max_size - 1
+            size = min_size
+            while low <= high:
+                middle = (low + high) // 2
+                if self.fits(text, font, middle, width, height):
+                    size = middle
+                    low = middle + 1
+                else:
+                    high = middle - 1
+
+        self.cache[key] = size
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return size
+
+    def clear(self):
+        self.cache.clear()
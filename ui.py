@@ -1,9 +1,10 @@
-import random
+import collections
 import os
 import sys
+import time
 from PySide6.QtWidgets import (
-    QTableWidget,
-    QTableWidgetItem,
+    QTableView,
+    QAbstractItemView,
     QCheckBox,
     QHeaderView,
     QApplication,
@@ -17,50 +18,169 @@ from PySide6.QtWidgets import (
     QFormLayout,
     QDialogButtonBox,
     QSlider,
+    QComboBox,
     QColorDialog,
     QProgressBar,
     QInputDialog,
     QFileDialog,
     QMessageBox,
+    QLineEdit,
+    QListWidget,
 )
-import requests
-import yaml
-from PySide6.QtCore import QTimer, QTime, Qt, QPoint
-from PySide6.QtGui import QIcon, QMouseEvent, QPixmap, QColor, QFontMetrics
+from PySide6.QtCore import QObject, QTimer, QTime, Qt, QPoint, Signal
+from PySide6.QtGui import QGuiApplication, QMouseEvent, QColor, QKeySequence, QShortcut
 
 # Locals
+import cardstore
 import config as conf
 import deck
+import deckmodel
+import download
+import images
+import metrics
+import reviewlog
+import scheduler
+import search
+import textfit
+import watcher
+import workers
+
+# Minimum time between refits of the text while resizing
+RESIZE_THROTTLE_MS = 30
+# Room left between the text and the edges of its box
+TEXT_BOX_MARGIN = 4
+# Button icons are decoded at this size, enough for the 16 px buttons on 2x displays
+ICON_SIZE = 32
+# How one side of a card is shown, worked out before it is needed. `box` is the text box it was fitted to,
+# `image` and `pixmap` are set for an image side, `text` and `point_size` otherwise
+SideLayout = collections.namedtuple('SideLayout', ['box', 'text', 'point_size', 'image', 'pixmap', 'tooltip'])
+# Event loop lag is sampled with a timer of this interval when metrics are enabled
+LAG_INTERVAL_MS = 100
+# Refresh interval of the stats overlay
+OVERLAY_INTERVAL_MS = 1000
+METRICS_FILE = 'metrics.json'
+# Searching waits until typing pauses this long
+SEARCH_DELAY_MS = 150
+# Most search results listed at once
+SEARCH_LIMIT = 200
+# Config section of the first card window, windows opened later get sections of their own
+MAIN_SECTION = 'UI'
+# Config section listing the sections of the card windows that are open
+WINDOWS_SECTION = 'Windows'
+# Windows opened from another one are placed this far from it
+NEW_WINDOW_OFFSET = 30
+DEFAULT_WINDOW_SIZE = 200
 
 
 def resource_path(relative_path):
     if hasattr(sys, '_MEIPASS'):
         return os.path.join(sys._MEIPASS, relative_path)
-    return os.path.join(os.path.abspath("."), relative_path)
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), relative_path)
+
+
+def make_deck_view(proxy, parent=None):
+    """
+    Create a sortable table view for a deckmodel proxy, listed in model order until a header is clicked.
+    """
+    view = QTableView(parent)
+    view.setModel(proxy)
+    view.setSelectionBehavior(QAbstractItemView.SelectRows)
+    view.verticalHeader().hide()
+    header = view.horizontalHeader()
+    header.setSectionResizeMode(QHeaderView.ResizeToContents)
+    header.setSectionResizeMode(deckmodel.NAME_COLUMN, QHeaderView.Stretch)
+    header.setSortIndicator(-1, Qt.AscendingOrder)
+    view.setSortingEnabled(True)
+    return view
+
+
+def fetch_repository(worker):
+    return download.get_manager().fetch_repository()
+
+
+def download_decks(worker, deck_names, decks_path, cache_dir):
+    """
+    Download decks and parse the changed ones, sending (file path, decks, stat) chunks.
+    """
+    results = download.get_manager().download_decks(
+        deck_names, decks_path, progress=worker.report_progress, cancelled=lambda: worker.cancelled
+    )
+    return parse_downloaded_decks(worker, results, cache_dir)
+
+
+def sync_decks(worker, decks_path, cache_dir):
+    """
+    Update the downloaded decks that changed in the online repository, sending chunks like download_decks.
+    """
+    results = download.get_manager().sync(
+        decks_path, progress=worker.report_progress, cancelled=lambda: worker.cancelled
+    )
+    return parse_downloaded_decks(worker, results, cache_dir)
+
+
+def parse_downloaded_decks(worker, results, cache_dir):
+    for index, result in enumerate(results):
+        if result.error or not result.changed or worker.cancelled:
+            continue
+        try:
+            stat = os.stat(result.file_path)
+            decks = deck.validate_deck_data(deck.read_deck_file(result.file_path, cache_dir))
+            worker.emit_chunk((result.file_path, decks, stat))
+        except Exception as e:
+            results[index] = result._replace(error=str(e))
+    return results
+
+
+def build_search_index(worker, snapshots, saved_path):
+    """
+    Index the cards of the decks in `snapshots`, see deck.Collection.search_snapshots.
+    """
+    return search.build_deck_indexes(
+        snapshots, saved_path, progress=worker.report_progress, cancelled=lambda: worker.cancelled
+    )
 
 
 class DeckSelectionDialog(QDialog):
-    def __init__(self, collection, parent=None):
+    def __init__(self, collection, config, parent=None, section=MAIN_SECTION):
         super().__init__(parent)
         self.setWindowTitle("Select Items")
         self.collection = collection
+        self.config = config
         self.setFixedSize(400, 500)  # Set fixed size for the dialog
 
         self.layout = QVBoxLayout(self)
 
-        # Create the table widget
-        self.table = QTableWidget(self)
-        self.table.setColumnCount(2)  # Two columns: one for checkbox and one for item name
-        self.table.setHorizontalHeaderLabels(["Select", "Deck Name"])
-        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
-
-        # Add example items to the table
-        config = conf.read_config(conf.get_config_path())
-        self.selected_decks = config.get('UI', 'selected_decks', fallback='').split(',')
+        # Filters the decks by name and searches the cards of every deck
+        self.search_box = QLineEdit(self)
+        self.search_box.setPlaceholderText("Search decks and cards")
+        self.search_box.setClearButtonEnabled(True)
+        self.search_box.textChanged.connect(self.on_search_changed)
+        self.layout.addWidget(self.search_box)
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(SEARCH_DELAY_MS)
+        self.search_timer.timeout.connect(self.run_search)
+
+        # Config section of the window whose decks are selected
+        self.section = section
+        # Decks with their card counts, checked ones are selected
+        self.selected_decks = config.get(section, 'selected_decks', fallback='').split(',')
+        self.model = deckmodel.DeckTableModel(collection.get_decks(), self.selected_decks, collection.count, self)
+        self.proxy = deckmodel.make_proxy(self.model, self)
+        self.table = make_deck_view(self.proxy, self)
+        self.layout.addWidget(self.table)
 
-        self.populate_table()
+        self.search_results = QListWidget(self)
+        self.search_results.setVisible(False)
+        self.layout.addWidget(self.search_results)
+        # Indexes the decks in the background when a search needs it
+        self.index_task = None
 
-        self.layout.addWidget(self.table)
+        # Pick up decks added or removed while the dialog is open
+        self.refresh_pending = False
+        self.changed_decks = set()
+        self.collection.add_listener(self.on_deck_changed)
+        self.config.add_listener(self.on_config_changed)
 
         # Button to access online repository
         self.online_repo_button = QPushButton("Online Repository", self)
@@ -68,42 +188,154 @@ class DeckSelectionDialog(QDialog):
 
         self.layout.addWidget(self.online_repo_button)
 
+        # Button to update the downloaded decks
+        self.sync_button = QPushButton("Update Downloaded Decks", self)
+        self.sync_button.clicked.connect(self.sync_online_decks)
+        self.layout.addWidget(self.sync_button)
+
+        # Progress of network tasks, which run in the background
+        self.task = None
+        self.progress_bar = QProgressBar(self)
+        self.stop_button = QPushButton("Stop", self)
+        self.stop_button.clicked.connect(self.cancel_task)
+        progress_layout = QHBoxLayout()
+        progress_layout.addWidget(self.progress_bar)
+        progress_layout.addWidget(self.stop_button)
+        self.layout.addLayout(progress_layout)
+        self.set_busy(False)
+
         # OK and Cancel buttons
         self.button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
         self.button_box.accepted.connect(self.accept)
         self.button_box.rejected.connect(self.reject)
         self.layout.addWidget(self.button_box)
 
+    def set_busy(self, busy):
+        self.progress_bar.setVisible(busy)
+        self.stop_button.setVisible(busy)
+        self.online_repo_button.setEnabled(not busy)
+        self.sync_button.setEnabled(not busy)
+        if busy:
+            # Busy indicator until the first progress report
+            self.progress_bar.setRange(0, 0)
+
+    def run_task(self, fn, *args, on_result=None, on_chunk=None, error_prefix="Error"):
+        self.task = workers.Worker(fn, *args)
+        self.task.signals.progress.connect(self.on_task_progress)
+        if on_chunk is not None:
+            self.task.signals.chunk.connect(on_chunk)
+        if on_result is not None:
+            self.task.signals.result.connect(on_result)
+        self.task.signals.error.connect(lambda message: self.show_error_message(f"{error_prefix}: {message}"))
+        self.task.signals.finished.connect(self.on_task_finished)
+        self.set_busy(True)
+        self.task.start()
+
+    def on_task_progress(self, done, total):
+        self.progress_bar.setRange(0, total)
+        self.progress_bar.setValue(done)
+
+    def on_task_finished(self):
+        self.task = None
+        self.set_busy(False)
+
+    def cancel_task(self):
+        if self.task is not None:
+            self.task.cancel()
+
     def populate_table(self):
+        self.model.set_decks(self.collection.get_decks())
+
+    def on_search_changed(self, text):
+        self.proxy.setFilterFixedString(text.strip())
+        if text.strip():
+            self.search_timer.start()
+        else:
+            self.search_timer.stop()
+            self.search_results.setVisible(False)
+
+    def run_search(self):
+        query = self.search_box.text()
+        if not query.strip():
+            return
+        self.search_results.clear()
+        if self.collection.outdated_search_decks():
+            self.index_decks()
+            self.search_results.addItem("Indexing cards...")
+            self.search_results.setVisible(True)
+            return
+        results = self.collection.search(query, SEARCH_LIMIT)
+        for deck_name, card in results:
+            self.search_results.addItem(f"{card.question} — {card.answer}   [{deck_name}]")
+        if not results:
+            self.search_results.addItem("No cards found")
+        self.search_results.setVisible(True)
+
+    def index_decks(self):
+        if self.index_task is not None:
+            return
+        task = self.index_task = workers.Worker(build_search_index, *self.collection.search_snapshots())
+        task.signals.result.connect(self.on_decks_indexed)
+        task.signals.error.connect(lambda message: self.show_error_message(f"Failed to index cards: {message}"))
+        task.signals.finished.connect(lambda: self.on_index_finished(task))
+        task.start()
+
+    def on_decks_indexed(self, deck_indexes):
+        self.index_task = None
+        self.collection.add_search_indexes(deck_indexes)
+        # Decks that changed while indexing are indexed again
+        if self.search_results.isVisible():
+            self.run_search()
+
+    def on_index_finished(self, task):
+        if self.index_task is task:
+            self.index_task = None
+
+    def on_deck_changed(self, deck_name):
+        # One refresh for a whole batch of changed decks
+        self.changed_decks.add(deck_name)
+        if not self.refresh_pending:
+            self.refresh_pending = True
+            QTimer.singleShot(0, self.refresh_table)
+
+    def on_config_changed(self, section, key, value):
+        if section == self.section and key == 'selected_decks':
+            self.selected_decks = value.split(',')
+            self.model.set_checked(self.selected_decks)
+
+    def refresh_table(self):
+        self.refresh_pending = False
+        changed_decks, self.changed_decks = self.changed_decks, set()
         deck_names = self.collection.get_decks()
-        self.table.setRowCount(len(deck_names))
-        for row, deck_name in enumerate(deck_names):
-            checkbox = QCheckBox()
-            if deck_name in self.selected_decks:
-                checkbox.setChecked(True)
-            self.table.setCellWidget(row, 0, checkbox)
-            self.table.setItem(row, 1, QTableWidgetItem(deck_name))
+        if deck_names != self.model.deck_names:
+            self.model.set_decks(deck_names)
+        else:
+            # Only card counts changed
+            for deck_name in changed_decks:
+                self.model.refresh_deck(deck_name)
+        if self.search_results.isVisible():
+            self.run_search()
+
+    def done(self, result):
+        self.collection.remove_listener(self.on_deck_changed)
+        self.config.remove_listener(self.on_config_changed)
+        self.cancel_task()
+        if self.index_task is not None:
+            self.index_task.cancel()
+        super().done(result)
 
     def get_selected_items(self):
-        self.selected_decks = []
-        for row in range(self.table.rowCount()):
-            checkbox = self.table.cellWidget(row, 0)
-            if checkbox.isChecked():
-                item_name = self.table.item(row, 1).text()
-                self.selected_decks.append(item_name)
+        self.selected_decks = self.model.selected_decks()
         return self.selected_decks
 
     def open_online_repository(self):
-        try:
-            repo_url = "https://raw.githubusercontent.com/house-of-vanity/pyji/master/decs/repo.yaml"
-            response = requests.get(repo_url)
-            response.raise_for_status()
-            data = yaml.safe_load(response.text)
-            deck_names = data.get('decks', [])
-        except Exception as e:
-            self.show_error_message(f"Failed to fetch repository: {e}")
-            return
+        self.run_task(
+            fetch_repository,
+            on_result=self.show_online_repository,
+            error_prefix="Failed to fetch repository",
+        )
 
+    def show_online_repository(self, deck_names):
         dialog = self.OnlineRepositoryDialog(deck_names, self)
         if dialog.exec():
             selected_decks = dialog.selected_decks
@@ -111,22 +343,47 @@ class DeckSelectionDialog(QDialog):
                 self.download_and_add_decks(selected_decks)
 
     def download_and_add_decks(self, selected_decks):
-        decks_path = f"{conf.get_config_path(config=False)}/decks/"
-        os.makedirs(decks_path, exist_ok=True)  # Ensure the directory exists
-        for deck_name in selected_decks:
-            deck_url = f"https://raw.githubusercontent.com/house-of-vanity/pyji/master/decs/{deck_name}.yaml"
-            try:
-                response = requests.get(deck_url)
-                response.raise_for_status()
-                file_path = os.path.join(decks_path, f"{deck_name}.yaml")
-                with open(file_path, 'wb') as f:
-                    f.write(response.content)
-                # Load the new deck into the collection
-                self.collection.add_new_deck(file_path)
-            except Exception as e:
-                self.show_error_message(f"Failed to download deck {deck_name}: {e}")
-        # After downloading and adding decks, reload the table
-        self.populate_table()
+        decks_path = self.collection.directory_path
+        self.run_task(
+            download_decks,
+            selected_decks,
+            decks_path,
+            self.collection.cache_dir,
+            on_chunk=self.add_downloaded_deck,
+            on_result=self.show_download_errors,
+            error_prefix="Failed to download decks",
+        )
+
+    def sync_online_decks(self):
+        self.run_task(
+            sync_decks,
+            self.collection.directory_path,
+            self.collection.cache_dir,
+            on_chunk=self.add_downloaded_deck,
+            on_result=self.show_sync_results,
+            error_prefix="Failed to update decks",
+        )
+
+    def show_sync_results(self, results):
+        if any(result.error for result in results):
+            self.show_download_errors(results)
+            return
+        updated = [result.deck_name for result in results if result.changed]
+        message = f"Updated: {', '.join(updated)}" if updated else "All downloaded decks are up to date."
+        QMessageBox.information(self, "Online Repository", message)
+
+    def add_downloaded_deck(self, chunk):
+        # Parsed in the background, only adding the cards happens here
+        file_path, decks, stat = chunk
+        self.collection.add_file_decks(file_path, decks, stat)
+
+    def show_download_errors(self, results):
+        errors = [
+            f"Failed to download deck {result.deck_name}: {result.error}"
+            for result in results if result.error
+        ]
+        if errors:
+            self.show_error_message('\n'.join(errors))
 
     def show_error_message(self, message):
         QMessageBox.critical(self, "Error", message)
@@ -139,15 +396,15 @@ class DeckSelectionDialog(QDialog):
             self.selected_decks = []
             self.layout = QVBoxLayout(self)
 
-            self.table = QTableWidget(self)
-            self.table.setColumnCount(2)
-            self.table.setHorizontalHeaderLabels(["Select", "Deck Name"])
-            self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
-            self.table.setRowCount(len(deck_names))
-            for row, deck_name in enumerate(deck_names):
-                checkbox = QCheckBox()
-                self.table.setCellWidget(row, 0, checkbox)
-                self.table.setItem(row, 1, QTableWidgetItem(deck_name))
+            self.filter_box = QLineEdit(self)
+            self.filter_box.setPlaceholderText("Filter decks")
+            self.filter_box.setClearButtonEnabled(True)
+            self.layout.addWidget(self.filter_box)
+
+            self.model = deckmodel.DeckTableModel(deck_names, parent=self)
+            self.proxy = deckmodel.make_proxy(self.model, self)
+            self.filter_box.textChanged.connect(lambda text: self.proxy.setFilterFixedString(text.strip()))
+            self.table = make_deck_view(self.proxy, self)
             self.layout.addWidget(self.table)
 
             # Download button
@@ -161,13 +418,7 @@ class DeckSelectionDialog(QDialog):
             self.layout.addWidget(self.cancel_button)
 
         def download_selected_decks(self):
-            # Collect selected decks
-            self.selected_decks = []
-            for row in range(self.table.rowCount()):
-                checkbox = self.table.cellWidget(row, 0)
-                if checkbox.isChecked():
-                    deck_name = self.table.item(row, 1).text()
-                    self.selected_decks.append(deck_name)
+            self.selected_decks = self.model.selected_decks()
             self.accept()
 
 
@@ -196,6 +447,18 @@ class SettingsDialog(QDialog):
         self.opacity_slider.setValue(int(current_opacity * 100))
         self.layout.addRow("Window opacity (%):", self.opacity_slider)
 
+        # Combo box for selecting how cards are picked
+        self.sampling_combo = QComboBox(self)
+        self.sampling_combo.addItem("Every card equally", "card")
+        self.sampling_combo.addItem("Every deck equally", "deck")
+        self.sampling_combo.setCurrentIndex(self.sampling_combo.findData(parent.sampler.mode))
+        self.layout.addRow("Pick cards:", self.sampling_combo)
+
+        # Checkbox for showing due cards first
+        self.spaced_repetition_checkbox = QCheckBox("Spaced repetition", self)
+        self.spaced_repetition_checkbox.setChecked(parent.scheduler is not None)
+        self.layout.addRow(self.spaced_repetition_checkbox)
+
         # Button for selecting background color
         self.bg_color_button = QPushButton("Select Background Color", self)
         self.bg_color_button.clicked.connect(self.select_bg_color)
@@ -211,6 +474,11 @@ class SettingsDialog(QDialog):
         self.item_selection_button.clicked.connect(self.open_item_selection)
         self.layout.addRow(self.item_selection_button)
 
+        # Another card window with a copy of these settings
+        self.new_window_button = QPushButton("New Window", self)
+        self.new_window_button.clicked.connect(lambda: parent.group.new_window(parent))
+        self.layout.addRow(self.new_window_button)
+
         # License and author information (with link)
         self.info_label = QLabel(self)
         self.info_label.setTextFormat(Qt.RichText)
@@ -232,16 +500,15 @@ class SettingsDialog(QDialog):
         self.layout.addWidget(self.button_box)
 
     def open_item_selection(self):
-        dialog = DeckSelectionDialog(self.collection, self)
+        dialog = DeckSelectionDialog(self.collection, self.parent().config, self, self.parent().section)
         if dialog.exec():
             selected_items = dialog.get_selected_items()
             print("Selected items:", selected_items)
             self.save_selected_decks(selected_items)
 
     def save_selected_decks(self, selected_decks):
-        self.parent().selected_decks = selected_decks
-        self.parent().config['UI']['selected_decks'] = ','.join(selected_decks)
-        conf.write_config(self.parent().config)
+        # Applied by MainWindow.on_config_changed
+        self.parent().config.set(self.parent().section, 'selected_decks', ','.join(selected_decks))
 
     def select_bg_color(self):
         color = QColorDialog.getColor(self.main_bg_color, self, "Select Background Color")
@@ -259,29 +526,266 @@ class SettingsDialog(QDialog):
             self.opacity_slider.value() / 100.0,
             self.main_bg_color,
             self.main_text_color,
+            self.sampling_combo.currentData(),
+            self.spaced_repetition_checkbox.isChecked(),
+        )
+
+def dump_metrics():
+    path = os.path.join(conf.get_cache_path(), METRICS_FILE)
+    try:
+        metrics.dump(path)
+        print(f"Metrics written to {path}")
+    except OSError as e:
+        print(f"Error writing metrics {path}: {e}")
+
+
+class WindowGroup(QObject):
+    """
+    The card windows of the application and what they share: the config service, one collection
+    with its loader and watcher, the text fit cache, the review scheduler and log. Decks are loaded
+    once however many windows there are. Every window keeps its settings in its own config section.
+    """
+
+    # (done, total) deck files while the decks load
+    loadingProgress = Signal(int, int)
+    loadingFinished = Signal()
+
+    def __init__(self, config, parent=None):
+        super().__init__(parent)
+        self.config = config
+        self.collection = deck.Collection(
+            directory_path=f"{conf.get_config_path(config=False)}/decks/",
+            cache_dir=conf.get_cache_path(),
+            store=cardstore.open_store(
+                config.get('Collection', 'card_store', fallback='memory'),
+                conf.get_cache_path(),
+            ),
+            load=False,
+        )
+        self.loader = None
+        self.loaded = False
+        self.deck_watcher = None
+        self.text_fitter = textfit.TextFitter()
+        self.windows = []
+        # Opened while a window uses spaced repetition
+        self.scheduler = None
+        self.scheduler_users = 0
+        # Every card shown and answer revealed, in any window
+        self.review_log = reviewlog.ReviewLog(conf.get_config_path(config=False))
+        if metrics.enabled:
+            self.lag_timer = QTimer(self)
+            self.lag_timer.setInterval(LAG_INTERVAL_MS)
+            self.lag_timer.timeout.connect(self.sample_lag)
+            self.lag_last = time.perf_counter()
+            self.lag_timer.start()
+
+    def sample_lag(self):
+        now = time.perf_counter()
+        # How much later than asked the timer fired
+        metrics.record('ui.event_loop_lag', max(now - self.lag_last - LAG_INTERVAL_MS / 1000, 0.0))
+        self.lag_last = now
+
+    def open_windows(self, startup_profile=None):
+        """
+        Open the windows that were open when the application was last closed, a single one the first time.
+        """
+        sections = [section for section in self.config.get(WINDOWS_SECTION, 'open', fallback='').split(',') if section]
+        for index, section in enumerate(sections or [MAIN_SECTION]):
+            window = MainWindow(self.config, startup_profile if index == 0 else None, group=self, section=section)
+            window.show()
+        return list(self.windows)
+
+    def new_window(self, source=None):
+        """
+        Open another card window next to `source`, with a copy of its settings.
+        """
+        sections = {window.section for window in self.windows}
+        number = 2
+        while f"Window {number}" in sections:
+            number += 1
+        section = f"Window {number}"
+        # Left over from a window that was closed
+        self.config.remove_section(section)
+        if source is not None:
+            values = self.config.get_section(source.section)
+            values.update({
+                'x': source.x() + NEW_WINDOW_OFFSET,
+                'y': source.y() + NEW_WINDOW_OFFSET,
+                'width': source.width(),
+                'height': source.height(),
+            })
+            self.config.update(section, values)
+        window = MainWindow(self.config, group=self, section=section)
+        window.show()
+        return window
+
+    def add_window(self, window):
+        self.windows.append(window)
+        self.save_open_windows()
+        # Paint the window first, decks load after the event loop has started
+        QTimer.singleShot(0, self.start_loading)
+
+    def forget_window(self, window):
+        """
+        Leave a window out of the ones opened next time, unless it is the last one open.
+        """
+        windows = [other for other in self.windows if other is not window]
+        if windows:
+            self.save_open_windows(windows)
+
+    def window_closed(self, window):
+        # Quitting closes every window too, so they stay in the list of open windows
+        if window in self.windows:
+            self.windows.remove(window)
+        if not self.windows and self.loader:
+            self.loader.cancel()
+
+    def save_open_windows(self, windows=None):
+        windows = self.windows if windows is None else windows
+        self.config.set(WINDOWS_SECTION, 'open', ','.join(window.section for window in windows))
+
+    def acquire_scheduler(self):
+        if self.scheduler is None:
+            self.scheduler = scheduler.Scheduler(os.path.join(conf.get_config_path(config=False), 'reviews.db'))
+        self.scheduler_users += 1
+        return self.scheduler
+
+    def release_scheduler(self):
+        self.scheduler_users -= 1
+        if not self.scheduler_users:
+            self.scheduler.close()
+            self.scheduler = None
+
+    def start_loading(self):
+        """
+        Parse the deck files in the background, cards are added as each chunk is read.
+        """
+        if self.loaded or self.loader is not None:
+            return
+        self.loading_started = time.perf_counter()
+        file_names, self.loading_stats = self.collection.plan_load()
+        self.loading_files = file_names
+        self.loader = workers.Worker(
+            watcher.read_deck_files, self.collection.directory_path, self.collection.cache_dir, file_names
         )
+        self.loader.signals.progress.connect(self.loadingProgress)
+        self.loader.signals.chunk.connect(self.on_deck_file_loaded)
+        self.loader.signals.result.connect(self.on_loading_done)
+        self.loader.signals.error.connect(lambda message: print(f"Failed to load decks: {message}"))
+        self.loader.signals.finished.connect(self.on_loading_finished)
+        self.loader.start()
+
+    @metrics.timed('ui.add_deck_chunk')
+    def on_deck_file_loaded(self, chunk):
+        file_name, decks, last = chunk
+        # Windows waiting for a card show one as the collection tells them about it
+        self.collection.add_chunk(file_name, decks, last, self.loading_stats[file_name])
+
+    def on_loading_done(self, report):
+        self.collection.record_files(self.loading_files, self.loading_stats)
+        self.collection.load_report.loaded_files.extend(report.loaded_files)
+        self.collection.load_report.errors.extend(report.errors)
+        self.collection.load_report.skipped.extend(report.skipped)
+        for error in report.errors:
+            print(f"Error processing file {error.file_name}: {error.message}")
+        for skipped in report.skipped:
+            print(f"In file {skipped.file_name}, {skipped.message}")
+        # Watch for changes only once the initial state is known
+        self.deck_watcher = watcher.DeckWatcher(self.collection, self)
+
+    def on_loading_finished(self):
+        self.loader = None
+        self.loaded = True
+        metrics.record('ui.deck_load', time.perf_counter() - self.loading_started)
+        self.loadingFinished.emit()
+
+    def close(self):
+        """
+        Release what the windows shared and save the search index, once they are all closed.
+        """
+        if self.loader:
+            self.loader.cancel()
+        if self.deck_watcher:
+            self.deck_watcher.stop()
+        if self.scheduler is not None:
+            self.scheduler.close()
+            self.scheduler = None
+        self.review_log.close()
+        self.collection.close()
+
 
 class MainWindow(QWidget):
-    def __init__(self, config):
+    def __init__(self, config, startup_profile=None, group=None, section=MAIN_SECTION):
+        """
+        A floating card window. Windows of the same `group` share its collection, a window
+        without one gets a group of its own. Settings are read from and written to the config
+        `section`, keys it doesn't have fall back to the ones of the first window.
+        """
         super().__init__()
-        self.collection = deck.Collection(directory_path=f"{conf.get_config_path(config=False)}/decks/")
+        # Marks the startup steps when started with --profile-startup
+        self.startup_profile = startup_profile
+        self.painted = False
+        self.group = group if group is not None else WindowGroup(config)
+        self.section = section
+        self.collection = self.group.collection
         self.current_card = None
+        self.current_deck = None
+        self.current_revealed = False
+        self.current_graded = False
+        self.showing_question = True
+        # Path of the image shown instead of text, if the shown side is an image
+        self.side_image = None
+        # is_question -> SideLayout of the current card, and (deck, card, layouts) of the card shown next
+        self.side_layouts = {}
+        self.next_card = None
         self.config = config
-        self.update_interval = config.getint("UI", "update_interval", fallback=10)
-        self.window_opacity = config.getfloat("UI", "window_opacity", fallback=1.0)
-        self.bg_color = QColor(config.get("UI", "bg_color", fallback="#ff55ff"))
-        self.text_color = QColor(config.get("UI", "text_color", fallback="#000000"))
-        selected_decks = self.config.get('UI', 'selected_decks', fallback='')
+        self.update_interval = int(self.setting("update_interval", 10))
+        self.window_opacity = float(self.setting("window_opacity", 1.0))
+        self.bg_color = QColor(self.setting("bg_color", "#ff55ff"))
+        self.text_color = QColor(self.setting("text_color", "#000000"))
+        selected_decks = self.setting('selected_decks', '')
+        # Without a saved selection every deck is shown, including ones added later
+        self.select_all_decks = not selected_decks
         if selected_decks:
             self.selected_decks = selected_decks.split(',')
         else:
             self.selected_decks = self.collection.get_decks()
+        self.sampler = deck.WeightedSampler(
+            self.collection,
+            self.setting('sampling', 'card'),
+            self.selected_decks,
+        )
+        self.scheduler = None
+        if self.setting('scheduler', 'random') == 'sm2':
+            self.start_scheduler()
+        self.collection.add_listener(self.on_deck_changed)
+        self.config.add_listener(self.on_config_changed)
 
         self.oldPos = self.pos()  # For moving the window
         self.resizing = False  # For resizing the window
         self.always_on_top = False  # Track the always on top state
         self.timer_running = True  # Track timer state
+        self.text_fitter = self.group.text_fitter
+        # Refit the text at most once per interval while the window is being resized
+        self.resize_timer = QTimer(self)
+        self.resize_timer.setSingleShot(True)
+        self.resize_timer.setInterval(RESIZE_THROTTLE_MS)
+        self.resize_timer.timeout.connect(self.fit_content)
         self.initUI()
+        self.group.loadingProgress.connect(self.on_loading_progress)
+        self.group.loadingFinished.connect(self.on_loading_finished)
+        self.group.add_window(self)
+
+    @property
+    def loader(self):
+        # The deck loader of the group while decks are loading
+        return self.group.loader
+
+    def setting(self, key, fallback=None):
+        """
+        Get a setting of this window from its section, or else from the section of the first window.
+        """
+        return self.config.get(self.section, key, fallback=self.config.get(MAIN_SECTION, key, fallback=fallback))
 
     def apply_styles(self):
         """
@@ -299,7 +803,13 @@ class MainWindow(QWidget):
         )
 
     def initUI(self):
-        self.resize(200, 200)
+        self.resize(
+            int(self.setting("width", DEFAULT_WINDOW_SIZE)), int(self.setting("height", DEFAULT_WINDOW_SIZE))
+        )
+        x, y = self.config.get(self.section, "x"), self.config.get(self.section, "y")
+        # Left where the window manager puts it if the screen it was on is gone
+        if x is not None and y is not None and QGuiApplication.screenAt(QPoint(int(x), int(y))) is not None:
+            self.move(int(x), int(y))
         self.setWindowTitle("PyJi")
 
         # Remove window frame
@@ -325,11 +835,10 @@ class MainWindow(QWidget):
         self.label.setAlignment(Qt.AlignCenter)
         self.label.setWordWrap(True)
         self.label.setObjectName("MainText")
-        self.update_font_size()
 
         # Settings button
         self.settings_button = QPushButton(self)
-        self.settings_button.setIcon(QIcon(resource_path("icons/settings.png")))
+        self.settings_button.setIcon(images.get_cache().icon(resource_path("icons/settings.png"), ICON_SIZE))
         self.settings_button.setFixedSize(16, 16)
         self.settings_button.clicked.connect(self.open_settings)
         self.settings_button.setStyleSheet("QPushButton { border: none; }")
@@ -337,21 +846,23 @@ class MainWindow(QWidget):
 
         # Close button
         self.close_button = QPushButton(self)
-        self.close_button.setIcon(QIcon(resource_path("icons/close.png")))
+        self.close_button.setIcon(images.get_cache().icon(resource_path("icons/close.png"), ICON_SIZE))
         self.close_button.setFixedSize(12, 12)
-        self.close_button.clicked.connect(self.close)
+        self.close_button.clicked.connect(self.close_window)
         self.close_button.setStyleSheet("QPushButton { border: none; }")
         self.close_button.setCursor(Qt.CursorShape.PointingHandCursor)
 
         # Always on top button
         self.always_on_top_button = QPushButton(self)
         # Set pin state
-        if self.config.getboolean("UI", "pin", fallback=False):
+        if self.config.getboolean(
+            self.section, "pin", fallback=self.config.getboolean(MAIN_SECTION, "pin", fallback=False)
+        ):
             self.setWindowFlags(self.windowFlags() | Qt.WindowStaysOnTopHint)
-            self.always_on_top_button.setIcon(QIcon(resource_path("icons/pin.png")))
+            self.always_on_top_button.setIcon(images.get_cache().icon(resource_path("icons/pin.png"), ICON_SIZE))
             self.always_on_top = not self.always_on_top
         else:
-            self.always_on_top_button.setIcon(QIcon(resource_path("icons/unpin.png")))
+            self.always_on_top_button.setIcon(images.get_cache().icon(resource_path("icons/unpin.png"), ICON_SIZE))
         self.always_on_top_button.setFixedSize(20, 20)
         self.always_on_top_button.clicked.connect(self.toggle_always_on_top)
         self.always_on_top_button.setStyleSheet("QPushButton { border: none; }")
@@ -360,7 +871,7 @@ class MainWindow(QWidget):
         # Resize icon
         self.resize_icon = QLabel(self)
         self.resize_icon.setPixmap(
-            QPixmap(resource_path("icons/resize.png")).scaled(14, 14, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            images.get_cache().icon_pixmap(resource_path("icons/resize.png"), 14)
         )
         self.resize_icon.setCursor(Qt.SizeFDiagCursor)
 
@@ -377,98 +888,368 @@ class MainWindow(QWidget):
         button_layout.addWidget(self.close_button)
 
         # Center layout for the label
-        center_layout = QVBoxLayout()
-        center_layout.addStretch()
-        center_layout.addWidget(self.label)
-        center_layout.addStretch()
-        center_layout.setAlignment(Qt.AlignCenter)
+        self.center_layout = QVBoxLayout()
+        self.center_layout.addStretch()
+        self.center_layout.addWidget(self.label)
+        self.center_layout.addStretch()
+        self.center_layout.setAlignment(Qt.AlignCenter)
 
         # Layout for bottom buttons
+        # Deck loading progress, only visible while decks load
+        self.progress_bar = QProgressBar(self)
+        self.progress_bar.setTextVisible(False)
+        self.progress_bar.setFixedHeight(6)
+        self.progress_bar.setRange(0, 0)
+        self.progress_bar.setVisible(not self.group.loaded)
+
         bottom_layout = QHBoxLayout()
         bottom_layout.addWidget(self.timer_icon, alignment=Qt.AlignLeft | Qt.AlignBottom)
+        bottom_layout.addWidget(self.progress_bar, 1, alignment=Qt.AlignBottom)
         bottom_layout.addStretch()
         bottom_layout.addWidget(self.resize_icon, alignment=Qt.AlignRight | Qt.AlignBottom)
 
         # Main layout
         main_layout = QVBoxLayout()
         main_layout.addLayout(button_layout)
-        main_layout.addLayout(center_layout)
+        main_layout.addLayout(self.center_layout)
         main_layout.addLayout(bottom_layout)
         main_layout.setStretch(1, 1)  # Make center_layout take all available space
         self.setLayout(main_layout)
+        self.update_font_size()
+
+        # Picks and lays out the next card once the event loop is idle after a change
+        self.prefetch_timer = QTimer(self)
+        self.prefetch_timer.setSingleShot(True)
+        self.prefetch_timer.setInterval(0)
+        self.prefetch_timer.timeout.connect(self.prefetch)
 
         # Create timer for updating text every second
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.update_text)
         self.timer.start(self.update_interval * 1000)  # Interval in milliseconds
 
+        QShortcut(QKeySequence(QKeySequence.New), self, lambda: self.group.new_window(self))
+
+        if metrics.enabled:
+            self.setup_metrics()
+
+    def setup_metrics(self):
+        """
+        Add the hidden stats overlay, toggled with Ctrl+Shift+M.
+        Ctrl+Shift+J writes the metrics to the cache directory.
+        """
+        self.stats_overlay = QLabel(self)
+        self.stats_overlay.setStyleSheet("QLabel { background-color: rgba(0, 0, 0, 180); color: white; padding: 4px; }")
+        font = self.stats_overlay.font()
+        font.setFamily("monospace")
+        font.setPointSize(7)
+        self.stats_overlay.setFont(font)
+        self.stats_overlay.hide()
+        self.overlay_timer = QTimer(self)
+        self.overlay_timer.setInterval(OVERLAY_INTERVAL_MS)
+        self.overlay_timer.timeout.connect(self.update_stats_overlay)
+        QShortcut(QKeySequence("Ctrl+Shift+M"), self, self.toggle_stats_overlay)
+        QShortcut(QKeySequence("Ctrl+Shift+J"), self, self.dump_metrics)
+
+    def toggle_stats_overlay(self):
+        if self.stats_overlay.isVisible():
+            self.overlay_timer.stop()
+            self.stats_overlay.hide()
+        else:
+            self.update_stats_overlay()
+            self.stats_overlay.show()
+            self.stats_overlay.raise_()
+            self.overlay_timer.start()
+
+    def update_stats_overlay(self):
+        self.stats_overlay.setText('\n'.join(metrics.summary_lines()) or "No metrics yet")
+        self.stats_overlay.adjustSize()
+
+    def dump_metrics(self):
+        dump_metrics()
+
+    @metrics.timed('ui.update_text')
     def update_text(self):
+        if self.scheduler and self.current_graded and not self.current_revealed:
+            # Card went by without a peek at the answer
+            self.scheduler.review(self.current_deck, self.current_card, scheduler.GOOD)
         if self.selected_decks:
-            deck_name = random.choice(self.selected_decks)
-            try:
-                card = self.collection.get_random_card(deck_name)
+            prefetched, self.next_card = self.next_card, None
+            picked = prefetched[:2] if prefetched else self.pick_card()
+            if picked is None:
+                self.label.setText("Loading decks..." if self.loader else "No cards in the selected decks")
+            else:
+                self.current_deck, card = picked
                 self.current_card = card  # Save current card
-                self.label.setText(card[0])  # Show question
-                self.update_font_size(is_question=True)  # Set huge font for question
-                self.label.adjustSize()
-            except ValueError as e:
-                self.label.setText(str(e))
+                self.current_revealed = False
+                # Cards shown ahead of their review time aren't graded
+                self.current_graded = self.scheduler is not None and self.scheduler.is_due(card)
+                self.side_layouts = prefetched[2] if prefetched else {}
+                self.show_side(is_question=True)
+                self.group.review_log.record(card.card_id(), self.current_deck, reviewlog.SHOWN)
+                self.mark_startup("first card")
+                self.prefetch_timer.start()
         else:
             self.label.setText("No decks selected")
 
+    def pick_card(self):
+        # The card on screen is reviewed before the next one shows, so a due one isn't picked again
+        exclude = self.current_card.card_id() if self.current_card else None
+        return self.scheduler.pick(self.sampler, exclude=exclude) if self.scheduler else self.sampler.sample()
+
+    @metrics.timed('ui.prefetch')
+    def prefetch(self):
+        """
+        Lay out the answer of the current card, then pick the next card and lay out both its sides,
+        so flipping and the next tick only swap in what is ready.
+        """
+        if self.current_card is None:
+            return
+        box = self.text_box()
+        if self.next_card is None and self.selected_decks:
+            picked = self.pick_card()
+            if picked is not None:
+                self.next_card = (*picked, {})
+        pending = [(self.current_card, self.side_layouts, False)]
+        if self.next_card is not None:
+            pending += [(self.next_card[1], self.next_card[2], True), (self.next_card[1], self.next_card[2], False)]
+        for card, layouts, is_question in pending:
+            layout = layouts.get(is_question)
+            if layout is None or layout.box != box:
+                layouts[is_question] = self.layout_side(card, is_question)
+
+    def drop_next_card(self):
+        # The selection changed, pick again
+        self.next_card = None
+        if self.current_card is not None:
+            self.prefetch_timer.start()
+
+    def on_loading_progress(self, done, total):
+        self.progress_bar.setRange(0, total)
+        self.progress_bar.setValue(done)
+
+    def on_loading_finished(self):
+        self.progress_bar.hide()
+        if self.current_card is None:
+            self.update_text()
+        self.mark_startup("deck load")
+        if self.startup_profile:
+            self.startup_profile.report()
+            self.startup_profile = None
+
+    def mark_startup(self, step):
+        if self.startup_profile:
+            self.startup_profile.mark(step)
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self.painted:
+            self.painted = True
+            self.mark_startup("first paint")
+
+    def closeEvent(self, event):
+        self.save_geometry()
+        self.timer.stop()
+        # The collection and config outlive the window when other windows are still open
+        self.config.remove_listener(self.on_config_changed)
+        self.collection.remove_listener(self.on_deck_changed)
+        self.sampler.close()
+        self.stop_scheduler()
+        self.group.window_closed(self)
+        super().closeEvent(event)
+
+    def close_window(self):
+        # Closed on its own rather than by quitting, so it isn't opened next time
+        self.group.forget_window(self)
+        self.close()
+
+    def save_geometry(self):
+        self.config.update(self.section, {'x': self.x(), 'y': self.y(), 'width': self.width(), 'height': self.height()})
+
+    def on_deck_changed(self, deck_name):
+        if self.select_all_decks and deck_name not in self.selected_decks and self.collection.count(deck_name):
+            self.selected_decks.append(deck_name)
+            self.sampler.set_deck_selected(deck_name, True)
+        if self.next_card is not None and self.next_card[0] == deck_name:
+            self.drop_next_card()
+        if self.current_card is None and self.collection.count(deck_name):
+            # Show a card as soon as there is one
+            self.update_text()
+
+    def start_scheduler(self):
+        self.scheduler = self.group.acquire_scheduler()
+
+    def stop_scheduler(self):
+        if self.scheduler is not None:
+            self.group.release_scheduler()
+            self.scheduler = None
+
     def update_timer_icon(self):
         if self.timer_running:
             self.timer_icon.setPixmap(
-                QPixmap(resource_path("icons/play.png")).scaled(14, 14, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+                images.get_cache().icon_pixmap(resource_path("icons/play.png"), 14)
             )
         else:
             self.timer_icon.setPixmap(
-                QPixmap(resource_path("icons/pause.png")).scaled(14, 14, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+                images.get_cache().icon_pixmap(resource_path("icons/pause.png"), 14)
             )
 
     def open_settings(self):
         dialog = SettingsDialog(self.update_interval, self.window_opacity, self.collection, self)
         if dialog.exec():
-            self.update_interval, self.window_opacity, self.bg_color, self.text_color = dialog.get_settings()
+            (
+                update_interval,
+                window_opacity,
+                bg_color,
+                text_color,
+                sampling,
+                spaced_repetition,
+            ) = dialog.get_settings()
+            # Applied by on_config_changed
+            self.config.update(self.section, {
+                "update_interval": update_interval,
+                "window_opacity": window_opacity,
+                "bg_color": bg_color.name(),
+                "text_color": text_color.name(),
+                "sampling": sampling,
+                "scheduler": "sm2" if spaced_repetition else "random",
+            })
+
+    def on_config_changed(self, section, key, value):
+        if section != self.section:
+            return
+        if key == "update_interval":
+            self.update_interval = int(value)
             self.timer.setInterval(self.update_interval * 1000)  # Update timer interval
+        elif key == "window_opacity":
+            self.window_opacity = float(value)
             self.setWindowOpacity(self.window_opacity)  # Update window opacity
+        elif key in ("bg_color", "text_color"):
+            self.bg_color = QColor(self.setting("bg_color"))
+            self.text_color = QColor(self.setting("text_color"))
             self.apply_styles()
-            # Apply styles specific to MainWindow only
-            self.config["UI"]["update_interval"] = str(self.update_interval)
-            self.config["UI"]["window_opacity"] = str(self.window_opacity)
-            self.config["UI"]["bg_color"] = self.bg_color.name()
-            self.config["UI"]["text_color"] = self.text_color.name()
-            conf.write_config(self.config)
+        elif key == "sampling":
+            self.sampler.set_mode(value)
+            self.drop_next_card()
+        elif key == "scheduler":
+            if value == "sm2" and not self.scheduler:
+                self.start_scheduler()
+            elif value != "sm2" and self.scheduler:
+                self.stop_scheduler()
+            self.drop_next_card()
+        elif key == "pin":
+            self.set_always_on_top(value == "True")
+        elif key == "selected_decks":
+            self.selected_decks = value.split(',') if value else []
+            self.select_all_decks = False
+            self.sampler.select(self.selected_decks)
+            self.drop_next_card()
+
+    def text_box(self):
+        """
+        Get the (width, height) the label text may take up.
+        """
+        rect = self.center_layout.geometry()
+        if rect.isEmpty():
+            # Not laid out yet
+            rect = self.contentsRect()
+        return rect.width() - TEXT_BOX_MARGIN, rect.height() - TEXT_BOX_MARGIN
 
+    @metrics.timed('ui.update_font_size')
     def update_font_size(self, is_question=True):
-        base_font_size = min(self.width(), self.height()) // 3
         font = self.label.font()
-        if is_question:
-            font.setPointSize(base_font_size)  # Set huge font for question
+        # Shrink long texts until they fit the window
+        size = self.text_fitter.fit(self.label.text(), font, *self.text_box(), self.max_font_size(is_question))
+        if size != font.pointSize():
+            font.setPointSize(size)
+            self.label.setFont(font)
+
+    def card_image(self, field):
+        """
+        Get the path of the image a card field refers to, None for a text field.
+        Relative paths are relative to the decks directory.
+        """
+        reference = cardstore.image_reference(field)
+        if reference is None:
+            return None
+        return os.path.join(self.collection.directory_path, reference)
+
+    def max_font_size(self, is_question):
+        base_font_size = min(self.width(), self.height()) // 3
+        # Huge font for the question, smaller for the answer
+        return base_font_size if is_question else base_font_size * 0.3
+
+    def layout_side(self, card, is_question):
+        """
+        Work out how a side of a card is shown at the current window size, without showing it.
+        """
+        box = self.text_box()
+        image = self.card_image(card.question if is_question else card.answer)
+        # The comment of an image answer is shown on hover
+        tooltip = '' if is_question or not image else card.comment
+        if image:
+            # Images are only decoded when shown or prefetched, scaled versions come from the shared cache
+            pixmap = images.get_cache().pixmap(image, *box)
+            if pixmap is not None:
+                return SideLayout(box, None, None, image, pixmap, tooltip)
+            text = f"Image not found: {os.path.basename(image)}"
+            is_question = False
         else:
-            font.setPointSize(base_font_size * 0.3)  # Set smaller font for answer
-        self.label.setFont(font)
+            text = card.question if is_question else card.back_text()
+        point_size = self.text_fitter.fit(text, self.label.font(), *box, self.max_font_size(is_question))
+        return SideLayout(box, text, point_size, image, None, tooltip)
 
-    def resizeEvent(self, event):
-        if self.current_card and self.label.text() == self.current_card[0]:
-            # If question
-            self.update_font_size(is_question=True)
+    @metrics.timed('ui.show_side')
+    def show_side(self, is_question):
+        """
+        Show the question or the back of the current card, as text or as an image.
+        """
+        layout = self.side_layouts.get(is_question)
+        if layout is None or layout.box != self.text_box():
+            layout = self.side_layouts[is_question] = self.layout_side(self.current_card, is_question)
+        self.showing_question = is_question
+        self.side_image = layout.image
+        self.label.setToolTip(layout.tooltip)
+        if layout.pixmap is not None:
+            self.label.setPixmap(layout.pixmap)
+        else:
+            self.label.setText(layout.text)
+            font = self.label.font()
+            if layout.point_size != font.pointSize():
+                font.setPointSize(layout.point_size)
+                self.label.setFont(font)
+        self.label.adjustSize()
+
+    @metrics.timed('ui.fit_content')
+    def fit_content(self):
+        if self.current_card:
+            self.show_side(self.showing_question)
+            # Layouts made for the old size are redone
+            self.prefetch_timer.start()
         else:
-            # If answer
             self.update_font_size(is_question=False)
+
+    @metrics.timed('ui.resize_event')
+    def resizeEvent(self, event):
+        # Resize drags send an event per mouse move, refit on a timer instead of for each of them
+        if not self.resize_timer.isActive():
+            self.resize_timer.start()
         super().resizeEvent(event)
 
     def toggle_always_on_top(self):
-        if self.always_on_top:
-            self.setWindowFlags(self.windowFlags() & ~Qt.WindowStaysOnTopHint)
-            self.config["UI"]["pin"] = "False"
-            self.always_on_top_button.setIcon(QIcon(resource_path("icons/unpin.png")))
-        else:
+        # Applied by on_config_changed
+        self.config.set(self.section, "pin", str(not self.always_on_top))
+
+    def set_always_on_top(self, always_on_top):
+        if always_on_top == self.always_on_top:
+            return
+        if always_on_top:
             self.setWindowFlags(self.windowFlags() | Qt.WindowStaysOnTopHint)
-            self.always_on_top_button.setIcon(QIcon(resource_path("icons/pin.png")))
-            self.config["UI"]["pin"] = "True"
-        self.always_on_top = not self.always_on_top
-        conf.write_config(self.config)
+            self.always_on_top_button.setIcon(images.get_cache().icon(resource_path("icons/pin.png"), ICON_SIZE))
+        else:
+            self.setWindowFlags(self.windowFlags() & ~Qt.WindowStaysOnTopHint)
+            self.always_on_top_button.setIcon(images.get_cache().icon(resource_path("icons/unpin.png"), ICON_SIZE))
+        self.always_on_top = always_on_top
         self.show()
 
     def mousePressEvent(self, event: QMouseEvent):
@@ -479,6 +1260,7 @@ class MainWindow(QWidget):
             else:
                 self.resizing = False
 
+    @metrics.timed('ui.mouse_move')
     def mouseMoveEvent(self, event: QMouseEvent):
         if event.buttons() == Qt.LeftButton:
             if self.resizing:
@@ -501,6 +1283,8 @@ class MainWindow(QWidget):
                         self.timer.stop()
                         self.timer_running = False
                         self.update_timer_icon()
+            # Only written if it was moved or resized
+            self.save_geometry()
         elif event.button() == Qt.RightButton:
             if self.current_card:
                 # Stop timer if running
@@ -508,20 +1292,17 @@ class MainWindow(QWidget):
                     self.timer.stop()
                     self.timer_running = False
                     self.update_timer_icon()
-                current_text = self.label.text()
                 # If questions
-                if current_text == self.current_card[0]:
-                    # Join answer and comment
-                    combined_text = self.current_card[1]
-                    if len(self.current_card) > 2:
-                        combined_text += '\n' + self.current_card[2]
-                    self.label.setText(combined_text)
-                    self.update_font_size(is_question=False)
+                if self.showing_question:
+                    if self.scheduler and self.current_graded and not self.current_revealed:
+                        # Peeking at the answer counts as not knowing the card
+                        self.scheduler.review(self.current_deck, self.current_card, scheduler.AGAIN)
+                    self.current_revealed = True
+                    self.show_side(is_question=False)
+                    self.group.review_log.record(self.current_card.card_id(), self.current_deck, reviewlog.REVEALED)
                 else:
                     # Возвращаемся к первой стороне
-                    self.label.setText(self.current_card[0])
-                    self.update_font_size(is_question=True)
-                self.label.adjustSize()
+                    self.show_side(is_question=True)
 
         self.resizing = False
 
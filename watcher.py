@@ -0,0 +1,129 @@
+import os
+
+from PySide6.QtCore import QObject, QFileSystemWatcher, QTimer, Signal
+
+# Locals
+import deck
+import workers
+
+# Editors save in several steps, wait for them to settle before re-reading
+DEBOUNCE_MS = 300
+# Used when the platform has no file notifications for the directory
+POLL_INTERVAL_MS = 5000
+
+
+def read_deck_files(worker, directory_path, cache_dir, file_names):
+    """
+    Parse deck files, sending (file name, decks, last) chunks as they are read. Returns the deck.LoadReport.
+    """
+    report = deck.LoadReport()
+    for chunk in deck.iter_deck_chunks(
+        directory_path, cache_dir, report=report, file_names=file_names, progress=worker.report_progress
+    ):
+        if worker.cancelled:
+            break
+        worker.emit_chunk(chunk)
+    return report
+
+
+class DeckWatcher(QObject):
+    """
+    Watches the decks directory of a collection and applies added, changed and removed files to it.
+    Uses the native file notifications of QFileSystemWatcher (inotify on Linux) and falls back
+    to polling when the directory can't be watched. Changed files are parsed in a Worker like
+    the first load, and their chunks added to the collection as they arrive.
+    """
+
+    # Emitted with the deck.LoadReport of every refresh that changed something
+    decksChanged = Signal(object)
+
+    def __init__(self, collection, parent=None):
+        super().__init__(parent)
+        self.collection = collection
+
+        self.debounce_timer = QTimer(self)
+        self.debounce_timer.setSingleShot(True)
+        self.debounce_timer.setInterval(DEBOUNCE_MS)
+        self.debounce_timer.timeout.connect(self.refresh)
+
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.schedule_refresh)
+        self.watcher.fileChanged.connect(self.schedule_refresh)
+
+        self.poll_timer = QTimer(self)
+        self.poll_timer.setInterval(POLL_INTERVAL_MS)
+        self.poll_timer.timeout.connect(self.refresh)
+
+        # Worker reading changed files, changes seen meanwhile wait for it
+        self.task = None
+        self.pending = False
+
+        if self.watcher.addPath(collection.directory_path):
+            self.watch_files()
+        else:
+            self.poll_timer.start()
+
+    def watch_files(self):
+        # The directory only reports added and removed files, edits in place need the files watched too
+        watched = set(self.watcher.files())
+        paths = [
+            os.path.join(self.collection.directory_path, file_name)
+            for file_name in self.collection.file_states
+        ]
+        new_paths = [path for path in paths if path not in watched]
+        if new_paths:
+            self.watcher.addPaths(new_paths)
+
+    def schedule_refresh(self, _path=None):
+        self.debounce_timer.start()
+
+    def refresh(self):
+        if self.task is not None:
+            self.pending = True
+            return
+        report, file_names, stats = self.collection.plan_refresh()
+        if not file_names:
+            self.refresh_done(report)
+            return
+        self.task = workers.Worker(
+            read_deck_files, self.collection.directory_path, self.collection.cache_dir, file_names
+        )
+        self.task.signals.chunk.connect(
+            lambda chunk: self.collection.add_chunk(*chunk, stats[chunk[0]])
+        )
+        self.task.signals.result.connect(lambda read_report: self.on_files_read(read_report, report, file_names, stats))
+        self.task.signals.error.connect(lambda message: print(f"Failed to reload decks: {message}"))
+        self.task.signals.finished.connect(self.on_refresh_finished)
+        self.task.start()
+
+    def on_files_read(self, read_report, report, file_names, stats):
+        self.collection.record_files(file_names, stats)
+        report.loaded_files.extend(read_report.loaded_files)
+        report.errors.extend(read_report.errors)
+        report.skipped.extend(read_report.skipped)
+        self.refresh_done(report)
+
+    def on_refresh_finished(self):
+        self.task = None
+        if self.pending:
+            self.pending = False
+            self.refresh()
+
+    def refresh_done(self, report):
+        if not self.poll_timer.isActive():
+            self.watch_files()
+        if report.loaded_files or report.removed_files or report.errors:
+            for error in report.errors:
+                print(f"Error processing file {error.file_name}: {error.message}")
+            for skipped in report.skipped:
+                print(f"In file {skipped.file_name}, {skipped.message}")
+            self.decksChanged.emit(report)
+
+    def stop(self):
+        """
+        Stop watching and cancel a refresh in progress.
+        """
+        self.debounce_timer.stop()
+        self.poll_timer.stop()
+        if self.task is not None:
+            self.task.cancel()
@@ -0,0 +1,61 @@
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Signal
+
+
+class WorkerSignals(QObject):
+    """
+    Signals of a Worker. They are emitted from the pool thread and delivered on the GUI thread.
+    """
+
+    # (done, total)
+    progress = Signal(int, int)
+    # Partial results, e.g. one parsed deck file
+    chunk = Signal(object)
+    result = Signal(object)
+    error = Signal(str)
+    finished = Signal()
+
+
+class Worker(QRunnable):
+    """
+    Runs `fn(worker, *args, **kwargs)` on the global QThreadPool.
+
+    `fn` reports through `worker.report_progress` and `worker.emit_chunk`, and should
+    check `worker.cancelled` between steps and return early once it is set.
+    """
+
+    def __init__(self, fn, *args, **kwargs):
+        super().__init__()
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = WorkerSignals()
+        self.cancelled = False
+        # Lifetime is managed from Python, callers keep a reference while it runs
+        self.setAutoDelete(False)
+
+    def start(self):
+        """
+        Queue the worker on the global thread pool. Connect to its signals before calling this.
+        """
+        QThreadPool.globalInstance().start(self)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def report_progress(self, done, total):
+        self.signals.progress.emit(done, total)
+
+    def emit_chunk(self, chunk):
+        self.signals.chunk.emit(chunk)
+
+    def run(self):
+        try:
+            result = self.fn(self, *self.args, **self.kwargs)
+        except Exception as e:
+            self.signals.error.emit(str(e))
+        else:
+            if not self.cancelled:
+                self.signals.result.emit(result)
+        finally:
+            self.signals.finished.emit()
+